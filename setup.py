@@ -50,6 +50,7 @@ setup(
         'addict',
         'ordered_set',
         'pandas',
+        'h5py',
         'lama_phenotype_detection'
     ],
 
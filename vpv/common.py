@@ -3,6 +3,7 @@ from inspect import getframeinfo, stack
 import SimpleITK as sitk
 import tempfile
 import gzip
+import shutil
 from os.path import splitext, dirname, realpath, join, isdir
 from os import mkdir
 import yaml
@@ -12,6 +13,7 @@ from PyQt5 import QtCore
 from PyQt5.QtWidgets import QMessageBox
 from typing import Tuple
 import numpy as np
+from vpv.utils.native_readers import decompress_image, read_zip_member, ZipMember
 
 RAS_DIRECTIONS = (-1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 1.0)
 LPS_DIRECTIONS = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
@@ -165,17 +167,46 @@ class Layers(Enum):
 # If the space directions are like this, no need to transform
 NO_TRANSFORM_VEC = (1, 0, 0, 0, 1, 0, 0, 0, 1)
 
+def _gunzip_to_temp(img_path):
+    """
+    Fallback for gzipped images we can't decompress natively. Stream the decompressed file to a temporary file that
+    SimpleITK can read. The returned NamedTemporaryFile must be kept alive until the image has been read
+    """
+    # Get the image file extension
+    ex = splitext(splitext(img_path)[0])[1]
+    tmp = tempfile.NamedTemporaryFile(suffix=ex)
+    with gzip.open(img_path, 'rb') as infile:
+        shutil.copyfileobj(infile, tmp)
+    tmp.flush()
+    return tmp
+
+
 class ImageReader(object):
     def __init__(self, img_path, memmap=False):
 
+        self.img = None
+
+        if isinstance(img_path, ZipMember):
+            # Stream the image out of the zip. If that's not possible, extract only this image
+            decompressed = read_zip_member(img_path, memmap)
+            if decompressed is not None:
+                self.dir_cos = decompressed.direction
+                self.spacing = decompressed.spacing
+                self.vol = decompressed.array
+                return
+            tmp_extracted = img_path.extract_to_temp()
+            img_path = tmp_extracted.name
+
+        # Compressed nrrds and niftis are decompressed straight into the output array
+        decompressed = decompress_image(img_path, memmap)
+        if decompressed is not None:
+            self.dir_cos = decompressed.direction
+            self.spacing = decompressed.spacing
+            self.vol = decompressed.array
+            return
+
         if img_path.endswith('.gz'):
-            # Get the image file extension
-            ex = splitext(splitext(img_path)[0])[1]
-            tmp = tempfile.NamedTemporaryFile(suffix=ex)
-            with gzip.open(img_path, 'rb') as infile:
-                data = infile.read()
-            with open(tmp.name, 'wb') as outfile:
-                outfile.write(data)
+            tmp = _gunzip_to_temp(img_path)
             img_path = tmp.name
         # if img_path.endswith('nrrd'):
         #     self.vol = nrrd.read(img_path)[0]
@@ -184,6 +215,7 @@ class ImageReader(object):
         self.img = sitk.ReadImage(img_path)
         # self.dir_cos = np.asarray(self.img.GetDirection()).reshape((3,3))
         self.dir_cos = self.img.GetDirection()
+        self.spacing = self.img.GetSpacing()
 
         vol = sitk.GetArrayFromImage(self.img)
 
@@ -232,14 +264,12 @@ class ImageReader(object):
 def read_image(img_path, convert_to_ras=False):
     # todo: This needs removing
 
+    decompressed = decompress_image(img_path)
+    if decompressed is not None:
+        return decompressed.array
+
     if img_path.endswith('.gz'):
-        # Get the image file extension
-        ex = splitext(splitext(img_path)[0])[1]
-        tmp = tempfile.NamedTemporaryFile(suffix=ex)
-        with gzip.open(img_path, 'rb') as infile:
-            data = infile.read()
-        with open(tmp.name, 'wb') as outfile:
-            outfile.write(data)
+        tmp = _gunzip_to_temp(img_path)
         img_path = tmp.name
 
     img = sitk.ReadImage(img_path)
@@ -1,21 +1,22 @@
 from PyQt5.QtGui import QPainter
-import pyqtgraph as pg
-import numpy as np
-from .layer import Layer
+from .layer import Layer, SliceImageItem
 
 
 class HeatmapLayer(Layer):
     def __init__(self, *args):
         super(HeatmapLayer, self).__init__(*args)
-        self.neg_image_item = pg.ImageItem(autoLevels=False)
-        self.neg_image_item.setCompositionMode(QPainter.CompositionMode_SourceOver)
-        self.neg_image_item.setLookupTable(self.lt._hot_red_blue()[1])
-        self.image_items.append(self.neg_image_item)
+        # Negative and positive values are coloured by a single diverging LUT, so each slice is displayed as is
+        self.image_item = SliceImageItem(autoLevels=False)
+        self.image_item.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        self.image_items.append(self.image_item)
 
-        self.pos_image_item = pg.ImageItem(autoLevels=False)
-        self.pos_image_item.setCompositionMode(QPainter.CompositionMode_SourceOver)
-        self.pos_image_item.setLookupTable(self.lt._hot_red_blue()[0])
-        self.image_items.append(self.pos_image_item)
+    def set_lut(self):
+        """
+        Set the combined negative/positive LUT and levels from the heatmap volume
+        """
+        lut, levels = self.vol.get_diverging_lut()
+        self.image_item.setLookupTable(lut, update=False)
+        self.image_item.setLevels(levels, update=False)
 
     def update(self, auto_levels=False):
         """
@@ -24,10 +25,7 @@ class HeatmapLayer(Layer):
         :return:
         """
         if self.vol and self.vol != 'None':
-            self.neg_image_item.setLookupTable(self.vol.negative_lut)
-            self.pos_image_item.setLookupTable(self.vol.positive_lut)
-            self.neg_image_item.setLevels(self.vol.neg_levels, update=False)
-            self.pos_image_item.setLevels(self.vol.pos_levels, update=False)
+            self.set_lut()
             self.reload()
 
     def reload(self):
@@ -49,8 +47,7 @@ class HeatmapLayer(Layer):
 
         self.volume_label_signal.emit(volname)
         self.vol = self.model.getvol(volname)
-        self.neg_image_item.setLookupTable(self.vol.negative_lut)
-        self.pos_image_item.setLookupTable(self.vol.positive_lut)
+        self.set_lut()
         self.set_slice(self.parent.current_slice_idx)
 
     def set_slice(self, index: int):
@@ -68,14 +65,18 @@ class HeatmapLayer(Layer):
             flip_x, flip_y, flip_z = self.parent.get_flips()
 
             try:
-                slices = self.vol.get_data(self.parent.orientation, index - 1,
-                                           flip_x, flip_z, flip_y)
+                lod = self.choose_lod()
+                region = self.choose_region(lod)
+                slice_ = self.vol.get_data(self.parent.orientation, index - 1,
+                                           flip_x, flip_z, flip_y, lod=lod, region=region)
+                self.prefetch(index - 1, (flip_x, flip_z, flip_y), lod, region)
             except IndexError as e:
                 print(e)
                 return
 
-            for i, ii in enumerate(self.image_items):
-                ii.setImage(slices[i], autoLevels=False, opacity=opacity)
+            self.set_placement(lod, region)
+            self.image_item.setImage(slice_, autoLevels=False, opacity=opacity)
+            self.interpolate(index - 1, (flip_x, flip_z, flip_y), lod, region)
 
     def set_t_threshold(self, t):
         if self.vol:
@@ -84,13 +85,12 @@ class HeatmapLayer(Layer):
 
     def clear(self):
         """
-        Override as we have multiple imageitems for
+        Override to drop the volume as well as clearing the image
         :return:
         """
         self.vol = None
         # #clear the image item with an empty array
         #
-        self.image_items[0].setImage(opacity=0.0)
-        self.image_items[1].setImage(opacity=0.0)
+        self.image_item.setImage(opacity=0.0)
         # self.item = None
 
@@ -1,11 +1,45 @@
-from PyQt5 import QtCore, Qt
-from vpv.utils.lookup_tables import Lut
+from PyQt5 import QtCore, QtGui, Qt
+import pyqtgraph as pg
+from vpv.utils.lookup_tables import Lut, label_filter_lut
 import numpy as np
+import math
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+REGION_MARGIN = 0.25  # Fraction of the visible width and height fetched beyond each edge of the view when zoomed in
+REGION_GRID = 32  # Region edges are snapped to multiples of this many pixels
+REGION_MAX_FRACTION = 0.5  # Fetch the whole slice if the region would be larger than this fraction of it
+MAX_INTERPOLATED_SIZE = 4096  # The largest interpolated image made, in screen pixels along each side
+
+# Interpolation is done off the GUI thread. One worker so that the most recent request is never queued behind many
+_interpolation_pool = ThreadPoolExecutor(max_workers=1)
+
+
+class SliceImageItem(pg.ImageItem):
+    """
+    An ImageItem that may be showing only a region of a slice, or a scaled version of it. Auto ranging the view uses
+    the whole slice
+    """
+    def __init__(self, *args, **kwargs):
+        super(SliceImageItem, self).__init__(*args, **kwargs)
+        self.extent = None  # (width, height) of the whole slice in view coordinates
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        if self.extent is not None:
+            # Map the slice's extent into the coordinates of the image the item is currently showing
+            transform = self.transform()
+            scale, offset = (transform.m11(), transform.dx()) if ax == 0 else (transform.m22(), transform.dy())
+            return -offset / scale, (self.extent[ax] - offset) / scale
+        if self.image is None:
+            return None
+        return 0, self.image.shape[ax]
 
 
 class Layer(Qt.QObject):
 
     volume_label_signal = QtCore.pyqtSignal(str)
+    # Emitted from the interpolation worker with (request number, interpolated image, region it covers)
+    interpolated_signal = QtCore.pyqtSignal(int, object, tuple)
 
     def __init__(self, parent, layer_type, model):
         """
@@ -34,6 +68,17 @@ class Layer(Qt.QObject):
         self.isvisible = True
         self.opacity = 1.0
         self._show_labels = [0]  # show all labels to start with (if label layer)
+        # False if the label filter could not be put in the LUT and slices have to be masked instead
+        self._labels_in_lut = True
+        # Label maps are not downsampled when zoomed out or interpolated when zoomed in, which would make up labels
+        self.label_map = False
+        self.lod = 0  # The level of the volume's resolution pyramid currently displayed
+        # When zoomed in only this region of the slice is fetched and displayed (see Volume.get_data). None for all
+        self.region = None
+        # Incremented whenever a new slice is shown so that interpolated images of older slices are dropped
+        self._interpolation_request = 0
+        self._showing_interpolated = False
+        self.interpolated_signal.connect(self.show_interpolated)
 
     @property
     def show_labels(self):
@@ -41,7 +86,30 @@ class Layer(Qt.QObject):
 
     @show_labels.setter
     def show_labels(self, labels):
+        """
+        Hidden labels are made transparent in the LUT, so the slice does not need reloading
+        """
         self._show_labels = labels
+        if self.vol and self.vol != 'None':
+            self.set_lut_and_levels()
+            if not self._labels_in_lut:
+                self.reload()
+
+    def set_lut_and_levels(self):
+        """
+        Set the image item's LUT and levels. If only some labels are being shown, the others are made transparent
+        in the LUT
+        """
+        lut, levels = self.lut[0], self.vol.levels
+        self._labels_in_lut = True
+        if self._show_labels != [0]:
+            filtered = label_filter_lut(lut, levels, self.vol.intensity_range(), self._show_labels)
+            if filtered is None:
+                self._labels_in_lut = False  # Too many values for one LUT entry each. Mask the slices instead
+            else:
+                lut, levels = filtered
+        self.image_item.setLevels(levels, update=False)
+        self.image_item.setLookupTable(lut)
 
     def clear(self):
         """
@@ -65,8 +133,7 @@ class Layer(Qt.QObject):
         :return:
         """
         if self.vol and self.vol != 'None':
-            self.image_item.setLevels(self.vol.levels, update=False)
-            self.image_item.setLookupTable(self.lut[0])
+            self.set_lut_and_levels()
             self.reload()
 
     def reload(self):
@@ -86,12 +153,12 @@ class Layer(Qt.QObject):
             self.vol = None
             return
 
-        self.volume_label_signal.emit(volname)
-
-        self.vol = self.model.getvol(volname)
-        if not self.vol:
+        vol = self.model.getvol(volname)
+        if not vol or isinstance(vol, str):  # Not loaded (yet). Keep showing the current volume
             print(f'cannot find vol: {volname}')
             return
+        self.vol = vol
+        self.volume_label_signal.emit(volname)
 
         # self.set_series_slider()
 
@@ -121,18 +188,200 @@ class Layer(Qt.QObject):
         if self.vol:
 
             try:
+                lod = self.choose_lod()
+                region = self.choose_region(lod)
                 slice_ = self.vol.get_data(self.parent.orientation, index,
-                                                       flip_x, flip_z, flip_y)
+                                                       flip_x, flip_z, flip_y, lod=lod, region=region)
+                self.prefetch(index, (flip_x, flip_z, flip_y), lod, region)
 
-                if self._show_labels != [0]:
+                if self._show_labels != [0] and not self._labels_in_lut:
                     slice_ = np.copy(slice_)
                     slice_[~np.isin(slice_, self._show_labels)] = 0
 
+                self.set_placement(lod, region)
                 self.image_item.setImage(slice_, autoLevels=False, opacity=opacity)
+                self.interpolate(index, (flip_x, flip_z, flip_y), lod, region)
 
             except IndexError as e:
                 print(e)
 
+    def prefetch(self, index: int, flips: tuple, lod: int = 0, region: tuple = None):
+        """
+        Let the model's prefetcher load the slices ahead of the direction this layer is being scrolled in
+
+        Parameters
+        ----------
+        index
+            the slice index passed to Volume.get_data
+        flips
+            (flip_x, flip_z, flip_y)
+        lod
+            the level of the volume's resolution pyramid being displayed
+        region
+            the region of the slice being displayed
+        """
+        self.model.slice_prefetcher.slice_changed(self, self.vol, self.parent.orientation, index, flips, lod, region)
+
+    def choose_lod(self) -> int:
+        """
+        Choose the level of the volume's resolution pyramid to display. Level n is used when each screen pixel covers
+        at least 2**n voxels, if it has been built yet
+
+        Returns
+        -------
+        int
+        """
+        if self.label_map:
+            return 0
+        voxels_per_pixel = min(self.parent.viewbox.viewPixelSize())
+        if not np.isfinite(voxels_per_pixel) or voxels_per_pixel < 2:
+            return 0
+        return min(int(math.log2(voxels_per_pixel)), self.vol.lod_levels() - 1)
+
+    def visible_region(self, lod: int) -> tuple:
+        """
+        The part of the slice that is in view
+
+        Returns
+        -------
+        tuple
+            (x0, x1, y0, y1) in the coordinates of the slice at the given level of the resolution pyramid. Not clipped
+            to the slice
+        """
+        (x0, x1), (y0, y1) = self.parent.viewbox.viewRange()
+        scale = 2 ** lod
+        return x0 / scale, x1 / scale, y0 / scale, y1 / scale
+
+    def choose_region(self, lod: int):
+        """
+        Choose the region of the slice to fetch. This is the visible region plus a margin so that small pans don't
+        need a reload, snapped to a grid so that the same region is chosen for nearby views
+
+        Returns
+        -------
+        tuple (x0, x1, y0, y1) or None if most of the slice is visible and the whole slice should be fetched
+        """
+        width, height = self.vol.plane_shape(self.parent.orientation, lod)
+        x0, x1, y0, y1 = self.visible_region(lod)
+        if not all(np.isfinite([x0, x1, y0, y1])):
+            return None
+        mx, my = (x1 - x0) * REGION_MARGIN, (y1 - y0) * REGION_MARGIN
+
+        def snap(lo, hi, size):
+            lo = int(math.floor(lo / REGION_GRID)) * REGION_GRID
+            hi = int(math.ceil(hi / REGION_GRID)) * REGION_GRID
+            lo = min(max(lo, 0), size - 1)
+            return lo, min(max(hi, lo + 1), size)
+
+        x0, x1 = snap(x0 - mx, x1 + mx, width)
+        y0, y1 = snap(y0 - my, y1 + my, height)
+        if (x1 - x0) * (y1 - y0) > REGION_MAX_FRACTION * width * height:
+            return None
+        return x0, x1, y0, y1
+
+    def set_placement(self, lod: int, region: tuple):
+        """
+        Scale and position the image item so that a downsampled or cropped slice covers the same area of the view as
+        the full resolution slice would
+        """
+        self.lod, self.region = lod, region
+        self._showing_interpolated = False
+        scale = 2 ** lod
+        x0, y0 = (region[0], region[2]) if region else (0, 0)
+        self._place(x0 * scale, y0 * scale, scale, scale)
+
+    def _place(self, x, y, scale_x, scale_y):
+        """
+        Put the origin of the image items at x, y in the view, with each image pixel covering scale_x by scale_y voxels
+        """
+        transform = QtGui.QTransform()
+        transform.translate(x, y)
+        transform.scale(scale_x, scale_y)
+        extent = self.vol.plane_shape(self.parent.orientation)
+        for image_item in self.image_items:
+            image_item.extent = extent
+            image_item.setTransform(transform)
+
+    def interpolate(self, index: int, flips: tuple, lod: int, region: tuple):
+        """
+        If interpolation is on and the view is zoomed in, smoothly upsample the visible part of the slice on a worker
+        thread. The nearest neighbour slice is shown until it's ready (see show_interpolated)
+
+        Parameters
+        ----------
+        index, flips, lod, region
+            as passed to Volume.get_data for the slice being shown
+        """
+        self._interpolation_request += 1
+        if not getattr(self.vol, 'interpolate', False) or self.label_map or lod != 0:
+            return
+        voxels_per_pixel = min(self.parent.viewbox.viewPixelSize())
+        if not np.isfinite(voxels_per_pixel) or voxels_per_pixel >= 1:
+            return  # Not zoomed in. Each voxel is already a pixel or smaller
+
+        # The visible part of the slice
+        width, height = self.vol.plane_shape(self.parent.orientation)
+        bounds = region or (0, width, 0, height)
+        vx0, vx1, vy0, vy1 = self.visible_region(0)
+        x0, x1 = max(int(math.floor(vx0)), bounds[0]), min(int(math.ceil(vx1)), bounds[1])
+        y0, y1 = max(int(math.floor(vy0)), bounds[2]), min(int(math.ceil(vy1)), bounds[3])
+        if x1 <= x0 or y1 <= y0:
+            return
+        visible = (x0, x1, y0, y1)
+        out_shape = tuple(min(MAX_INTERPOLATED_SIZE, int(math.ceil(size / voxels_per_pixel)))
+                          for size in (x1 - x0, y1 - y0))
+
+        request = self._interpolation_request
+        vol, orientation = self.vol, self.parent.orientation
+
+        def work():
+            if request != self._interpolation_request:
+                return  # A newer slice has been shown since
+            try:
+                smooth = vol.get_interpolated(orientation, index, *flips, visible, out_shape)
+            except Exception as e:  # Only a display nicety. Keep showing the nearest neighbour slice
+                logging.info('Slice interpolation failed\n{}'.format(e))
+                return
+            self.interpolated_signal.emit(request, smooth, visible)
+
+        _interpolation_pool.submit(work)
+
+    def show_interpolated(self, request: int, smooth: np.ndarray, region: tuple):
+        """
+        Replace the nearest neighbour slice with the interpolated image of the visible region, if it's still current
+        """
+        if request != self._interpolation_request or not self.vol:
+            return
+        x0, x1, y0, y1 = region
+        self.image_item.setImage(smooth, autoLevels=False)
+        self._place(x0, y0, (x1 - x0) / smooth.shape[0], (y1 - y0) / smooth.shape[1])
+        self._showing_interpolated = True
+
+    def view_range_changed(self):
+        """
+        Reload the slice if zooming means a different level of the resolution pyramid should be displayed, or if
+        panning or zooming has moved the view outside of the region that was fetched
+        """
+        if not self.vol or self.vol == 'None':
+            return
+        lod = self.choose_lod()
+        region = self.choose_region(lod)
+        if self._showing_interpolated:
+            # The interpolated image only covers what was in view, and at the old zoom
+            self.reload()
+        elif lod != self.lod or (region is None) != (self.region is None):
+            self.reload()
+        elif region is not None:
+            x0, x1, y0, y1 = self.region
+            vx0, vx1, vy0, vy1 = self.visible_region(lod)
+            width, height = self.vol.plane_shape(self.parent.orientation, lod)
+            outside = (vx0 < x0 and x0 > 0) or (vx1 > x1 and x1 < width) or \
+                      (vy0 < y0 and y0 > 0) or (vy1 > y1 and y1 < height)
+            # Zoomed in a lot since the region was fetched
+            too_big = (region[1] - region[0]) * (region[3] - region[2]) * 4 < (x1 - x0) * (y1 - y0)
+            if outside or too_big:
+                self.reload()
+
     def set_series_slider(self):
         if not self.vol or self. vol == 'None':
             return
@@ -0,0 +1,115 @@
+# Copyright 2016 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Neil Horner <n.horner@har.mrc.ac.uk>
+
+"""
+Coalesces slice changes of linked views into one update per display frame.
+
+Synchronised slicing (moving the mouse with shift held) asks every view to change slice on each mouse move event, which
+is far more often than the screen is redrawn. Requests are held here and only the latest one for each view is applied
+when the frame timer fires, so the views keep up with the cursor instead of working through a backlog of stale slices.
+"""
+
+from collections import OrderedDict
+from PyQt5 import QtCore
+
+FRAME_MS = 16  # About 60 frames per second
+
+
+class RenderScheduler(QtCore.QObject):
+    """
+    Attributes
+    ----------
+    focused: SliceWidget
+        the view the user is interacting with. Updated first in each frame
+    """
+    def __init__(self, frame_ms: int = FRAME_MS):
+        super(RenderScheduler, self).__init__()
+        self.focused = None
+        self._pending = OrderedDict()  # SliceWidget -> (slice index, crosshair xy)
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(frame_ms)
+        self._timer.timeout.connect(self.flush)
+
+    def request_slice(self, view, index: int, crosshair_xy: tuple = None):
+        """
+        Ask for a view to show a slice at the next frame. Replaces any earlier request for the view
+
+        Parameters
+        ----------
+        view: SliceWidget
+        index
+            the slice to show
+        crosshair_xy
+            where to put the view's cross hair
+        """
+        self._pending[view] = (index, crosshair_xy)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        """
+        Apply the latest request for each view, the focused view first
+        """
+        self._timer.stop()
+        pending, self._pending = self._pending, OrderedDict()
+        if self.focused in pending:
+            pending.move_to_end(self.focused, last=False)
+        for view, (index, crosshair_xy) in pending.items():
+            try:
+                if index == view.current_slice_idx and crosshair_xy:
+                    # Still on the same slice. Only the cross hair needs moving
+                    view.set_crosshair(*crosshair_xy)
+                else:
+                    view.set_slice(index, crosshair_xy=crosshair_xy)
+            except IndexError:
+                pass
+
+    def cancel(self, view):
+        """
+        Drop any pending request for a view, eg. when it is being hidden or its volumes changed
+        """
+        self._pending.pop(view, None)
+
+
+class FrameThrottle(QtCore.QObject):
+    """
+    Calls a function at most once per frame, with the arguments of the latest call. Used for work done on every mouse
+    move, such as reading out the voxel values under the cursor
+    """
+    def __init__(self, func, frame_ms: int = FRAME_MS):
+        super(FrameThrottle, self).__init__()
+        self._func = func
+        self._args = None
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(frame_ms)
+        self._timer.timeout.connect(self.flush)
+
+    def __call__(self, *args):
+        self._args = args
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        """
+        Call the function now with the latest arguments, if there are any waiting
+        """
+        self._timer.stop()
+        args, self._args = self._args, None
+        if args is not None:
+            self._func(*args)
@@ -32,6 +32,7 @@ import os
 from collections import OrderedDict
 
 from vpv.common import Orientation, Layers
+from .layer import Layer
 from .heatmaplayer import HeatmapLayer
 from .vectorlayer import VectorLayer
 from .volumelayer import VolumeLayer
@@ -486,6 +487,8 @@ class SliceWidget(QWidget, Ui_SliceWidget):
         self.ui.seriesSlider.hide()
 
         self.layers = self.register_layers()
+        # Zooming in or out can change which level of the volumes' resolution pyramids is displayed
+        self.viewbox.sigRangeChanged.connect(self.view_range_changed)
 
         self.orientation_indicator = OrientationIndicator(self)
 
@@ -494,10 +497,10 @@ class SliceWidget(QWidget, Ui_SliceWidget):
     def filter_label(self, label: Iterable[int]):
         """
         On volume2 layers only show these labels. If 0 show all.
+        The labels are filtered by the layer's LUT, so the slice is not reloaded
         """
         l = self.layers[Layers.vol2]
         l.show_labels = label
-        self.update_view()
 
     def set_orientation_labels_visiblility(self, visible: bool):
         self.orientation_indicator.set_visibility(visible)
@@ -598,6 +601,11 @@ class SliceWidget(QWidget, Ui_SliceWidget):
         self.scale_changed_signal.emit(self.orientation, self.id,  self.viewbox.viewRange())
         QtCore.QTimer.singleShot(500, lambda: self.scalebar.updateBar())
 
+    def view_range_changed(self):
+        for layer in self.all_layers():
+            if isinstance(layer, Layer):
+                layer.view_range_changed()
+
     def set_zoom(self, range_x=None, range_y=None):
         if range_x:
             self.viewbox.setXRange(range_x[0], range_x[1], padding=False)
@@ -622,8 +630,9 @@ class SliceWidget(QWidget, Ui_SliceWidget):
         self.setFocus()
         pos = event._scenePos
 
-        x = self.layers[Layers.vol1].image_item.mapFromScene(pos).x()
-        y = self.layers[Layers.vol1].image_item.mapFromScene(pos).y()
+        # View coordinates are voxel coordinates, whatever level of the resolution pyramid the image item shows
+        x = self.viewbox.mapSceneToView(pos).x()
+        y = self.viewbox.mapSceneToView(pos).y()
         if x < 0 or y < 0:
             return
         self.mouse_pressed_annotation_signal.emit(self.current_slice_idx, x, y, self)
@@ -638,8 +647,8 @@ class SliceWidget(QWidget, Ui_SliceWidget):
         """
 
         self.setFocus()
-        x = int(self.layers[Layers.vol1].image_item.mapFromScene(pos).x())
-        y = int(self.layers[Layers.vol1].image_item.mapFromScene(pos).y())
+        x = int(self.viewbox.mapSceneToView(pos).x())
+        y = int(self.viewbox.mapSceneToView(pos).y())
 
         self.mouse_moved_signal.emit(x, y, self.current_slice_idx, self)
 
@@ -809,7 +818,10 @@ class SliceWidget(QWidget, Ui_SliceWidget):
         crosshair_xy: tuple
             xy coordinates of the cross hair
         """
+        # Don't let the slider's valueChanged set the slice as well
+        self.ui.sliderSlice.blockSignals(True)
         self.ui.sliderSlice.setValue(index)
+        self.ui.sliderSlice.blockSignals(False)
         self._set_slice(index, crosshair_xy)
 
     def _set_slice(self, index, crosshair_xy=None):
@@ -842,10 +854,13 @@ class SliceWidget(QWidget, Ui_SliceWidget):
         self.current_slice_idx = index
 
         if crosshair_xy:
-            self.vLine.setPos(crosshair_xy[0])
-            self.hLine.setPos(crosshair_xy[1])
+            self.set_crosshair(*crosshair_xy)
         self.annotation_marker.update(self.current_slice_idx)
 
+    def set_crosshair(self, x, y):
+        self.vLine.setPos(x)
+        self.hLine.setPos(y)
+
     def move_slice(self, num_slices):
         """
         Shift slices relative to current view.
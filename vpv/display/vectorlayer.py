@@ -3,6 +3,11 @@ import pyqtgraph as pg
 from vpv.common import Orientation
 import numpy as np
 import math
+from collections import OrderedDict
+
+ARROW_HEAD_LENGTH = 1
+ARROW_HEAD_ANGLE = math.radians(20)
+PATH_CACHE_SIZE = 64  # The number of slices of arrows kept
 
 
 class VectorLayer(object):
@@ -24,9 +29,12 @@ class VectorLayer(object):
         self.plt.hideAxis('bottom')
         self.plt.hideAxis('top')
         self.vol = None
-        self.arrow_color = "22E300"
+        self.arrow_color = "#22E300"
         self.vec_mag_min = 0.0
         self.vec_mag_max = 5.0
+        # (slice index, subsampling, scale, magnitude cutoff) -> QPainterPath of the arrows for the current volume
+        # and orientation
+        self._paths = OrderedDict()
 
     def set_magnitude_cutoff(self, min_, max_):
         self.vec_mag_min = min_
@@ -47,12 +55,14 @@ class VectorLayer(object):
             self.vol = None
             if self.item:
                 self.viewbox.removeItem(self.item)
+                self.item = None
             return
         self.volume_label_signal.emit(volname)
 
         self.parent.overlay.set_vector_label(volname)
 
         self.vol = self.model.getvol(volname)
+        self._paths.clear()
         orientation = self.parent.orientation
         self.slice_change_function = self.register_slice_change_function()
         self.name = self.vol.name
@@ -78,6 +88,7 @@ class VectorLayer(object):
         """
         set which 2 axes to take from the 3D vector.
         """
+        self._paths.clear()
         if self.parent.orientation == Orientation.axial:
             self.vector_axes = (1, 0)
         elif self.parent.orientation == Orientation.coronal:
@@ -103,110 +114,106 @@ class VectorLayer(object):
         c = self.vol.subsampling
         scale = self.vol.scale
 
-        if self.item:
-            self.viewbox.removeItem(self.item)
-
-        # Get the slice and 2D vectors for this orientation
-        slice_ = self.slice_change_function(index)
-
-        # Get the 2d vector for this plane
-        slice_2d_vec = slice_.take(self.vector_axes, axis=2)
-
-        x_points = []
-        y_points = []
-        connect = []
-
-        for y in range(0, slice_.shape[0] - c, c):
-            for x in range(0, slice_.shape[1] -c, c):
-
-                try:
-
-                    subsmapled_box = slice_2d_vec[y: y+c, x: x+c, :]
-                except IndexError:
-                    print("fell off")
-                else:
-                    x1 = x + (c/2)
-                    y1 = y + (c/2)
-
-                    x_magnitude, y_magnitude = np.mean(subsmapled_box, axis=(0, 1))
-                    magnitude = np.linalg.norm((x_magnitude, y_magnitude))
-                    if magnitude < self.vec_mag_min:
-                        continue
-                    if self.orientation == Orientation.axial:
-                        x_magnitude, y_magnitude = self.rotate_vector((x_magnitude, y_magnitude), -90.0)
-
-                    x_points.append(x1)
-                    y_points.append(y1)
-                    connect.append(1)
-
-                    # Draw a line to end of arrow
-                    x2 = x1 + (x_magnitude * scale)
-                    y2 = y1 + (y_magnitude * scale)
-
-                    x_points.append(x2)
-                    y_points.append(y2)
-                    connect.append(1)
-
-                    arrow_Xs, arrow_ys = self.draw_arrow_head(x2, x1, y2, y1)
+        key = (index, c, scale, self.vec_mag_min)
+        path = self._paths.get(key)
+        if path is None:
+            means, magnitudes = self.vol.block_means(self.parent.orientation, int(index), c, self.vector_axes)
+            path = self._arrows_path(means, magnitudes, c, scale)
+            self._paths[key] = path
+            if len(self._paths) > PATH_CACHE_SIZE:
+                self._paths.popitem(last=False)
+        else:
+            self._paths.move_to_end(key)
 
-                    x_points.append(arrow_Xs[0])
-                    y_points.append(arrow_ys[0])
-                    connect.append(0)
+        if self.item is None:
+            self.item = QGraphicsPathItem(path)
+            self.viewbox.addItem(self.item)
+        else:
+            self.item.setPath(path)
+        self.item.setPen(pg.mkPen({'color': self.arrow_color, 'width': 1}))
 
-                    x_points.append(arrow_Xs[1])
-                    y_points.append(arrow_ys[1])
-                    connect.append(1)
+    def _arrows_path(self, means, magnitudes, c, scale):
+        """
+        Make the path of the arrows for a slice of vectors. Each arrow shows the mean vector of a c x c block
+
+        Parameters
+        ----------
+        means: np.ndarray
+            (y, x, 2) mean 2D vectors of the blocks of the slice (see VectorVolume.block_means)
+        magnitudes: np.ndarray
+            (y, x) magnitudes of the mean vectors
+        c: int
+            subsampling. The size of the blocks averaged for each arrow
+        scale: float
+            arrow length per unit of vector magnitude
+
+        Returns
+        -------
+        QPainterPath
+        """
+        ny, nx = magnitudes.shape
+        y, x = np.mgrid[0: ny * c: c, 0: nx * c: c]
+
+        keep = magnitudes >= self.vec_mag_min
+        x_magnitude = means[..., 0][keep].astype(np.float64)
+        y_magnitude = means[..., 1][keep].astype(np.float64)
+        if self.orientation == Orientation.axial:
+            x_magnitude, y_magnitude = self.rotate_vector((x_magnitude, y_magnitude), -90.0)
+
+        x1 = x[keep] + (c / 2)
+        y1 = y[keep] + (c / 2)
+        # The end of the arrow
+        x2 = x1 + (x_magnitude * scale)
+        y2 = y1 + (y_magnitude * scale)
+        arrow_xs, arrow_ys = self.draw_arrow_head(x2, x1, y2, y1)
+
+        # Each arrow is drawn as tail -> tip, then one side of the head -> the other side -> back to the tip
+        x_points = np.stack((x1, x2, arrow_xs[0], arrow_xs[1], x2), axis=1).ravel()
+        y_points = np.stack((y1, y2, arrow_ys[0], arrow_ys[1], y2), axis=1).ravel()
+        connect = np.tile(np.array([1, 1, 0, 1, 0], dtype=np.int32), len(x1))
+        return pg.arrayToQPath(x_points, y_points, connect)
 
-                    # Back to arrow tip
-                    x_points.append(x2)
-                    y_points.append(y2)
-                    connect.append(0)
+    def rotate_vector(self, vector, theta):
+        """
+        Rotate vectors by theta degrees
 
-        path = pg.arrayToQPath(np.array(x_points), np.array(y_points), np.array(connect))
-        self.item = QGraphicsPathItem(path)
-        self.item.setPen(pg.mkPen({'color': self.arrow_color, 'width': 1}))
-        self.viewbox.addItem(self.item)
+        Parameters
+        ----------
+        vector: tuple
+            (x, y). Each can be a number or an array
 
-    def rotate_vector(self, vector, theta):
-        x_temp = np.copy(vector[0])
+        Returns
+        -------
+        tuple: (x, y)
+        """
         theta = math.radians(theta)
         x = vector[0] * math.cos(theta) - vector[1] * math.sin(theta)
-        y = x_temp * math.sin(theta) + vector[1] * math.cos(theta)
+        y = vector[0] * math.sin(theta) + vector[1] * math.cos(theta)
         return x, y
 
     def draw_arrow_head(self, tipX, tailX, tipY, tailY):
         """
-        This is the function that needs speeding up
-        :param tipX:
-        :param tailX:
-        :param tipY:
-        :param tailY:
-        :return:
-        """
-        arrowLength = 1
-        dx = tipX - tailX
-        dy = tipY - tailY
+        Get the ends of the two lines of arrow heads
 
-        theta = math.atan2(dy, dx)
+        Parameters
+        ----------
+        tipX, tailX, tipY, tailY: np.ndarray
+            the ends of the arrows
 
-        rad = math.radians(20)
-        x = tipX - arrowLength * math.cos(theta + rad)
-        y = tipY - arrowLength * math.sin(theta + rad)
-
-
-        phi2 = math.radians(-20)
-        x2 = tipX - arrowLength * math.cos(theta + phi2)
-        y2 = tipY - arrowLength * math.sin(theta + phi2)
+        Returns
+        -------
+        tuple
+            ([x of one side, x of the other side], [y of one side, y of the other side])
+        """
+        theta = np.arctan2(tipY - tailY, tipX - tailX)
 
-        arrowYs = []
-        arrowYs.append(y)
-        arrowYs.append(y2)
+        x = tipX - ARROW_HEAD_LENGTH * np.cos(theta + ARROW_HEAD_ANGLE)
+        y = tipY - ARROW_HEAD_LENGTH * np.sin(theta + ARROW_HEAD_ANGLE)
 
-        arrowXs = []
-        arrowXs.append(x)
-        arrowXs.append(x2)
+        x2 = tipX - ARROW_HEAD_LENGTH * np.cos(theta - ARROW_HEAD_ANGLE)
+        y2 = tipY - ARROW_HEAD_LENGTH * np.sin(theta - ARROW_HEAD_ANGLE)
 
-        return arrowXs, arrowYs
+        return [x, x2], [y, y2]
 
     def set_subsampling(self, value):
         self.vol.subsampling = int(value)
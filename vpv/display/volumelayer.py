@@ -1,19 +1,19 @@
 from PyQt5.QtGui import QPainter
-import pyqtgraph as pg
-from .layer import Layer
+from .layer import Layer, SliceImageItem
 
 
 class VolumeLayer(Layer):
 
     def __init__(self, *args):
         super(VolumeLayer, self).__init__(*args)
-        self.image_item = pg.ImageItem(autoLevels=False)
+        self.image_item = SliceImageItem(autoLevels=False)
         self.image_item.setCompositionMode(QPainter.CompositionMode_Plus)
         self.image_items.append(self.image_item)
         self.lut = self.lt.get_lut('grey')
 
     def set_lut(self, lutname):
         self.lut = self.lt.get_lut(lutname)
+        self.label_map = lutname.endswith('labels')
         if lutname == 'anatomy_labels':
             self.set_blend_mode_over()
         else:
@@ -11,6 +11,7 @@ Copyright (c) 2011-2017 Maarten Everts and others. See LICENSE and AUTHORS.
 
 import zlib
 import bz2
+import gzip
 import os
 from datetime import datetime
 
@@ -209,12 +210,32 @@ def _determine_dtype(fields):
     return np.dtype(np_typestring)
 
 
-def read_data(fields, filehandle, filename=None):
+def _read_stream_into(stream, data):
+    """Fill the preallocated array `data` from a binary stream, one chunk at a time.
+
+    Decompressing file objects (gzip.GzipFile, bz2.BZ2File) only hold one chunk
+    of output at a time, so peak memory is the size of `data` rather than a
+    multiple of it. Returns the number of bytes read.
+    """
+    view = memoryview(data.reshape(-1).view(np.uint8))
+    pos = 0
+    while pos < len(view):
+        n = stream.readinto(view[pos: pos + _READ_CHUNKSIZE])
+        if not n:
+            break
+        pos += n
+    return pos
+
+
+def read_data(fields, filehandle, filename=None, out=None):
     """Read the NRRD data from a file object into a numpy structure.
 
     File handle is is assumed to point to the first byte of the data. That is,
     in case of an attached header, assumed to point to the first byte after the
     '\n\n' line.
+
+    If `out` is given it must be a contiguous array (or memmap) with the same
+    number of elements as the NRRD data. The data is read directly into it.
     """
     data = np.zeros(0)
     # Determine the data type from the fields
@@ -235,6 +256,11 @@ def read_data(fields, filehandle, filename=None):
         datafilehandle = open(datafilename, 'rb')
 
     num_pixels = np.array(fields['sizes']).prod()
+    if out is None:
+        out = np.empty(num_pixels, dtype)
+    elif out.size != num_pixels or out.dtype != dtype:
+        raise NrrdError('Output array does not match the size of the nrrd data')
+
     # Seek to start of data based on lineskip/byteskip. byteskip == -1 is
     # only valid for raw encoding and overrides any lineskip
     if fields['encoding'] == 'raw' and byteskip == -1:
@@ -244,33 +270,32 @@ def read_data(fields, filehandle, filename=None):
             datafilehandle.readline()
 
     if fields['encoding'] == 'raw':
-        datafilehandle.seek(byteskip, os.SEEK_CUR)
-        data = np.fromfile(datafilehandle, dtype)
+        if byteskip > 0:
+            datafilehandle.seek(byteskip, os.SEEK_CUR)
+        stream = datafilehandle
     else:
         # Probably the data is compressed then
         if fields['encoding'] == 'gzip' or\
              fields['encoding'] == 'gz':
-            decompobj = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            stream = gzip.GzipFile(fileobj=datafilehandle, mode='rb')
         elif fields['encoding'] == 'bzip2' or\
              fields['encoding'] == 'bz2':
-            decompobj = bz2.BZ2Decompressor()
+            stream = bz2.BZ2File(datafilehandle, mode='rb')
         else:
             raise NrrdError('Unsupported encoding: "%s"' % fields['encoding'])
-
-        decompressed_data = b''
-        while True:
-            chunk = datafilehandle.read(_READ_CHUNKSIZE)
-            if not chunk:
-                break
-            decompressed_data += decompobj.decompress(chunk)
         # byteskip applies to the _decompressed_ byte stream
-        data = np.fromstring(decompressed_data[byteskip:], dtype)
+        if byteskip > 0:
+            stream.read(byteskip)
+
+    nbytes = _read_stream_into(stream, out)
+    data = out.reshape(-1)
 
-    if datafilehandle:
+    if datafilehandle is not filehandle:
         datafilehandle.close()
 
-    if num_pixels != data.size:
-        raise NrrdError('ERROR: {0}-{1}={2}'.format(num_pixels, data.size, num_pixels - data.size))
+    if nbytes != data.nbytes:
+        read_pixels = nbytes // dtype.itemsize
+        raise NrrdError('ERROR: {0}-{1}={2}'.format(num_pixels, read_pixels, num_pixels - read_pixels))
 
     # dkh : eliminated need to reverse order of dimensions. nrrd's
     # data layout is same as what numpy calls 'Fortran' order,
@@ -348,7 +373,7 @@ def read_header(nrrdfile):
         # Handle the <key>:=<value> lines first since <value> may contain a
         # ': ' which messes up the <field>: <desc> parsing
         key_value = line.split(':=', 1)
-        if len(key_value) is 2:
+        if len(key_value) == 2:
             key, value = key_value
             # TODO: escape \\ and \n ??
             # value.replace(r'\\\\', r'\\').replace(r'\n', '\n')
@@ -357,7 +382,7 @@ def read_header(nrrdfile):
 
         # Handle the "<field>: <desc>" lines.
         field_desc = line.split(': ', 1)
-        if len(field_desc) is 2:
+        if len(field_desc) == 2:
             field, desc = field_desc
             ## preceeding and suffixing white space should be ignored.
             field = field.rstrip().lstrip()
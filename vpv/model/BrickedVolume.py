@@ -0,0 +1,34 @@
+from .ImageVolume import ImageVolume
+from vpv.utils.bricked_volume import BrickedImage
+
+
+class BrickedVolume(ImageVolume):
+    """
+    A volume stored in the bricked multi-resolution format (.vpvb). Nothing is read into memory on loading; each call
+    to get_data reads only the bricks that cover the requested plane
+    """
+    def __init__(self, *args):
+        self.bricked = None
+        super(BrickedVolume, self).__init__(*args)
+
+    def _load_data(self, path, memmap=False):
+        self.bricked = BrickedImage(str(path))
+        self.space = self.bricked.direction
+        # The intensity range is stored in the header so there's no need to scan the data
+        self.min, self.max = self.bricked.min, self.bricked.max
+        return self.bricked.levels[0]
+
+    def lod_levels(self) -> int:
+        # The pyramid is built when converting to the bricked format
+        return len(self.bricked.levels)
+
+    def lod_data(self, lod: int):
+        """
+        Get a level of the resolution pyramid. Level 0 is full resolution and each subsequent level is half the size
+        in each dimension
+
+        Returns
+        -------
+        BrickedArray
+        """
+        return self.bricked.levels[lod]
@@ -1,17 +1,29 @@
 from .volume import Volume
 import numpy as np
 import os
-from collections import OrderedDict
-import SimpleITK as sitk
-from vpv.common import timing, ImageReader
+from functools import partial
+from PyQt5 import QtCore
+from vpv.common import ImageReader
 
-from vpv.utils.lookup_tables import Lut
+from vpv.utils.lookup_tables import Lut, diverging_lut
 from vpv.utils.read_minc import mincstats_to_numpy
+from vpv.utils.volume_cache import volume_cache
+from vpv.utils.component_tree import HeatmapComponentTrees
 
 
 class HeatmapVolume(Volume):
+    # The data is cast to float16 before the stats are computed
+    stats_variant = 'float16'
+    # Emitted from a background thread once the connected components can be looked up
+    components_ready_signal = QtCore.pyqtSignal()
+
     def __init__(self, *args):
-        self.connected_components = OrderedDict()
+        # Statistics of the blobs at the current thresholds, largest first. See HeatmapComponentTrees.cluster_statistics
+        self.connected_components = None
+        self._component_trees = None
+        # The (thresholds, voxel volume, atlas) that connected_components are for, and that were last requested
+        self._components_key = None
+        self._requested_components_key = None
         super(HeatmapVolume, self).__init__(*args)
         self.lt = Lut()
         self.negative_lut = None
@@ -20,30 +32,19 @@ class HeatmapVolume(Volume):
 
         self._fdr_thresholds = {}
 
-        neg_lower = float(self._arr_data.min())
-
-        # Fix problem when we have no negative values
-        if float(self._arr_data.min()) >= 0:
-            neg_upper = 0
-        else:
-            neg_upper = float(self._arr_data[self._arr_data < 0].max())
-        self.neg_levels = [neg_lower, neg_upper]
+        # All the levels come from a single pass over the data (or its stats sidecar)
+        stats = self.stats()
+        self.max = stats.max
+        self.min = stats.min
 
-        pos_upper = self._arr_data.max()
-        # Fix problem when we have no positve values
-        if self._arr_data.max() <= 0:
-            pos_lower = 0
-        else:
-            pos_lower = self._arr_data[self._arr_data > 0].min()
-        self.pos_levels = [float(pos_lower), float(pos_upper)]
+        # Fix problem when we have no negative or positive values
+        self.neg_levels = [stats.min, stats.neg_max if stats.neg_max is not None else 0]
+        self.pos_levels = [stats.pos_min if stats.pos_min is not None else 0, stats.max]
 
         self.non_zero_mins = self._get_non_zero_mins()
 
         self.set_lut(initial_lut)
 
-        self.max = self._arr_data.max()
-        self.min = self._arr_data.min()
-
     @property
     def fdr_thresholds(self):
         return self._fdr_thresholds
@@ -52,8 +53,8 @@ class HeatmapVolume(Volume):
     def fdr_thresholds(self, thresholds):
         self._fdr_thresholds = thresholds
         if thresholds is None:  # Set the lower t-statistic slider to max as there's no hits at any FDR cutoff
-            self.set_lower_positive_lut(self._arr_data.max() - 0.1)
-            self.set_upper_negative_lut(self._arr_data.min() + 0.2)  # Had to add extra as it would go nuts
+            self.set_lower_positive_lut(self.max - 0.1)
+            self.set_upper_negative_lut(self.min + 0.2)  # Had to add extra as it would go nuts
 
     def _get_non_zero_mins(self):
         """
@@ -62,65 +63,109 @@ class HeatmapVolume(Volume):
         :return:
         """
 
-        if self._arr_data.min() >= 0:
-            neg = 0
-        else:
-            neg = self._arr_data[self._arr_data < 0].max()
-        if self._arr_data.max() <= 0:
-            pos = 0
-        else:
-            pos = self._arr_data[self._arr_data > 0].min()
+        stats = self.stats()
+        neg = stats.neg_max if stats.neg_max is not None else 0
+        pos = stats.pos_min if stats.pos_min is not None else 0
         self.mins = (neg, pos)
         return self.mins
 
     def positive_min(self):
-        return self._arr_data[self._arr_data > 0].min()
+        return self.stats().pos_min
 
     def negative_min(self):
-        return self._arr_data[self._arr_data < 0].max()
+        return self.stats().neg_max
 
     def _load_data(self, path, memmap=False):
         """
-        override Volume method to cast to 16bit float to speed things up
+        override Volume method to cast to 16bit float to speed things up.
+        The cast array is stored in the volume cache
         """
-        if os.path.splitext(path)[1].lower() == '.mnc':
+        if os.path.splitext(str(path))[1].lower() == '.mnc':
 
             arr = mincstats_to_numpy(path)  # Need to fix headers for mncs
             return arr
-        else:
-            ir = ImageReader(path)
-            arr = ir.vol.astype(np.float16)
 
+        cached = volume_cache.get(path, variant='float16')
+        if cached is not None:
+            arr, meta = cached
+            self.space = meta['direction']
+            self.min, self.max = meta['min'], meta['max']
+            return arr
+
+        ir = ImageReader(path)
+        arr = ir.vol.astype(np.float16)
+        self.space = ir.dir_cos
+        stats = self.stats(arr)
+        self.min, self.max = stats.min, stats.max
+        volume_cache.put_async(path, arr, self.space, self.min, self.max, variant='float16')
         return arr
 
-    @timing
-    def find_largest_connected_components(self):
+    def find_largest_connected_components(self, voxel_volume: float = 1.0, atlas: Volume = None, build: bool = True):
         """
-        Look for the top n conencted comonets for easy finding
-        :return:
+        Look up the connected components (blobs) beyond the current t-statistic thresholds, and their statistics.
+
+        They come from component trees of the heatmap, which are built in the background the first time they are
+        needed, so the thresholds can be changed without relabelling the volume. The statistics are then also computed
+        in the background. connected_components keeps its previous value (None at first) until they are ready, then
+        components_ready_signal is emitted
+
+        Parameters
+        ----------
+        voxel_volume
+            the physical volume of a voxel
+        atlas
+            a label volume of the same shape. The most common label of each blob is reported
+        build
+            whether to start building the component trees if they have not been built. If False and there are no
+            trees, nothing is looked up
+
+        Returns
+        -------
+        bool
+            whether connected_components are for the current thresholds
+        """
+        trees = self._component_trees
+        if trees is None:
+            if not build:
+                return False
+            trees = self._component_trees = HeatmapComponentTrees(self._arr_data, self.components_ready_signal.emit)
+        if not trees.complete:
+            return False
+        if atlas is None or atlas.shape_xyz() != self.shape_xyz():
+            atlas = None
+        key = (self.neg_levels[1], self.pos_levels[0], voxel_volume, atlas)
+        if key == self._components_key:
+            return True
+        if key != self._requested_components_key:
+            self._requested_components_key = key
+            trees.cluster_statistics_async(partial(self._on_components_found, trees, key), key[0], key[1],
+                                           voxel_volume=voxel_volume,
+                                           atlas=atlas.get_voxels if atlas is not None else None)
+        return False
+
+    def _on_components_found(self, trees, key, table):
         """
-        self.connected_components = OrderedDict()
-        img = sitk.GetImageFromArray(self._arr_data.astype(np.float32)) # Create this on the fly as it would take up lots of space
-        lower_threshold = self.neg_levels[1]
-        upper_threshold = self.pos_levels[0]
-        binary_img = sitk.BinaryThreshold(img, lower_threshold, upper_threshold, 0, 1)
-        conn = sitk.RelabelComponent(sitk.ConnectedComponent(binary_img))
-        ls = sitk.LabelStatisticsImageFilter()
-        ls.Execute(img, conn)
-        number_of_labels = ls.GetNumberOfLabels()
-        # Now get the top 50  coordinates of the connected components
-        n = 50
-        if n > number_of_labels:
-            n = number_of_labels
-        for i in range(1, n):
-            bbox = ls.GetBoundingBox(i)  # x,x,y,y, z,z
-            size = ls.GetCount(i)
-            if size < 4:
-                break
-            mean = ls.GetMean(i)
-
-            bbox_xyz = [bbox[0], bbox[1], bbox[2], bbox[3], bbox[4], bbox[5]]
-            self.connected_components[size, mean] = bbox_xyz
+        Called from the background thread when the statistics of the components requested with key are ready
+        """
+        if trees is not self._component_trees:  # Freed since they were requested
+            return
+        self.connected_components = table
+        self._components_key = key
+        self.components_ready_signal.emit()
+
+    def free_connected_components(self):
+        """
+        Stop building the component trees, or free them if they are built. They are rebuilt when next needed
+        """
+        if self._component_trees is not None:
+            self._component_trees.close()
+            self._component_trees = None
+        self.connected_components = None
+        self._components_key = self._requested_components_key = None
+
+    def destroy(self):
+        self.free_connected_components()
+        super(HeatmapVolume, self).destroy()
 
     def set_lut(self, lut_name):
         self.positive_lut, self.negative_lut = self.lt.get_lut(lut_name)
@@ -133,39 +178,16 @@ class HeatmapVolume(Volume):
     def get_lut(self):
         return self.negative_lut, self.positive_lut
 
-    def get_data(self, orientation, index=1, flipx=False, flipz=False, flipy=False, xy=None):
+    def get_diverging_lut(self):
         """
-        Override the base method. return two arrays instead of one. One with negative values and the other with positives
-        The Heatmap layer takes negative and positive slices and applies individual LUTs to each
-
-        If xy given, just return a single pixel value at that position
-
-        Parameters
-        ----------
-        orientation: Orientation
-        index: slice to take
-        flipx:
-        xy
+        The negative and positive LUTs combined into one, for displaying a heatmap slice in a single ImageItem.
+        Slices are displayed directly from get_data; there's no need to split them into negative and positive arrays
 
         Returns
         -------
-        tuple: (ndarray, ndarray)
-            orthogonal slices at given slice index and orientation if xy is None
-        float:
-            single voxel value if xy is tuple (xy)
-
+        tuple: ((n, 4) uint8 LUT, [lower, upper] levels)
         """
-        array = super(HeatmapVolume, self).get_data(orientation, index, flipx, flipz, flipy, xy)
-
-        if xy:
-           return array
-
-        neg_array = np.copy(array)
-        neg_array[neg_array > 0] = 0
-        pos_array = np.copy(array)
-        pos_array[pos_array < 0] = 0
-
-        return neg_array, pos_array
+        return diverging_lut(self.negative_lut, self.positive_lut, self.neg_levels, self.pos_levels)
 
     def set_lower_positive_lut(self, value):
         if value > self.max:
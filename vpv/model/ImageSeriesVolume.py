@@ -1,4 +1,5 @@
 from .volume import Volume
+from vpv.utils.layout_cache import layout_cache
 
 class ImageSeriesVolume(Volume):
     """
@@ -19,10 +20,20 @@ class ImageSeriesVolume(Volume):
         for path in paths:
             array = super(ImageSeriesVolume, self)._load_data(path, memmap)
             self.images.append(array)
+        # Any intensity range set by Volume._load_data is from the last image. Let Volume.__init__ compute it for the first
+        self.min = self.max = None
+        self._stats = None
         return self.images[0]
 
     def set_image(self, idx):
         self._arr_data = self.images[idx]
+        if self._pyramid is not None:
+            self._pyramid.close()
+            self._pyramid = None
+        # Cached slices and plane layouts are from the previous image
+        layout_cache.discard(self)
+        if self.model is not None:
+            self.model.slice_cache.discard(self)
 
     def num_images(self):
         return len(self.images)
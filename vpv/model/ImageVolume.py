@@ -1,3 +1,4 @@
+import os
 from .volume import Volume
 from vpv.annotations.annotations_model import SpecimenAnnotations
 
@@ -7,6 +8,11 @@ class ImageVolume(Volume):
         super(ImageVolume, self).__init__(*args)
 
         # We have annotations only on ImageVolumes
-        self.annotations = SpecimenAnnotations(self.shape_xyz(), self.vol_path)
-        self.levels = [float(self._arr_data.min()), float(self._arr_data.max())]
+        if isinstance(self.vol_path, (list, tuple)):
+            # Virtual stacks are loaded from a list of 2D slice paths. Use the directory containing them
+            ann_path = os.path.dirname(self.vol_path[0])
+        else:
+            ann_path = str(self.vol_path)
+        self.annotations = SpecimenAnnotations(self.shape_xyz(), ann_path)
+        self.levels = [self.min, self.max]
 
@@ -1,5 +1,14 @@
 from vpv.common import Orientation, read_image
 import numpy as np
+import logging
+import threading
+from collections import OrderedDict
+from vpv.utils.volume_cache import volume_cache
+
+# Vector fields are only used for display so half precision is plenty, and a quarter of the size of float64
+VECTOR_DTYPE = np.float16
+MAX_BLOCK_FIELDS = 6  # The number of (orientation, subsampling) block averaged fields kept
+BLOCK_SLAB_SLICES = 16  # Slices block averaged at a time when building a field
 
 
 class VectorVolume(object):
@@ -14,9 +23,19 @@ class VectorVolume(object):
         self.shape = self._arr_data.shape
         self.scale = 1
         self.subsampling = 5
+        # (orientation, subsampling, axes) -> (block means, magnitudes) for every slice. Built in the background
+        self._block_fields = OrderedDict()
+        self._building = set()
+        self._lock = threading.Lock()
 
     def _load_data(self, vol, memap=False):
-        return read_image(vol)
+        # The cached copy is already cast, and is memory mapped
+        cached = volume_cache.get(vol, variant='float16')
+        if cached is not None:
+            return cached[0]
+        arr = read_image(vol).astype(VECTOR_DTYPE)
+        volume_cache.put_async(vol, arr, variant='float16')
+        return arr
 
     def get_coronal(self, index):
         #slice_ = np.rot90(self._arr_data[:, index, :], 1)
@@ -32,6 +51,95 @@ class VectorVolume(object):
         slice_ = np.flipud(self._arr_data[index, :, :])
         return slice_
 
+    def _slices(self, orientation):
+        """
+        The field as a stack of the slices returned by get_axial etc.
+
+        Returns
+        -------
+        np.ndarray view (slices, rows, columns, 3)
+        """
+        if orientation == Orientation.sagittal:
+            return np.moveaxis(self._arr_data, 2, 0)
+        if orientation == Orientation.coronal:
+            return np.moveaxis(self._arr_data, 1, 0)[:, :, ::-1]
+        return self._arr_data[:, ::-1]
+
+    @staticmethod
+    def _average_blocks(slices, c, axes):
+        """
+        Average the 2D vectors of c x c blocks of a stack of slices. Only whole blocks that don't touch the last row
+        or column are used
+
+        Returns
+        -------
+        tuple
+            (block means (slices, rows, columns, 2), magnitudes of the means (slices, rows, columns))
+        """
+        ny, nx = (len(range(0, n - c, c)) for n in slices.shape[1:3])
+        vectors = slices[:, : ny * c, : nx * c].take(axes, axis=3).astype(np.float32)
+        means = vectors.reshape(len(slices), ny, c, nx, c, 2).mean(axis=(2, 4))
+        return means, np.hypot(means[..., 0], means[..., 1])
+
+    def block_means(self, orientation, index: int, c: int, axes: tuple):
+        """
+        Get the mean 2D vectors of the c x c blocks of a slice, and their magnitudes. These come from a block averaged
+        copy of the whole field once it has been built, so changing subsampling or magnitude cutoff, or scrolling, does
+        not need the full resolution vectors re-averaged
+
+        Parameters
+        ----------
+        orientation: Orientation
+        index
+            the slice
+        c
+            subsampling. The size of the blocks
+        axes
+            the two vector components to use
+
+        Returns
+        -------
+        tuple
+            (means (rows, columns, 2), magnitudes (rows, columns))
+        """
+        key = (orientation, c, tuple(axes))
+        # With no averaging to do, a copy of the field would be almost as big as the field itself
+        if c > 1:
+            with self._lock:
+                field = self._block_fields.get(key)
+                if field is not None:
+                    self._block_fields.move_to_end(key)
+                    return field[0][index], field[1][index]
+                if key not in self._building:
+                    self._building.add(key)
+                    threading.Thread(target=self._build_block_field, args=(key,), daemon=True).start()
+        # Average just this slice while the field is built
+        means, magnitudes = self._average_blocks(self._slices(orientation)[index: index + 1], c, axes)
+        return means[0], magnitudes[0]
+
+    def _build_block_field(self, key):
+        orientation, c, axes = key
+        try:
+            slices = self._slices(orientation)
+            ny, nx = (len(range(0, n - c, c)) for n in slices.shape[1:3])
+            means = np.empty((len(slices), ny, nx, 2), dtype=VECTOR_DTYPE)
+            magnitudes = np.empty((len(slices), ny, nx), dtype=VECTOR_DTYPE)
+            for i in range(0, len(slices), BLOCK_SLAB_SLICES):
+                means[i: i + BLOCK_SLAB_SLICES], magnitudes[i: i + BLOCK_SLAB_SLICES] = \
+                    self._average_blocks(slices[i: i + BLOCK_SLAB_SLICES], c, axes)
+        except MemoryError as e:
+            logging.info('Could not build the block averaged vector field {}\n{}'.format(key, e))
+            return
+        else:
+            with self._lock:
+                self._block_fields[key] = means, magnitudes
+                while len(self._block_fields) > MAX_BLOCK_FIELDS:
+                    self._block_fields.popitem(last=False)
+        finally:
+            # Whatever happened, allow the field to be built again if it's not stored
+            with self._lock:
+                self._building.discard(key)
+
     def dimension_length(self, orientation):
         """
         Temp bodge. return the number of slices in this dimension
@@ -43,4 +151,4 @@ class VectorVolume(object):
         if orientation == Orientation.coronal:
             return self._arr_data[0, :, 0, 0].size
         if orientation == Orientation.axial:
-            return self._arr_data[:, 0, 0, 0].size
\ No newline at end of file
+            return self._arr_data[:, 0, 0, 0].size
@@ -1,16 +1,209 @@
 from .ImageVolume import ImageVolume
+from .volume import LoadCancelledError
+from vpv.utils.layout_cache import layout_cache
 from vpv.common import read_image
+import os
+import logging
 import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
 import numpy as np
+import SimpleITK as sitk
+
+NUM_LOAD_WORKERS = min(8, os.cpu_count() or 1)
+# Stacks larger than this are loaded lazily if the lazy argument to VirtualStackVolume is not given
+LAZY_STACK_MIN_BYTES = 2 * 1024 ** 3
+# The number of decoded axial slices kept by a LazySliceStack
+LAZY_CACHE_SLICES = 64
+
+
+def sitk_load(p):
+    return read_image(str(p))
+
+
+def pil_load(p):
+    im = Image.open(p)
+    return np.array(im)
+
+
+def slice_header(path):
+    """
+    Get the dimensions and pixel type of a 2D slice without decoding the pixel data
+
+    Returns
+    -------
+    tuple: (dimensions, pixel type)
+    """
+    # SimpleITK reads in 2D bmps as 3D. So use PIL instead
+    if path.lower().endswith('.bmp'):
+        with Image.open(path) as im:  # PIL only reads the header until the pixels are accessed
+            return im.size, im.mode
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    return reader.GetSize(), (reader.GetPixelID(), reader.GetNumberOfComponents())
+
+
+class LazySliceStack(object):
+    """
+    A read-only, array-like (z, y, x) view of a stack of 2D slice files.
+
+    Indexing a single z (axial) slice decodes just that file, and the most recently used slices are kept in memory.
+    A full copy of the stack is built on a background thread. Any other indexing (coronal and sagittal planes etc.) is
+    served from that copy, in which slices that have not been decoded yet are zero. Once it is complete,
+    VirtualStackVolume has the layout cache build the reordered copies that make coronal and sagittal planes contiguous.
+    """
+    def __init__(self, file_paths, reader, first_slice: np.ndarray, on_complete=None, on_error=None):
+        """
+        Parameters
+        ----------
+        file_paths: list
+            sorted paths to the slices
+        reader: callable
+            decodes a slice path into a 2D array
+        first_slice
+            the already decoded first slice. Gives the shape and dtype of the stack
+        on_complete: callable
+            called with the (min, max) of the stack when the background copy is finished
+        on_error: callable
+            called with a message if any slices could not be decoded. Those slices are left as zeros
+        """
+        self.file_paths = file_paths
+        self.reader = reader
+        self.shape = (len(file_paths), ) + first_slice.shape
+        self.dtype = first_slice.dtype
+        self.ndim = len(self.shape)
+        self.complete = False
+        self.failed_slices = []
+        self._on_complete = on_complete
+        self._on_error = on_error
+
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self._copy = np.memmap(tempfile.TemporaryFile(), dtype=str(self.dtype), mode='w+', shape=self.shape)
+        self._copy[0] = first_slice
+        self._decoded = np.zeros(len(file_paths), dtype=bool)
+        self._decoded[0] = True
+
+        self._thread = threading.Thread(target=self._build_copy, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple) and len(item) > 0 and isinstance(item[0], (int, np.integer)):
+            return self.get_slice(item[0])[item[1:]]
+        if isinstance(item, (int, np.integer)):
+            return self.get_slice(item)
+        return self._copy[item]
+
+    def get_slice(self, z: int) -> np.ndarray:
+        """
+        Get an axial slice, decoding it if it is not in the background copy or the LRU cache yet
+        """
+        if not -self.shape[0] <= z < self.shape[0]:
+            raise IndexError('slice {} is out of bounds for a stack of {} slices'.format(z, self.shape[0]))
+        z = int(z) % self.shape[0]  # Negative indices count back from the end, as for an ndarray
+        if self._decoded[z]:
+            return self._copy[z]
+
+        with self._cache_lock:
+            if z in self._cache:
+                self._cache.move_to_end(z)
+                return self._cache[z]
+
+        slice_ = self.reader(self.file_paths[z])
+        with self._cache_lock:
+            self._cache[z] = slice_
+            while len(self._cache) > LAZY_CACHE_SLICES:
+                self._cache.popitem(last=False)
+        return slice_
+
+    def _build_copy(self):
+
+        def load_slice(z):
+            if self._stop.is_set():
+                return None
+            with self._cache_lock:
+                slice_ = self._cache.get(z)
+            if slice_ is None:
+                try:
+                    slice_ = self.reader(self.file_paths[z])
+                except (IOError, RuntimeError, ValueError) as e:
+                    # Keep building the rest of the stack so the other planes are only missing this slice.
+                    # The slice stays zero in every plane
+                    logging.error('Virtual stack slice {} could not be decoded\n{}'.format(self.file_paths[z], e))
+                    self.failed_slices.append(self.file_paths[z])
+                    self._decoded[z] = True
+                    return None
+            self._copy[z] = slice_
+            self._decoded[z] = True
+            return slice_.min(), slice_.max()
+
+        first = self._copy[0]
+        min_, max_ = first.min(), first.max()
+
+        with ThreadPoolExecutor(max_workers=NUM_LOAD_WORKERS) as pool:
+            futures = [pool.submit(load_slice, z) for z in range(1, self.shape[0])]
+            for future in as_completed(futures):
+                range_ = future.result()
+                if range_ is not None:
+                    min_, max_ = min(min_, range_[0]), max(max_, range_[1])
+
+        if self._stop.is_set():
+            return
+
+        with self._cache_lock:
+            # Axial slices now come from the copy
+            self._cache.clear()
+        self.complete = True
+        logging.info('Virtual stack of {} slices fully loaded'.format(self.shape[0]))
+        if self.failed_slices and self._on_error:
+            self._on_error('{} slices of the virtual stack could not be decoded and are shown blank:\n{}'.format(
+                len(self.failed_slices), '\n'.join(sorted(self.failed_slices))))
+        if self._on_complete:
+            self._on_complete(float(min_), float(max_))
+
+    def full_copy(self) -> np.ndarray:
+        """
+        The (z, y, x) memmap of the whole stack. Slices that have not been decoded yet are zero until complete is True
+        """
+        return self._copy
+
+    def close(self):
+        """
+        Stop building the background copy
+        """
+        self._stop.set()
 
 
 class VirtualStackVolume(ImageVolume):
-    def __init__(self, *args):
+    def __init__(self, *args, lazy=None, cancel_event=None):
+        """
+        Parameters
+        ----------
+        args
+            As Volume
+        lazy: bool
+            If True, slices are decoded on demand and the full stack is loaded in the background.
+            If None, stacks larger than LAZY_STACK_MIN_BYTES are loaded lazily
+        cancel_event: threading.Event
+            If set while the stack is loading, loading is stopped
+        """
+        self.lazy = lazy
+        self.cancel_event = cancel_event
         super(VirtualStackVolume, self).__init__(*args)
 
     def _load_data(self, file_paths, memap=True):
         """
+        Decode a stack of 2D images into a memory mapped 3D array. The slices are decoded in a thread pool and
+        written directly into their rows of the memmap.
+        In lazy mode, a LazySliceStack is returned after decoding just the first slice
 
         Parameters
         ----------
@@ -20,24 +213,18 @@ class VirtualStackVolume(ImageVolume):
         ------
         ValueError
             If an image in the stack is of the icorrect dimensions
+        LoadCancelledError
+            If the cancel_event is set while the stack is loading
 
         """
-        # self.worker = LoadVirtualStackWorker(file_paths)
-        # self.model.updating_started_signal.emit()
-        # self.worker.progress_signal.connect(self.model.updating_msg_signal)
-        # self.worker.finished.connect(self.loading_finsihed)
-        # self.worker.start()
+        file_paths = sorted(file_paths)
 
-    # def loading_finsihed(self):
-    #     self.model.updating_finished_signal.emit()
-    #     return self.worker.memmap_result
-
-        def sitk_load(p):
-            return read_image(str(p))
-
-        def pil_load(p):
-            im = Image.open(p)
-            return np.array(im)
+        # Check the dimensions of all the slices from the headers so we fail before decoding anything
+        first_header = slice_header(file_paths[0])
+        for path in file_paths[1:]:
+            header = slice_header(path)
+            if header != first_header:
+                raise ValueError('{} has dimensions/pixel type {}. Expected {}'.format(path, header, first_header))
 
         # SimpleITK reads in 2D bmps as 3D. So use PIL instead
         if file_paths[0].lower().endswith('.bmp'):
@@ -45,13 +232,72 @@ class VirtualStackVolume(ImageVolume):
         else:
             reader = sitk_load
 
+        # The first slice gives us the dtype. It's written straight into the memmap so is only decoded once
         arr = reader(file_paths[0])
-        dtype = arr.dtype
-        zyx = list(arr.shape)
-        zyx.insert(0, len(file_paths))
+        zyx = (len(file_paths), ) + arr.shape
+
+        if self.lazy is None:
+            self.lazy = arr.nbytes * len(file_paths) > LAZY_STACK_MIN_BYTES
+        if self.lazy:
+            # Until the whole stack is loaded, use the range of the first slice for the display levels
+            self.min, self.max = float(arr.min()), float(arr.max())
+            return LazySliceStack(file_paths, reader, arr, on_complete=self._lazy_load_complete,
+                                  on_error=self._lazy_load_error)
+
         t = tempfile.TemporaryFile()
-        m = np.memmap(t, dtype=str(dtype), mode='w+', shape=tuple(zyx))
-        for i, path in enumerate(sorted(file_paths)):
-            img_arr = reader(path)
-            m[i] = img_arr
-        return m
\ No newline at end of file
+        m = np.memmap(t, dtype=str(arr.dtype), mode='w+', shape=zyx)
+        m[0] = arr
+
+        def load_slice(i):
+            m[i] = reader(file_paths[i])
+
+        size = len(file_paths)
+        report_every = max(1, size // 100)
+
+        with ThreadPoolExecutor(max_workers=NUM_LOAD_WORKERS) as pool:
+            futures = [pool.submit(load_slice, i) for i in range(1, size)]
+            try:
+                for num_done, future in enumerate(as_completed(futures), 2):
+                    future.result()
+                    if self.cancel_event is not None and self.cancel_event.is_set():
+                        raise LoadCancelledError('Virtual stack loading cancelled')
+                    if num_done % report_every == 0 and self.model is not None:
+                        self.model.updating_msg_signal.emit(
+                            "Loading virtual stack.. {}%".format(int(100.0 / size * num_done)))
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return m
+
+    def _lazy_load_complete(self, min_, max_):
+        """
+        Called from the LazySliceStack background thread when the full stack has been loaded
+        """
+        # The levels start at the range of the first slice. Widen them unless the user has already changed them
+        if getattr(self, 'levels', None) == [self.min, self.max]:
+            self.levels[:] = [min_, max_]
+        self.min, self.max = min_, max_
+
+    def _lazy_load_error(self, msg):
+        """
+        Called from the LazySliceStack background thread if some of the slices could not be decoded
+        """
+        if self.model is not None:
+            self.model.load_error_signal.emit(msg)
+
+    def _layout(self, orientation):
+        """
+        Once a lazy stack is fully loaded, build the coronal and sagittal layouts from its background copy so
+        those planes are not strided reads of the memmap
+        """
+        if isinstance(self._arr_data, LazySliceStack):
+            if not self.use_layout_cache or not self._arr_data.complete:
+                return None
+            return layout_cache.get(self, self._arr_data.full_copy(), orientation)
+        return super(VirtualStackVolume, self)._layout(orientation)
+
+    def destroy(self):
+        if isinstance(self._arr_data, LazySliceStack):
+            self._arr_data.close()
+        super(VirtualStackVolume, self).destroy()
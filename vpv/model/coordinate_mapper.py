@@ -18,12 +18,143 @@ flip_from_axial_order = {
 }
 
 
+def _permutation(order) -> np.ndarray:
+    """
+    The 4x4 homogeneous matrix that reorders a point as sorted(zip(order, point)) does
+    """
+    matrix = np.zeros((4, 4), dtype=np.int64)
+    for j, i in enumerate(order):
+        matrix[i, j] = 1
+    matrix[3, 3] = 1
+    return matrix
+
+
 class Coordinate_mapper(object):
     """Map coordinates between views and volumes
+
+    Each mapping is a 4x4 integer homogeneous transform, made once per combination of orientations, volume dimensions
+    and flips. Call flips_changed when the flip options change
     """
     def __init__(self, views: dict, saved_flip_info: dict):
         self.views = views  # Get a reference to the views dict that contains the slice view widgets
         self.flip_info = saved_flip_info
+        self._transforms = {}
+
+    def flips_changed(self):
+        """
+        The flips in flip_info have been changed. The transforms need remaking
+        """
+        self._transforms.clear()
+
+    def _view_flips(self, ori: Orientation, dims) -> np.ndarray:
+        """
+        The transform that applies the flips of a view, in the view's coordinates. The transform is its own inverse
+        """
+        # The dimensions in the order of the view
+        new_dims = _permutation(flip_from_axial_order[ori])[:3, :3] @ np.asarray(dims)
+        flips = self.flip_info[ori.name]
+        # 280319. x is flipped by default in every view for RAS
+        flipped = (not flips['x'], flips['y'], flips['z'])
+        matrix = np.eye(4, dtype=np.int64)
+        for i, flip in enumerate(flipped):
+            if flip:
+                matrix[i, i] = -1
+                matrix[i, 3] = new_dims[i]
+        return matrix
+
+    def view_to_volume_transform(self, src_ori: Orientation, dims, from_saved=False) -> np.ndarray:
+        """
+        Get the transform from a view's (x, y, slice) coordinates to volume (x, y, z) coordinates
+
+        Returns
+        -------
+        np.ndarray
+            4x4 homogeneous integer matrix
+        """
+        key = ('to_volume', src_ori, tuple(dims), from_saved)
+        transform = self._transforms.get(key)
+        if transform is None:
+            transform = _permutation(flip_to_axial_order[src_ori])
+            if not from_saved:  # If from saved list we don't need to do any flipping on the points
+                transform = transform @ self._view_flips(src_ori, dims)
+            self._transforms[key] = transform
+        return transform
+
+    def view_to_view_transform(self, src_ori: Orientation, dest_ori: Orientation, dims, from_saved=False) -> np.ndarray:
+        """
+        Get the transform from a view's (x, y, slice) coordinates to another view's
+
+        Returns
+        -------
+        np.ndarray
+            4x4 homogeneous integer matrix
+        """
+        key = ('to_view', src_ori, dest_ori, tuple(dims), from_saved)
+        transform = self._transforms.get(key)
+        if transform is None:
+            transform = self._view_flips(dest_ori, dims) @ _permutation(flip_from_axial_order[dest_ori]) @ \
+                        self.view_to_volume_transform(src_ori, dims, from_saved)
+            self._transforms[key] = transform
+        return transform
+
+    @staticmethod
+    def _apply(transform: np.ndarray, points) -> np.ndarray:
+        points = np.asarray(points)
+        return points @ transform[:3, :3].T + transform[:3, 3]
+
+    def view_to_volume_points(self, points, src_ori: Orientation, dims, from_saved=False) -> np.ndarray:
+        """
+        Map many points from a slice view to volume space at once. See view_to_volume
+
+        Parameters
+        ----------
+        points: array-like
+            (N, 3) of (x, y, slice index)
+
+        Returns
+        -------
+        np.ndarray
+            (N, 3) of volume (x, y, z)
+        """
+        return self._apply(self.view_to_volume_transform(src_ori, dims, from_saved), points)
+
+    def view_to_view_points(self, points, src_ori: Orientation, dest_ori: Orientation, dims,
+                            from_saved=False) -> np.ndarray:
+        """
+        Map many points from one slice view to another at once. See view_to_view
+
+        Parameters
+        ----------
+        points: array-like
+            (N, 3) of (x, y, slice index)
+
+        Returns
+        -------
+        np.ndarray
+            (N, 3) of (x, y, slice index) in the destination view
+        """
+        return self._apply(self.view_to_view_transform(src_ori, dest_ori, dims, from_saved), points)
+
+    def view_to_views(self, x: int, y: int, z: int, src_ori: Orientation, dest_oris, dims,
+                      from_saved=False) -> np.ndarray:
+        """
+        Map a point from one slice view to several other views at once. See view_to_view
+
+        Parameters
+        ----------
+        dest_oris: list
+            the Orientation of each destination view
+
+        Returns
+        -------
+        np.ndarray
+            (N, 3) of (x, y, slice index), one row for each destination view
+        """
+        if not dest_oris:
+            return np.empty((0, 3), dtype=int)
+        transforms = np.stack([self.view_to_view_transform(src_ori, dest_ori, dims, from_saved)
+                               for dest_ori in dest_oris])
+        return transforms[:, :3, :3] @ (x, y, z) + transforms[:, :3, 3]
 
     def view_to_volume(self, x: int, y: int, z: int, src_ori: Orientation, dims: list, from_saved=False) -> tuple:
         """
@@ -60,27 +191,7 @@ class Coordinate_mapper(object):
         position labels
 
         """
-
-        if not from_saved:  # If from saved list we don't need to do any flipping on the points
-            # Flip the dimensions so thay match the view
-
-            dims_order = flip_from_axial_order[src_ori]
-            new_dims = [j for _, j in sorted(zip(dims_order, dims), key=lambda pair: pair[0])]
-
-
-            if self.flip_info[src_ori.name]['y']:
-                y = new_dims[1] - y
-
-            if not self.flip_info[src_ori.name]['x']:  # 280319. x is flipped by default in every view for RAS
-                x = new_dims[0] - x
-
-            if self.flip_info[src_ori.name]['z']:
-                z = new_dims[2] - z
-
-        order = flip_to_axial_order[src_ori]
-        xa, ya, za = [j for _, j in sorted(zip(order, [x, y, z]), key=lambda pair: pair[0])]
-
-        return xa, ya, za
+        return tuple(self.view_to_volume_points((x, y, z), src_ori, dims, from_saved).tolist())
 
     def view_to_view(self, x, y, z, src_ori, dest_ori, dims, from_saved=False):
         """
@@ -106,27 +217,7 @@ class Coordinate_mapper(object):
             (x,y,idx)
 
         """
-        # Get the points in volume space
-        axial_space_points = self.view_to_volume(x, y, z, src_ori, dims, from_saved)
-
-        # And map to the destination space
-
-        order = flip_from_axial_order[dest_ori]
-        dest_points = [j for _, j in sorted(zip(order, axial_space_points), key=lambda pair: pair[0])]
-
-        dims_order = flip_from_axial_order[dest_ori]
-        new_dims = [j for _, j in sorted(zip(dims_order, dims), key=lambda pair: pair[0])]
-
-        if self.flip_info[dest_ori.name]['y']:
-            dest_points[1] = new_dims[1] - dest_points[1]
-
-        if not self.flip_info[dest_ori.name]['x']:
-            dest_points[0] = new_dims[0] - dest_points[0]
-
-        if self.flip_info[dest_ori.name]['z']:
-            dest_points[2] = new_dims[2] - dest_points[2]
-
-        return dest_points
+        return self.view_to_view_points((x, y, z), src_ori, dest_ori, dims, from_saved).tolist()
 
     def roi_to_view(self, xx, yy, zz):
 
@@ -143,19 +234,15 @@ class Coordinate_mapper(object):
         tuple
             Mapped coordinates ((x,x), (y,y), (z,z)
         """
-        z = [int(i) for i in zz]
-        y = [int(i) for i in yy]
-        x = [int(i) for i in xx]
+        # The two corners of the roi
+        corners = np.array([xx, yy, zz], dtype=float).astype(int).T
 
         for dest_view in self.views.values():
             # First map the annotation marker between views
             dest_dims = dest_view.main_volume.shape_xyz()
 
-            points_1 = self.view_to_view(x[0], y[0], z[0], Orientation.axial, dest_view.orientation,
-                                         dest_dims, from_saved=True)
-
-            points_2 = self.view_to_view(x[1], y[1], z[1], Orientation.axial, dest_view.orientation,
-                                         dest_dims, from_saved=True)
+            points_1, points_2 = self.view_to_view_points(corners, Orientation.axial, dest_view.orientation,
+                                                          dest_dims, from_saved=True).tolist()
 
             midslice = int(np.mean([points_1[2], points_2[2]]))
 
@@ -18,12 +18,16 @@
 """
 TODO: don't duplicate the full array for each _get_* function
 """
-import numpy as np
 import os
-import tempfile
-from PIL import Image
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait, as_completed
+from functools import partial
+from typing import Iterator, Tuple, Union
 from PyQt5 import QtCore
-from vpv.common import read_image, get_stage_and_modality, error_dialog
+from vpv.common import get_stage_and_modality, error_dialog
+from vpv.utils.native_readers import ZipMember
+from vpv.utils.bricked_volume import BRICKED_EXT
 from vpv.annotations.impc_xml import load_xml, get_annotator_id_and_date
 from vpv.annotations.annotations_model import centre_stage_options, PROCEDURE_METADATA, ANNOTATION_DONE_METADATA_FILE
 
@@ -32,43 +36,94 @@ from .HeatmapVolume import HeatmapVolume
 from .VectorVolume import VectorVolume
 from .ImageSeriesVolume import ImageSeriesVolume
 from .VirtualStackVolume import VirtualStackVolume
+from .BrickedVolume import BrickedVolume
+from .volume import LoadCancelledError
+from .slice_cache import SliceCache, SlicePrefetcher
 import yaml
 
+MAX_LOAD_WORKERS = 4  # Limit the number of volumes being decoded at once to keep memory use down
 
-class LoadVirtualStackWorker(QtCore.QThread):
-    progress_signal = QtCore.pyqtSignal([str])
 
-    def __init__(self, file_paths):
-        QtCore.QThread.__init__(self)
-        self.file_paths = file_paths
-        self.memmap_result = None  # Populated at end of run()
+class LoadHandle(QtCore.QObject):
+    """
+    Returned by DataModel.load_volumes_async. The unique ids are reserved when the load is started and are shown as
+    'loading' entries until the volumes are ready.
+
+    Attributes
+    ----------
+    paths: list
+        the paths being loaded
+    ids: list
+        the unique ids reserved for each path, in the same order
+    loaded_ids: list
+        ids of volumes that have been added to the model so far
+    failed: list
+        (path, error message) of volumes that could not be loaded
+    cancelled: list
+        paths of volumes not loaded because the load was cancelled
+    cancel_event: threading.Event
+        set by cancel(). Only affects this load
+    """
+    volume_loaded_signal = QtCore.pyqtSignal(str, str)  # path, unique id
+    volume_failed_signal = QtCore.pyqtSignal(str, str)  # path, error message
+    finished_signal = QtCore.pyqtSignal()
+
+    def __init__(self, paths, ids):
+        super(LoadHandle, self).__init__()
+        self.paths = paths
+        self.ids = ids
+        self.loaded_ids = []
+        self.failed = []
+        self.cancelled = []
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """
+        Stop loading the volumes of this load that have not been decoded yet
+        """
+        self.cancel_event.set()
 
-    def sitk_load(self, p):
-        read_image(p, convert_to_ras=True)
+    def done(self) -> bool:
+        return len(self.loaded_ids) + len(self.failed) + len(self.cancelled) == len(self.paths)
 
-    def pil_load(self, p):
-        im = Image.open(p)
-        return np.array(im)
 
-    def run(self):
-        size = len(self.file_paths)
-        # SimpleITK reads in 2D bmps as 3D. So use PIL instead
-        if self.file_paths[0].lower().endswith('.bmp'):
-            reader = self.pil_load
-        else:
-            reader = self.sitk_load
+class LoadVolumesWorker(QtCore.QThread):
+    """
+    Decodes volumes in a thread pool. Each Volume object is sent back to the GUI thread via loaded_signal as soon as
+    it's ready
+    """
+    loaded_signal = QtCore.pyqtSignal(int, object)  # index into paths, Volume
+    failed_signal = QtCore.pyqtSignal(int, str)  # index into paths, error message
+    cancelled_signal = QtCore.pyqtSignal(int)  # index into paths
+
+    def __init__(self, model, paths, data_type, memory_map, fdr_thresholds, cancel_event):
+        QtCore.QThread.__init__(self)
+        self.model = model
+        self.cancel_event = cancel_event
+        self.paths = paths
+        self.data_type = data_type
+        self.memory_map = memory_map
+        self.fdr_thresholds = fdr_thresholds
 
-        arr = reader(self.file_paths[0])
-        dtype = arr.dtype
-        zyx = list(arr.shape)
-        zyx.insert(0, len(self.file_paths))
-        t = tempfile.TemporaryFile()
-        m = np.memmap(t, dtype=dtype, mode='w+', shape=tuple(zyx))
-        for i, path in enumerate(sorted(self.file_paths)):
-            img_arr = reader(path)
-            m[i] = img_arr
-            self.progress_signal.emit("Loading virtual stack.. {}%".format(str(100.0/size * i)))
-        self.memmap_result = m
+    def run(self):
+        num_workers = min(len(self.paths), MAX_LOAD_WORKERS, os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            futures = {pool.submit(self.model._create_volume, path, self.data_type, self.memory_map,
+                                   self.fdr_thresholds, self.cancel_event): i for i, path in enumerate(self.paths)}
+            for future in as_completed(futures):
+                i = futures[future]
+                if self.cancel_event.is_set():
+                    for f in futures:
+                        f.cancel()
+                try:
+                    vol = future.result()
+                except (LoadCancelledError, CancelledError):
+                    self.cancelled_signal.emit(i)
+                except Exception as e:  # Any decoder error. RuntimeError is raised by SimpleITK
+                    logging.exception('Could not load {}'.format(self.paths[i]))
+                    self.failed_signal.emit(i, str(e) or type(e).__name__)
+                else:
+                    self.loaded_signal.emit(i, vol)
 
 
 class DataModel(QtCore.QObject):
@@ -76,9 +131,9 @@ class DataModel(QtCore.QObject):
     The model for our app
     """
     data_changed_signal = QtCore.pyqtSignal()
-    updating_started_signal = QtCore.pyqtSignal()
     updating_msg_signal = QtCore.pyqtSignal(str)
-    updating_finished_signal = QtCore.pyqtSignal()
+    # Problems found with volumes that have already been added, eg. while the rest of a lazy stack is loaded
+    load_error_signal = QtCore.pyqtSignal(str)
 
     def update_msg_slot(self, msg):
         """
@@ -98,6 +153,26 @@ class DataModel(QtCore.QObject):
         self._volumes = {}
         self._data = {}
         self._vectors = {}
+        # unique id -> data type of volumes being loaded in the background
+        self._loading = {}
+        # unique id -> (path, data type, memory map) of volumes that are loaded when first requested
+        self._lazy = {}
+        # unique id -> LoadHandle of volumes being loaded in the background
+        self._load_handles = {}
+        self._load_workers = []
+        # The cancel events of the loads in progress. Each load has its own
+        self._cancel_events = set()
+        # 2D slices shared between the views, and filled ahead of scrolling by the prefetcher
+        self.slice_cache = SliceCache()
+        self.slice_prefetcher = SlicePrefetcher(self.slice_cache)
+
+    def cancel_loading(self):
+        """
+        Stop all the loads in progress. Volumes that have already been decoded are still added. To cancel a single
+        load use LoadHandle.cancel, or the cancel_event given to add_volumes
+        """
+        for event in list(self._cancel_events):
+            event.set()
 
     def change_vol_name(self, old_name, new_name):
         # Only work on image volumes for now
@@ -112,17 +187,27 @@ class DataModel(QtCore.QObject):
             vol.set_interpolation(onoff)
 
     def clear_data(self):
+        # Stop the loads in progress. Anything they have already decoded is dropped rather than added to the
+        # cleared model
+        self.cancel_loading()
+        self._loading = {}
+        self._load_handles = {}
         keys = list(self._volumes.keys())
         for k in keys:
             del self._volumes[k]
         self._volumes = {}
         self._data = {}
+        self._vectors = {}
+        self._lazy = {}
+        self.slice_cache.clear()
 
     def volume_id_list(self, sort=True):
+        # Volumes that will be loaded when first viewed are included
+        ids = [id_ for id_ in self._volumes] + [id_ for id_, spec in self._lazy.items() if spec[1] == 'vol']
         if sort: # Not sure if we need this
-            return sorted([id_ for id_ in self._volumes])
+            return sorted(ids)
         else:
-            return [id_ for id_ in self._volumes]
+            return ids
 
     def data_id_list(self):
         return sorted([id_ for id_ in self._data])
@@ -130,6 +215,17 @@ class DataModel(QtCore.QObject):
     def vector_id_list(self):
         return sorted([id_ for id_ in self._vectors])
 
+    def loading_id_list(self, data_types=('vol', 'virtual_stack')):
+        """
+        The ids reserved for volumes that are still being loaded in the background
+
+        Parameters
+        ----------
+        data_types: tuple
+            only return ids for these data types
+        """
+        return sorted([id_ for id_, data_type in self._loading.items() if data_type in data_types])
+
         for key in self._data.keys():
             self._data[key].destroy()
 
@@ -141,6 +237,10 @@ class DataModel(QtCore.QObject):
         vol = None
         if id_ == 'None':
             return 'None'
+        if id_ in self._lazy or id_ in self._loading:
+            # Not loaded yet. Make sure it's loading in the background. See load_pending
+            self.load_pending(id_)
+            return "None"
         try:
             vol = self._volumes[id_]
         except KeyError:
@@ -332,36 +432,263 @@ class DataModel(QtCore.QObject):
         unique id of loaded image
 
         """
-        if data_type != 'virtual_stack':
+        vol = self._create_volume(volpath, data_type, memory_map, fdr_thresholds)
+        return self._register_volume(vol, volpath, data_type)
+
+    def add_volumes(self, volpaths, data_type, memory_map, fdr_thresholds=False,
+                    cancel_event: threading.Event = None) -> Iterator[Tuple]:
+        """
+        Load multiple volumes. The files are decoded in a thread pool and each volume is registered in the model on
+        the calling (GUI) thread as it becomes available. Results are yielded in the order of volpaths so the unique
+        names are the same as if they were loaded one at a time. Qt events are processed while waiting so the window
+        stays responsive.
+
+        Parameters
+        ----------
+        volpaths: list
+            paths to the volumes
+        data_type: str
+        memory_map: bool
+        fdr_thresholds: dict
+        cancel_event
+            set this to stop the volumes not yet decoded from being loaded
+
+        Yields
+        -------
+        tuple: (path, unique id) or (path, exception) if the volume could not be loaded
+        """
+        specs = [(volpath, data_type, memory_map, fdr_thresholds) for volpath in volpaths]
+        for spec, result in self.add_volume_batch(specs, cancel_event):
+            yield spec[0], result
+
+    def add_volume_batch(self, specs, cancel_event: threading.Event = None) -> Iterator[Tuple]:
+        """
+        As add_volumes, but each volume can be of a different data type
+
+        Parameters
+        ----------
+        specs: list
+            (volpath, data_type, memory_map, fdr_thresholds) for each volume
+        cancel_event
+            set this to stop the volumes not yet decoded from being loaded
+
+        Yields
+        -------
+        tuple: (spec, unique id) or (spec, exception) if the volume could not be loaded
+        """
+        if not specs:
+            return
+        num_workers = min(len(specs), MAX_LOAD_WORKERS, os.cpu_count() or 1)
+        if cancel_event is None:
+            cancel_event = threading.Event()
+        self._cancel_events.add(cancel_event)
+
+        try:
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                futures = [pool.submit(self._create_volume, *spec, cancel_event) for spec in specs]
+                for i, (spec, future) in enumerate(zip(specs, futures)):
+                    while not wait([future], timeout=0.05).done:
+                        QtCore.QCoreApplication.processEvents()
+                        if cancel_event.is_set():
+                            for f in futures:
+                                f.cancel()
+                    try:
+                        vol = future.result()
+                    except (LoadCancelledError, CancelledError):
+                        continue
+                    except Exception as e:  # Any decoder error. RuntimeError is raised by SimpleITK
+                        logging.exception('Could not load {}'.format(spec[0]))
+                        yield spec, e
+                        continue
+                    unique_name = self._register_volume(vol, spec[0], spec[1])
+                    self.updating_msg_signal.emit('Loaded {} ({}/{})'.format(unique_name, i + 1, len(specs)))
+                    yield spec, unique_name
+        finally:
+            self._cancel_events.discard(cancel_event)
+
+    def add_volume_lazy(self, volpath, data_type='vol', memory_map=False) -> str:
+        """
+        Reserve a unique id for a volume without loading it. The volume is listed with the loaded volumes and is
+        loaded in the background the first time it's requested by getvol() or load_pending()
+
+        Returns
+        -------
+        unique id of the volume
+        """
+        unique_name = self.create_unique_name(self._base_name(volpath, data_type))
+        self._lazy[unique_name] = (volpath, data_type, memory_map)
+        self.data_changed_signal.emit()
+        return unique_name
+
+    def load_pending(self, id_) -> Union[LoadHandle, None]:
+        """
+        Get the background load of a volume that is not loaded yet. Volumes added with add_volume_lazy are started
+        loading on the first call
+
+        Returns
+        -------
+        LoadHandle
+            None if the volume is already loaded, or the id is unknown
+        """
+        if id_ in self._lazy:
+            volpath, data_type, memory_map = self._lazy.pop(id_)
+            self.load_volumes_async([volpath], data_type, memory_map, ids=[id_])
+        return self._load_handles.get(id_)
+
+    def load_volumes_async(self, volpaths, data_type, memory_map, fdr_thresholds=False, ids=None) -> LoadHandle:
+        """
+        Load volumes in the background without blocking the Qt event loop.
+        A unique id for each volume is reserved straight away and listed in loading_id_list() until the volume is
+        ready. data_changed_signal is emitted when the load is started and again as each volume is added to the model
+
+        Parameters
+        ----------
+        volpaths: list
+        data_type: str
+        memory_map: bool
+        fdr_thresholds: dict
+        ids: list
+            ids already reserved for the volumes by add_volume_lazy. If None, new ones are created
+
+        Returns
+        -------
+        LoadHandle
+        """
+        if ids is None:
+            ids = [self.create_unique_name(self._base_name(volpath, data_type)) for volpath in volpaths]
+        handle = LoadHandle(volpaths, ids)
+        for id_ in ids:
+            self._loading[id_] = data_type
+            self._load_handles[id_] = handle
+        self._cancel_events.add(handle.cancel_event)
+        handle.finished_signal.connect(partial(self._cancel_events.discard, handle.cancel_event))
+
+        worker = LoadVolumesWorker(self, volpaths, data_type, memory_map, fdr_thresholds, handle.cancel_event)
+        worker.loaded_signal.connect(partial(self._on_async_volume_loaded, handle, data_type))
+        worker.failed_signal.connect(partial(self._on_async_volume_failed, handle))
+        worker.cancelled_signal.connect(partial(self._on_async_volume_cancelled, handle))
+        worker.finished.connect(partial(self._load_workers.remove, worker))
+        self._load_workers.append(worker)
+        worker.start()
+
+        self.data_changed_signal.emit()
+        return handle
+
+    def _release_load_id(self, handle, i) -> bool:
+        """
+        Stop tracking the id reserved for volume i of a background load
+
+        Returns
+        -------
+        bool
+            False if the model has been cleared since the load was started, so the id is no longer reserved
+        """
+        id_ = handle.ids[i]
+        if self._load_handles.get(id_) is not handle:
+            return False
+        del self._load_handles[id_]
+        self._loading.pop(id_, None)
+        return True
+
+    def _on_async_volume_loaded(self, handle, data_type, i, vol):
+        if not self._release_load_id(handle, i):
+            # The model was cleared while this volume was loading
+            vol.destroy()
+            handle.cancelled.append(handle.paths[i])
+            if handle.done():
+                handle.finished_signal.emit()
+            return
+        unique_name = self._register_volume(vol, handle.paths[i], data_type, handle.ids[i])
+        handle.loaded_ids.append(unique_name)
+        handle.volume_loaded_signal.emit(str(handle.paths[i]), unique_name)
+        if handle.done():
+            handle.finished_signal.emit()
+
+    def _on_async_volume_failed(self, handle, i, msg):
+        self._release_load_id(handle, i)
+        handle.failed.append((handle.paths[i], msg))
+        handle.volume_failed_signal.emit(str(handle.paths[i]), msg)
+        self.data_changed_signal.emit()
+        if handle.done():
+            handle.finished_signal.emit()
+
+    def _on_async_volume_cancelled(self, handle, i):
+        self._release_load_id(handle, i)
+        handle.cancelled.append(handle.paths[i])
+        self.data_changed_signal.emit()
+        if handle.done():
+            handle.finished_signal.emit()
+
+    def _create_volume(self, volpath, data_type, memory_map, fdr_thresholds=False, cancel_event=None):
+        """
+        Load the data into a Volume subclass. This does not touch the model's volume dicts so it can be run
+        on a worker thread
+
+        Parameters
+        ----------
+        cancel_event: threading.Event
+            Checked by volumes that are slow to load (virtual stacks) so the load can be stopped part way through
+
+        Returns
+        -------
+        Volume subclass instance
+        """
+        if data_type != 'virtual_stack' and not isinstance(volpath, ZipMember):
             volpath = str(volpath)
-            n = os.path.basename(volpath)
-            unique_name = self.create_unique_name(n)
-        else:
-            n = os.path.basename(os.path.split(volpath[0])[0])
-            unique_name = self.create_unique_name(n)
 
         if data_type == 'heatmap':
             vol = HeatmapVolume(volpath, self, 'heatmap')
             if fdr_thresholds or fdr_thresholds is None:
                 vol.fdr_thresholds = fdr_thresholds
-            vol.name = unique_name
-            self._data[vol.name] = vol
+        elif data_type == 'vol' and str(volpath).lower().endswith(BRICKED_EXT):
+            vol = BrickedVolume(volpath, self, 'volume', memory_map)
         elif data_type == 'vol':
             vol = ImageVolume(volpath, self, 'volume', memory_map)
-            vol.name = unique_name
-            self._volumes[vol.name] = vol
         elif data_type == 'virtual_stack':
-            vol = VirtualStackVolume(volpath, self, 'virtual_stack', memory_map)
-            vol.name = unique_name
-            self._volumes[vol.name] = vol
+            vol = VirtualStackVolume(volpath, self, 'virtual_stack', memory_map, cancel_event=cancel_event)
         elif data_type == 'vector':
             vol = VectorVolume(volpath, self, 'vector')
-            vol.name = unique_name
+
+        if isinstance(vol, QtCore.QObject) and vol.thread() is not self.thread():
+            # Created on a worker thread. Give it the same thread affinity as the model
+            vol.moveToThread(self.thread())
+        return vol
+
+    def _register_volume(self, vol, volpath, data_type, unique_name=None) -> str:
+        """
+        Give a loaded volume a unique name and add it to the model. Should be called on the GUI thread
+
+        Parameters
+        ----------
+        unique_name: str
+            An id reserved by load_volumes_async. If None, a new one is created
+
+        Returns
+        -------
+        unique id of the volume
+        """
+        if unique_name is None:
+            unique_name = self.create_unique_name(self._base_name(volpath, data_type))
+        self._loading.pop(unique_name, None)
+        vol.name = unique_name
+
+        if data_type == 'heatmap':
+            self._data[vol.name] = vol
+        elif data_type in ('vol', 'virtual_stack'):
+            self._volumes[vol.name] = vol
+        elif data_type == 'vector':
             self._vectors[vol.name] = vol
 
         self.id_counter += 1
         self.data_changed_signal.emit()
-        return unique_name
+        return vol.name
+
+    @staticmethod
+    def _base_name(volpath, data_type) -> str:
+        if data_type != 'virtual_stack':
+            return os.path.basename(str(volpath))
+        else:
+            return os.path.basename(os.path.split(volpath[0])[0])
 
     def create_unique_name(self, name):
         """
@@ -370,12 +697,13 @@ class DataModel(QtCore.QObject):
         :return:
         """
         name = os.path.splitext(name)[0]
-        if name not in self._volumes and name not in self._data and name not in self._vectors:
+        taken = (self._volumes, self._data, self._vectors, self._loading, self._lazy)
+        if not any(name in ids for ids in taken):
             return name
         else:
             for i in range(1, 100):
                 new_name = '{}({})'.format(name, i)
-                if new_name not in self._volumes and new_name not in self._data:
+                if not any(new_name in ids for ids in taken):
                     return new_name
 
     def write_temporary_annotations_metadata(self):
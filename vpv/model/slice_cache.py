@@ -0,0 +1,189 @@
+"""
+A cache of 2D slices shared by all the views, and a prefetcher that fills it ahead of scrolling.
+
+Views showing the same volume in the same orientation with the same flips get the same slice from the cache instead
+of each extracting it. Cached slices are contiguous, read-only copies; callers that need to modify a slice must copy
+it first. The cache is limited by a byte budget and the least recently used slices are dropped first.
+
+The SlicePrefetcher is told each time a view changes slice. From the direction and speed of scrolling it loads the
+next slices on a worker thread, so holding down the scroll buttons does not wait on reading from disk.
+"""
+
+import time
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+DEFAULT_BUDGET = 512 * 1024 ** 2  # 512MB
+PREFETCH_WORKERS = 2
+PREFETCH_MIN = 4  # The fewest slices to load ahead
+PREFETCH_MAX = 32  # The most slices to load ahead
+PREFETCH_SECONDS = 0.5  # Load enough slices to cover this much scrolling at the current speed
+PREFETCH_IDLE_SECONDS = 1.0  # Scrolling that pauses for longer than this starts again at PREFETCH_MIN
+
+
+class SliceCache(object):
+    """
+    Attributes
+    ----------
+    budget: int
+        maximum size in bytes of all the cached slices. If 0, nothing is cached
+    """
+    def __init__(self, budget: int = DEFAULT_BUDGET):
+        self.budget = budget
+        self._lock = threading.Lock()
+        # (id(volume), orientation, index, flipx, flipz, flipy) -> (weakref to volume, slice). Least recently used first
+        self._slices = OrderedDict()
+        self._nbytes = 0
+
+    def get(self, vol, key: tuple):
+        """
+        Parameters
+        ----------
+        vol: Volume
+        key
+            (orientation, index, flipx, flipz, flipy)
+
+        Returns
+        -------
+        np.ndarray or None if not cached
+        """
+        full_key = (id(vol), ) + key
+        with self._lock:
+            entry = self._slices.get(full_key)
+            if entry is None:
+                return None
+            if entry[0]() is not vol:
+                # A previous volume with the same id has gone
+                self._pop(full_key)
+                return None
+            self._slices.move_to_end(full_key)
+            return entry[1]
+
+    def put(self, vol, key: tuple, slice_: np.ndarray) -> np.ndarray:
+        """
+        Add a slice to the cache
+
+        Returns
+        -------
+        np.ndarray
+            the read-only copy of slice_ that was cached
+        """
+        # Always copy so the cached slice does not keep reading from a memory mapped file
+        slice_ = np.array(slice_, order='C')
+        slice_.flags.writeable = False
+        if not self.budget or slice_.nbytes > self.budget:
+            return slice_
+
+        full_key = (id(vol), ) + key
+        with self._lock:
+            self._pop(full_key)
+            self._slices[full_key] = (weakref.ref(vol), slice_)
+            self._nbytes += slice_.nbytes
+            while self._nbytes > self.budget:
+                self._pop(next(iter(self._slices)))
+        return slice_
+
+    def contains(self, vol, key: tuple) -> bool:
+        with self._lock:
+            entry = self._slices.get((id(vol), ) + key)
+            return entry is not None and entry[0]() is vol
+
+    def _pop(self, full_key):
+        entry = self._slices.pop(full_key, None)
+        if entry is not None:
+            self._nbytes -= entry[1].nbytes
+
+    def discard(self, vol):
+        """
+        Remove all the slices of a volume. Call this if the volume's data changes
+        """
+        with self._lock:
+            for full_key in [k for k in self._slices if k[0] == id(vol)]:
+                self._pop(full_key)
+
+    def size(self) -> int:
+        return self._nbytes
+
+    def clear(self):
+        with self._lock:
+            self._slices.clear()
+            self._nbytes = 0
+
+
+class SlicePrefetcher(object):
+    """
+    Loads slices into the SliceCache ahead of the direction each view is scrolling in
+    """
+    def __init__(self, cache: SliceCache):
+        self.cache = cache
+        self._pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+        self._lock = threading.Lock()
+        # id(view) -> [(id(volume), orientation, lod, region), last index, time of last change, generation]
+        self._views = {}
+
+    def slice_changed(self, view, vol, orientation, index: int, flips: tuple, lod: int = 0, region: tuple = None):
+        """
+        Called whenever a view shows a new slice
+
+        Parameters
+        ----------
+        view
+            any object that identifies the view (normally a Layer)
+        vol: Volume
+        orientation: Orientation
+        index
+            the slice that is being shown
+        flips
+            (flipx, flipz, flipy) as passed to Volume.get_data
+        lod
+            the level of the volume's resolution pyramid the view is showing
+        region
+            the region of the slice the view is showing, as passed to Volume.get_data
+        """
+        if not self.cache.budget or not hasattr(vol, 'prefetch_slices'):
+            return
+        now = time.perf_counter()
+        source = (id(vol), orientation, lod, region)
+        with self._lock:
+            state = self._views.get(id(view))
+            # A newer request supersedes any prefetching still queued for this view
+            generation = state[3] + 1 if state else 0
+            self._views[id(view)] = [source, index, now, generation]
+        if state is None or state[0] != source:
+            # The view has just started showing this volume, orientation, level or region. Wait to see which way it's scrolled
+            return
+
+        step = index - state[1]
+        elapsed = now - state[2]
+        if step == 0:
+            return
+
+        direction = 1 if step > 0 else -1
+        if elapsed > PREFETCH_IDLE_SECONDS:
+            ahead = PREFETCH_MIN
+        else:
+            speed = abs(step) / max(elapsed, 1e-3)  # slices per second
+            ahead = int(min(PREFETCH_MAX, max(PREFETCH_MIN, speed * PREFETCH_SECONDS)))
+
+        indices = [index + direction * i for i in range(1, ahead + 1)]
+
+        def superseded():
+            state = self._views.get(id(view))
+            return state is None or state[3] != generation
+
+        self._pool.submit(self._prefetch, vol, orientation, indices, flips, superseded, lod, region)
+
+    @staticmethod
+    def _prefetch(vol, orientation, indices, flips, superseded, lod, region):
+        try:
+            vol.prefetch_slices(orientation, indices, flips, superseded, lod, region)
+        except Exception as e:  # Prefetching is only an optimisation. Never let it take down the worker
+            logging.info('Slice prefetch failed\n{}'.format(e))
+
+    def forget(self, view):
+        with self._lock:
+            self._views.pop(id(view), None)
@@ -3,9 +3,20 @@ import os
 import tempfile
 from PyQt5 import QtCore, Qt
 from scipy import ndimage
-# from scipy.misc import imresize
 from ..common import Orientation, ImageReader
 from vpv.utils.read_minc import minc_to_numpy
+from vpv.utils.native_readers import memmap_image
+from vpv.utils.volume_cache import volume_cache
+from vpv.utils.layout_cache import layout_cache
+from vpv.utils.volume_stats import stats_store
+from vpv.utils.pyramid import VolumePyramid
+
+
+class LoadCancelledError(RuntimeError):
+    """
+    Raised when loading is cancelled by the user via LoadHandle.cancel() or DataModel.cancel_loading()
+    """
+    pass
 
 
 class Volume(Qt.QObject):
@@ -14,6 +25,8 @@ class Volume(Qt.QObject):
     The classes that inherit from this add functionality specific to those volume type
     """
     axial_slice_signal = QtCore.pyqtSignal(str, name='axial_signal')
+    # Distinguishes the stats of differently decoded versions of the same file (see volume_stats)
+    stats_variant = ''
 
     def __init__(self, vol_path: str, model: "vpv_viewer.model.model", datatype: str,  memory_map: bool=False):
         """
@@ -27,6 +40,12 @@ class Volume(Qt.QObject):
         """
         super(Volume, self).__init__()
         self.space = None
+        # The intensity range. Set by _load_data if it is already known from the volume cache
+        self.min = None
+        self.max = None
+        self._stats = None
+        # Downsampled copies for displaying zoomed out views. Built when first needed
+        self._pyramid = None
         self.data_type = datatype
         self.name = None
         self.model = model
@@ -38,11 +57,34 @@ class Volume(Qt.QObject):
         # it in Slices.Layers and possibly others
         self.active = True
         self.int_order = 3
-        self.min = float(self._arr_data.min())
-        self.max = float(self._arr_data.max())
+        # Serve sagittal and coronal planes from contiguous copies made by the layout cache
+        self.use_layout_cache = True
+        if self.min is None:
+            stats = self.stats()
+            self.min, self.max = stats.min, stats.max
         # The coordinate spacing of the input volume
 
 
+    def stats(self, arr=None):
+        """
+        The min, max, largest negative, smallest positive, mean and histogram of the data. Computed in a single pass
+        the first time they are needed, and stored in a sidecar file so they don't need computing when the volume is
+        reopened
+
+        Parameters
+        ----------
+        arr: np.ndarray
+            the data to compute the stats from if it's not loaded into self._arr_data yet
+
+        Returns
+        -------
+        VolumeStats
+        """
+        if self._stats is None:
+            source = self.vol_path if not isinstance(self.vol_path, (list, tuple)) else None
+            self._stats = stats_store.get(source, self._arr_data if arr is None else arr, self.stats_variant)
+        return self._stats
+
     def shape_xyz(self):
         return tuple(reversed(self._arr_data.shape))
 
@@ -52,52 +94,89 @@ class Volume(Qt.QObject):
     def get_axial_slot(self):
         print('get_axial_slot')
 
-    # def pixel_axial(self, z, y, x, flipx, flipz):
-    #     """
-    #     get pixel intensity. due to way pyqtgraph orders the axes, we have to flip the z axis
-    #     """
-    #     try:
-    #         vox = self.get_data(Orientation.axial, z, flipx, flipz, xy=(x, y))
-    #     except TypeError as e:
-    #         print(e.message)
-    #     return vox
-    #
-    # def pixel_sagittal(self, z, y, x, flipx, flipz):
-    #     """
-    #     get pixel intensity. due to way pyqtgraph orders the axes, we have to flip the y axis
-    #     """
-    #     vox = self.get_data(Orientation.sagittal, x, flipx, flipz, xy=(y, z))
-    #     return vox
-    #
-    # def pixel_coronal(self, z, y, x, flipx, flipz):
-    #     """
-    #     get pixel intensity. due to way pyqtgraph orders the axes, we have to flip the y axis
-    #     """
-    #     vox = self.get_data(Orientation.coronal, y, flipx, flipz, xy=(x, z))
-    #     return vox
+    def get_voxel(self, x: int, y: int, z: int):
+        """
+        Get the value of a single voxel by indexing the data directly, without extracting a slice
+
+        Parameters
+        ----------
+        x, y, z
+            volume coordinates
+
+        Returns
+        -------
+        the voxel value
+
+        Raises
+        ------
+        IndexError if the coordinates are outside the volume
+        """
+        if min(x, y, z) < 0:
+            raise IndexError('voxel ({}, {}, {}) is outside the volume'.format(x, y, z))
+        return self._arr_data[z, y, x]
+
+    def get_voxels(self, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> np.ndarray:
+        """
+        Get the values of many voxels at once. See get_voxel
+
+        Parameters
+        ----------
+        x, y, z
+            arrays of volume coordinates
+        """
+        if isinstance(self._arr_data, np.ndarray):
+            return np.asarray(self._arr_data[z, y, x])
+        # Bricked and lazy arrays only support integer and slice indexing. Read the voxels an axial slice at a time,
+        # which also decodes any lazily loaded slices that are not in the background copy yet
+        values = np.empty(len(z), dtype=self._arr_data.dtype)
+        order = np.argsort(z, kind='stable')
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(z[order])) + 1)) if len(z) else []
+        for start, end in zip(starts, np.append(starts[1:], len(z))):
+            voxels = order[start: end]
+            values[voxels] = np.asarray(self._arr_data[int(z[voxels[0]])])[y[voxels], x[voxels]]
+        return values
 
     def intensity_range(self):
         return self.min, self.max
 
     def _load_data(self, path, memmap=False):
         """
-        Open data and convert
+        Open data and convert.
+        Uncompressed nrrd, nifti and MetaImage files are memory mapped directly from disk. Other formats are
+        decoded once and then memory mapped from the volume cache on subsequent loads
         todo: error handling
         :param path:
         :return:
         """
-        ext = os.path.splitext(path)[1].lower()
-        if ext == '.mnc':
-            return minc_to_numpy(path)
+        mapped = memmap_image(path)
+        if mapped is not None:
+            self.space = mapped.direction
+            return mapped.array
 
-        ir = ImageReader(path, memmap=memmap)
-        vol = ir.vol
-        self.space = ir.dir_cos
+        cached = volume_cache.get(path)
+        if cached is not None:
+            vol, meta = cached
+            self.space = meta['direction']
+            self.min, self.max = meta['min'], meta['max']
+            return vol
+
+        ext = os.path.splitext(str(path))[1].lower()
+        if ext == '.mnc':
+            vol = minc_to_numpy(path)
+            if vol is False or isinstance(vol, np.memmap):  # Uncompressed MINC2 is mapped directly from the file
+                return vol
+        else:
+            ir = ImageReader(path, memmap=memmap)
+            vol = ir.vol
+            self.space = ir.dir_cos
         #
         # vol = convert_volume(vol, ir.space)
+        stats = self.stats(vol)
+        self.min, self.max = stats.min, stats.max
+        volume_cache.put_async(path, vol, self.space, self.min, self.max)
         return vol
 
-    def get_data(self, orientation, index=0, flipx=False, flipz=False, flipy=False, xy=None):
+    def get_data(self, orientation, index=0, flipx=False, flipz=False, flipy=False, xy=None, lod=0, region=None):
         """
         Get a 2D slice given the index and orthogonal orientation. Optionally return the slice flipped in x
         if xy specified, return just a single pixel value
@@ -113,6 +192,12 @@ class Volume(Qt.QObject):
         flipz: bool
             Whether to flip in z or not. Z in this case is the order of the slices as they come of the array for
             the given dimension. if flipz == True then  -> index = dimension_len - index
+        lod: int
+            the level of the resolution pyramid to take the slice from (see lod_levels). index is still the full
+            resolution slice index
+        region: tuple
+            (x0, x1, y0, y1). Only return this rectangle of the slice, in the coordinates of the slice that would
+            otherwise be returned (see plane_shape). Only the voxels in the rectangle are read, flipped and copied
 
         Returns
         -------
@@ -122,14 +207,138 @@ class Volume(Qt.QObject):
         Notes
         -----
         get_sagittal, get_axial and get_coronal apply a flip in in x on the 2D slice.
+        Slices come from the model's SliceCache where possible, and are then read-only.
 
         """
+        index = index // 2 ** lod
+        slice_cache = self._slice_cache()
+        if xy is None and slice_cache is not None:
+            key = (orientation, index, flipx, flipz, flipy, lod, region)
+            slice_ = slice_cache.get(self, key)
+            if slice_ is None:
+                slice_ = slice_cache.put(self, key, self._get_plane(orientation, index, flipx, flipz, flipy, lod=lod,
+                                                                    region=region))
+            return slice_
+        return self._get_plane(orientation, index, flipx, flipz, flipy, xy, lod, region)
+
+    def _get_plane(self, orientation, index, flipx, flipz, flipy, xy=None, lod=0, region=None):
         if orientation == Orientation.sagittal:
-            return self._get_sagittal(index, flipx, flipz, flipy, xy=xy)
+            return self._get_sagittal(index, flipx, flipz, flipy, xy=xy, lod=lod, region=region)
         if orientation == Orientation.coronal:
-            return self._get_coronal(index, flipx, flipz, flipy, xy=xy)
+            return self._get_coronal(index, flipx, flipz, flipy, xy=xy, lod=lod, region=region)
         if orientation == Orientation.axial:
-            return self._get_axial(index, flipx, flipz, flipy, xy=xy)
+            return self._get_axial(index, flipx, flipz, flipy, xy=xy, lod=lod, region=region)
+
+    def plane_shape(self, orientation, lod=0) -> tuple:
+        """
+        The shape of the slices returned by get_data for an orientation
+
+        Returns
+        -------
+        tuple
+            (x, y) size of the displayed slice
+        """
+        z, y, x = self.lod_data(lod).shape
+        if orientation == Orientation.sagittal:
+            return y, z
+        if orientation == Orientation.coronal:
+            return x, z
+        return x, y
+
+    @staticmethod
+    def _window(plane_shape, flipx, flipy, region):
+        """
+        Convert a region of a displayed slice into the rows and columns of the unflipped plane it comes from
+
+        Parameters
+        ----------
+        plane_shape: tuple
+            (rows, columns) of the plane as it comes from the array
+        region: tuple
+            (x0, x1, y0, y1) in the displayed slice, which is the plane flipped and transposed
+
+        Returns
+        -------
+        tuple of slices: rows, columns
+        """
+        if region is None:
+            return slice(None), slice(None)
+        rows, cols = plane_shape
+        x0, x1, y0, y1 = region
+        # The plane is flipped left-right unless flipx is set, and upside down if flipy is set
+        cols = slice(x0, x1) if flipx else slice(cols - x1, cols - x0)
+        rows = slice(rows - y1, rows - y0) if flipy else slice(y0, y1)
+        return rows, cols
+
+    def lod_levels(self) -> int:
+        """
+        The number of levels of the resolution pyramid that are available. Level 0 is the full resolution data and
+        level n is 2**n times smaller in each dimension. Calling this starts building the pyramid if needed
+        """
+        if self._pyramid is None:
+            # Lazy virtual stacks and bricked volumes are not plain arrays. Bricked volumes have their own pyramid
+            if not isinstance(self._arr_data, np.ndarray):
+                return 1
+            self._pyramid = VolumePyramid(self._arr_data)
+        return self._pyramid.num_levels()
+
+    def lod_data(self, lod: int):
+        """
+        Get a level of the resolution pyramid
+
+        Returns
+        -------
+        zyx array
+        """
+        if lod == 0:
+            return self._arr_data
+        return self._pyramid.levels[lod]
+
+    def _slice_cache(self):
+        """
+        The model's SliceCache, or None if slices of this volume should not be cached
+        """
+        if self.model is None or not getattr(self.model, 'slice_cache', None) or not self.model.slice_cache.budget:
+            return None
+        # A lazy virtual stack fills in its sagittal and coronal planes as it loads, so don't cache until it's complete
+        if not getattr(self._arr_data, 'complete', True):
+            return None
+        return self.model.slice_cache
+
+    def prefetch_slices(self, orientation, indices, flips, superseded=None, lod=0, region=None):
+        """
+        Load slices into the SliceCache ahead of them being displayed. Called from a SlicePrefetcher worker thread
+
+        Parameters
+        ----------
+        orientation: Orientation
+        indices: list
+            the slices to load in order. Any outside the volume are skipped
+        flips: tuple
+            (flipx, flipz, flipy)
+        superseded: callable
+            returns True if the prefetch is no longer needed
+        lod: int
+            the level of the resolution pyramid the slices are being displayed from
+        region: tuple
+            the region of the slices being displayed, as passed to get_data
+        """
+        slice_cache = self._slice_cache()
+        if slice_cache is None:
+            return
+        dim_len = self.dimension_length(orientation)
+        for index in indices:
+            if superseded and superseded():
+                return
+            if not 0 <= index < dim_len or not self.active:
+                continue
+            key = (orientation, index // 2 ** lod) + tuple(flips) + (lod, region)
+            if slice_cache.contains(self, key):
+                continue
+            try:
+                slice_cache.put(self, key, self._get_plane(orientation, key[1], *flips, lod=lod, region=region))
+            except IndexError:
+                continue
 
     def dimension_length(self, orientation):
         """
@@ -152,10 +361,27 @@ class Volume(Qt.QObject):
         """
         self.voxel_size = size
 
-    def _get_coronal(self, index, flipx, flipz, flipy, xy=None):
+    def _layout(self, orientation):
+        """
+        Get a copy of the data in which planes of the given orientation are contiguous. If it's not available, the
+        layout cache starts building it and None is returned
+
+        Returns
+        -------
+        np.ndarray or None
+        """
+        # Lazy and bricked arrays already read planes without a strided gather over the whole volume
+        if not self.use_layout_cache or not isinstance(self._arr_data, np.ndarray):
+            return None
+        return layout_cache.get(self, self._arr_data, orientation)
+
+    def _get_coronal(self, index, flipx, flipz, flipy, xy=None, lod=0, region=None):
+        arr = self.lod_data(lod)
         if flipz:
-            index = self.shape_xyz()[1] - index
-        slice_ = self._arr_data[:, index, :]
+            index = arr.shape[1] - index
+        rows, cols = self._window((arr.shape[0], arr.shape[2]), flipx, flipy, region)
+        layout = self._layout(Orientation.coronal) if lod == 0 else None
+        slice_ = layout[index, rows, cols] if layout is not None else arr[rows, index, cols]
         if flipy:
             slice_ = np.flipud(slice_)
         if not flipx:
@@ -165,10 +391,13 @@ class Volume(Qt.QObject):
             slice_ = slice_[y, x]
         return slice_.T
 
-    def _get_sagittal(self, index, flipx, flipz, flipy, xy=None):
+    def _get_sagittal(self, index, flipx, flipz, flipy, xy=None, lod=0, region=None):
+        arr = self.lod_data(lod)
         if flipz:
-            index = self.shape_xyz()[0] - index
-        slice_ = self._arr_data[:, :, index]
+            index = arr.shape[2] - index
+        rows, cols = self._window((arr.shape[0], arr.shape[1]), flipx, flipy, region)
+        layout = self._layout(Orientation.sagittal) if lod == 0 else None
+        slice_ = layout[index, rows, cols] if layout is not None else arr[rows, cols, index]
         if flipy:
             slice_ = np.flipud(slice_)
         if not flipx:
@@ -178,10 +407,12 @@ class Volume(Qt.QObject):
             slice_ = slice_[y, x]
         return slice_.T
 
-    def _get_axial(self, index, flipx, flipz, flipy, xy=None):
+    def _get_axial(self, index, flipx, flipz, flipy, xy=None, lod=0, region=None):
+        arr = self.lod_data(lod)
         if flipz:
-            index = self.shape_xyz()[2] - index
-        slice_ = self._arr_data[index, :, :]
+            index = arr.shape[0] - index
+        rows, cols = self._window(arr.shape[1:], flipx, flipy, region)
+        slice_ = arr[index, rows, cols]
         if flipy:
             slice_ = np.flipud(slice_)
         if not flipx:
@@ -199,12 +430,46 @@ class Volume(Qt.QObject):
         self.levels[1] = level
 
     def destroy(self):
+        layout_cache.discard(self)
+        if self._pyramid is not None:
+            self._pyramid.close()
+        if self.model is not None and getattr(self.model, 'slice_cache', None):
+            self.model.slice_cache.discard(self)
         self._arr_data = None
         self.active = False
 
     def set_interpolation(self, state):
         self.interpolate = state
 
-    # def _interpolate(self, slice_):
-    #     return imresize(ndimage.zoom(slice_, 2, order=4), 0.5, interp='bicubic')
-    #     #return ndimage.gaussian_filter(slice_, sigma=0.7, order=0)
+    def get_interpolated(self, orientation, index, flipx, flipz, flipy, region, out_shape):
+        """
+        Get a region of a slice smoothly upsampled, for display when zoomed in. Interpolating even a small region
+        takes long enough that this should be called from a worker thread
+
+        Parameters
+        ----------
+        orientation, index, flipx, flipz, flipy
+            as for get_data
+        region: tuple
+            (x0, x1, y0, y1) of the slice, as for get_data
+        out_shape: tuple
+            the shape to upsample the region to. Normally the size of the region on screen
+
+        Returns
+        -------
+        np.ndarray
+            float32 array of out_shape. From the model's SliceCache if it has been made before
+        """
+        slice_cache = self._slice_cache()
+        key = (orientation, index, flipx, flipz, flipy, 'interpolated', region, tuple(out_shape))
+        if slice_cache is not None:
+            smooth = slice_cache.get(self, key)
+            if smooth is not None:
+                return smooth
+        slice_ = self.get_data(orientation, index, flipx, flipz, flipy, region=region).astype(np.float32)
+        zoom = [out / float(in_) for out, in_ in zip(out_shape, slice_.shape)]
+        # grid_mode keeps the edges of the upsampled image at the edges of the region
+        smooth = ndimage.zoom(slice_, zoom, order=3, mode='nearest', grid_mode=True)
+        if slice_cache is not None:
+            smooth = slice_cache.put(self, key, smooth)
+        return smooth
@@ -0,0 +1,77 @@
+import numpy as np
+import SimpleITK as sitk
+import pytest
+import zipfile
+from vpv.model.BrickedVolume import BrickedVolume
+from vpv.utils import bricked_volume
+from vpv.utils.native_readers import ZipMember
+
+
+@pytest.fixture
+def bricked(tmp_path):
+    arr = np.random.RandomState(0).randint(0, 1000, size=(37, 50, 21)).astype(np.int16)
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing((14.0, 14.0, 28.0))
+    img.SetDirection((-1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 1.0))
+    path = str(tmp_path / 'test.nrrd')
+    sitk.WriteImage(img, path)
+    out = str(tmp_path / 'test.vpvb')
+    bricked_volume.convert_to_bricked(path, out, brick_size=16)
+    return arr, img, bricked_volume.BrickedImage(out)
+
+
+def test_header(bricked):
+    arr, img, image = bricked
+    assert image.levels[0].shape == arr.shape
+    assert image.levels[0].dtype == arr.dtype
+    assert (image.min, image.max) == (arr.min(), arr.max())
+    assert np.allclose(image.direction, img.GetDirection())
+    assert np.allclose(image.spacing, img.GetSpacing())
+    assert [level.shape for level in image.levels] == [(37, 50, 21), (19, 25, 11), (10, 13, 6)]
+
+
+@pytest.mark.parametrize('key', [
+    (5, slice(None), slice(None)),
+    (slice(None), 49, slice(None)),
+    (slice(None), slice(None), -1),
+    (slice(3, 30), slice(17, 18), slice(None, None, 3)),
+    (slice(None), 16, 15),
+])
+def test_indexing_matches_array(bricked, key):
+    arr, _, image = bricked
+    assert np.array_equal(image.levels[0][key], arr[key])
+
+
+def test_pyramid_level(bricked):
+    arr, _, image = bricked
+    padded = np.pad(arr.astype(np.float64), [(0, 1), (0, 0), (0, 1)], mode='edge')
+    expected = np.rint(padded.reshape(19, 2, 25, 2, 11, 2).mean(axis=(1, 3, 5))).astype(arr.dtype)
+    assert np.array_equal(image.levels[1][:, :, :], expected)
+
+
+def test_spacing_from_zip_member(tmp_path):
+    arr = np.arange(8 * 9 * 10, dtype=np.uint8).reshape(8, 9, 10)
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing((14.0, 14.0, 28.0))
+    path = str(tmp_path / 'test.nrrd')
+    sitk.WriteImage(img, path)
+    zip_path = str(tmp_path / 'analysis.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.write(path, 'test.nrrd')
+
+    out = str(tmp_path / 'test.vpvb')
+    bricked_volume.convert_to_bricked(ZipMember(zip_path, 'test.nrrd'), out, brick_size=16)
+    image = bricked_volume.BrickedImage(out)
+    assert np.allclose(image.spacing, img.GetSpacing())
+    assert np.array_equal(image.levels[0][:, :, :], arr)
+
+
+def test_get_voxels(tmp_path):
+    arr = np.random.RandomState(0).randint(0, 1000, size=(20, 18, 21)).astype(np.int16)
+    path = str(tmp_path / 'test.nrrd')
+    sitk.WriteImage(sitk.GetImageFromArray(arr), path)
+    out = str(tmp_path / 'test.vpvb')
+    bricked_volume.convert_to_bricked(path, out, brick_size=16)
+    vol = BrickedVolume(out, None, 'volume')
+    z, y, x = (np.random.RandomState(1).randint(0, n, 50) for n in arr.shape)
+    assert np.array_equal(vol.get_voxels(x, y, z), arr[z, y, x])
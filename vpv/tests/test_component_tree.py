@@ -0,0 +1,47 @@
+import numpy as np
+from scipy import ndimage
+from vpv.utils.component_tree import HeatmapComponentTrees
+
+
+def _labelled_clusters(arr, atlas, negative_threshold, positive_threshold):
+    clusters = []
+    for mask in (arr > positive_threshold, arr < negative_threshold):
+        labels, num = ndimage.label(mask)
+        index = np.arange(1, num + 1)
+        sizes = np.bincount(labels.ravel())[1:]
+        sums = ndimage.sum(arr.astype(np.float64), labels, index)
+        peaks = ndimage.maximum(np.abs(arr), labels, index)
+        centroids = ndimage.center_of_mass(mask, labels, index)
+        for i, (z, y, x) in enumerate(ndimage.find_objects(labels)):
+            majority = np.bincount(atlas[labels == i + 1]).argmax()
+            clusters.append((int(sizes[i]), round(sums[i] / sizes[i], 4), round(sums[i], 3), round(float(peaks[i]), 4),
+                             tuple(round(c, 4) for c in centroids[i][::-1]),
+                             (x.start, x.stop - 1, y.start, y.stop - 1, z.start, z.stop - 1), int(majority)))
+    return sorted(clusters)
+
+
+def test_cluster_statistics_match_labelling():
+    arr = (ndimage.gaussian_filter(np.random.RandomState(0).randn(20, 24, 28), 1.5) * 10).astype(np.float16)
+    atlas = np.random.RandomState(1).randint(0, 3, arr.shape)
+    trees = HeatmapComponentTrees(arr)
+    trees.wait()
+    for t in (0.0, 0.5, 1.3, 2.0):
+        table = trees.cluster_statistics(-t, t, min_size=1, voxel_volume=2.0, atlas=lambda x, y, z: atlas[z, y, x])
+        assert list(table['size']) == sorted(table['size'], reverse=True)
+        assert np.allclose(table['volume'], table['size'] * 2.0)
+        clusters = [(r.size, round(r.mean, 4), round(r.sum, 3), round(r.peak, 4),
+                     (round(r.centroid_x, 4), round(r.centroid_y, 4), round(r.centroid_z, 4)),
+                     (r.x0, r.x1, r.y0, r.y1, r.z0, r.z1), r.label) for r in table.itertuples()]
+        assert sorted(clusters) == _labelled_clusters(arr.astype(np.float32), atlas, -t, t)
+
+
+def test_cluster_statistics_async_computes_latest():
+    arr = (ndimage.gaussian_filter(np.random.RandomState(0).randn(20, 24, 28), 1.5) * 10).astype(np.float16)
+    trees = HeatmapComponentTrees(arr)
+    trees.wait()
+    results = []
+    for t in (0.5, 1.0, 1.3):
+        trees.cluster_statistics_async(lambda table, t=t: results.append((t, table)), -t, t)
+    trees.wait()
+    assert results[-1][0] == 1.3
+    assert results[-1][1].equals(trees.cluster_statistics(-1.3, 1.3))
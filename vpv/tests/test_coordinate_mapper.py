@@ -0,0 +1,54 @@
+import itertools
+import numpy as np
+from vpv.common import Orientation
+from vpv.model.coordinate_mapper import Coordinate_mapper, flip_to_axial_order, flip_from_axial_order
+
+
+def _reorder(order, values):
+    return [j for _, j in sorted(zip(order, values), key=lambda pair: pair[0])]
+
+
+def _flip(point, flips, dims):
+    x, y, z = point
+    if flips['y']:
+        y = dims[1] - y
+    if not flips['x']:
+        x = dims[0] - x
+    if flips['z']:
+        z = dims[2] - z
+    return [x, y, z]
+
+
+def test_transforms_match_per_point_mapping():
+    dims = (30, 40, 50)
+    point = (3, 7, 11)
+    for flip_values in itertools.product([False, True], repeat=9):
+        flip_info = {ori.name: dict(zip('xyz', flip_values[i * 3: i * 3 + 3])) for i, ori in enumerate(Orientation)}
+        mapper = Coordinate_mapper({}, flip_info)
+        for src, dest in itertools.product(Orientation, repeat=2):
+            src_point = _flip(point, flip_info[src.name], _reorder(flip_from_axial_order[src], dims))
+            volume_point = _reorder(flip_to_axial_order[src], src_point)
+            assert mapper.view_to_volume(*point, src, dims) == tuple(volume_point)
+
+            dest_point = _flip(_reorder(flip_from_axial_order[dest], volume_point), flip_info[dest.name],
+                               _reorder(flip_from_axial_order[dest], dims))
+            assert mapper.view_to_view(*point, src, dest, dims) == dest_point
+
+            points = np.array([point, (0, 0, 0), (29, 39, 49)])
+            batch = mapper.view_to_view_points(points, src, dest, dims)
+            assert np.array_equal(batch[0], dest_point)
+
+        dests = list(Orientation) * 2
+        for src in Orientation:
+            expected = [mapper.view_to_view(*point, src, dest, dims) for dest in dests]
+            assert mapper.view_to_views(*point, src, dests, dims).tolist() == expected
+
+
+def test_flips_changed():
+    flip_info = {ori.name: {'x': False, 'y': False, 'z': False} for ori in Orientation}
+    mapper = Coordinate_mapper({}, flip_info)
+    dims = (30, 40, 50)
+    assert mapper.view_to_volume(3, 7, 11, Orientation.axial, dims) == (27, 7, 11)
+    flip_info['axial']['x'] = True
+    mapper.flips_changed()
+    assert mapper.view_to_volume(3, 7, 11, Orientation.axial, dims) == (3, 7, 11)
@@ -0,0 +1,22 @@
+import numpy as np
+import SimpleITK as sitk
+from vpv.common import Orientation
+from vpv.model.ImageSeriesVolume import ImageSeriesVolume
+from vpv.utils.layout_cache import layout_cache
+
+
+def test_set_image_sagittal(tmp_path):
+    arrays = [np.random.RandomState(i).randint(0, 100, size=(6, 7, 8)).astype(np.int16) for i in range(2)]
+    paths = []
+    for i, arr in enumerate(arrays):
+        paths.append(str(tmp_path / '{}.nrrd'.format(i)))
+        sitk.WriteImage(sitk.GetImageFromArray(arr), paths[-1])
+    vol = ImageSeriesVolume(paths, None, 'volume')
+
+    for i, arr in enumerate(arrays):
+        vol.set_image(i)
+        vol.get_data(Orientation.sagittal, 3)
+        layout_cache.wait()  # The next slice comes from the contiguous copy
+        slice_ = vol.get_data(Orientation.sagittal, 3, flipx=True)
+        assert vol._layout(Orientation.sagittal) is not None
+        assert np.array_equal(slice_, arr[:, :, 3].T)
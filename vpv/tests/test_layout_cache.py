@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from vpv.common import Orientation
+from vpv.utils.layout_cache import LayoutCache
+
+
+class Owner(object):
+    pass
+
+
+@pytest.fixture
+def arr():
+    return np.arange(6 * 7 * 8, dtype=np.int16).reshape((6, 7, 8))
+
+
+@pytest.mark.parametrize('orientation, take', [
+    (Orientation.sagittal, lambda a, i: a[:, :, i]),
+    (Orientation.coronal, lambda a, i: a[:, i, :])
+])
+def test_layout_planes(arr, orientation, take):
+    cache = LayoutCache()
+    owner = Owner()
+    assert cache.get(owner, arr, orientation) is None  # Built in the background
+    cache.wait()
+    layout = cache.get(owner, arr, orientation)
+    assert layout.flags.c_contiguous
+    for i in range(layout.shape[0]):
+        assert np.array_equal(layout[i], take(arr, i))
+
+
+def test_axial_not_copied(arr):
+    cache = LayoutCache()
+    cache.get(Owner(), arr, Orientation.axial)
+    cache.wait()
+    assert cache.size() == 0
+
+
+def test_budget_evicts_least_recently_used(arr):
+    cache = LayoutCache(budget=arr.nbytes * 2)
+    owners = [Owner() for _ in range(3)]
+    for owner in owners:
+        cache.get(owner, arr, Orientation.sagittal)
+        cache.wait()
+    assert cache.size() == arr.nbytes * 2
+    assert cache.get(owners[0], arr, Orientation.sagittal) is None
+    assert cache.get(owners[2], arr, Orientation.sagittal) is not None
+
+
+def test_discard(arr):
+    cache = LayoutCache()
+    owner = Owner()
+    cache.get(owner, arr, Orientation.coronal)
+    cache.wait()
+    cache.discard(owner)
+    assert cache.size() == 0
@@ -0,0 +1,44 @@
+import numpy as np
+from pyqtgraph import functions as fn
+import pytest
+from vpv.utils.lookup_tables import Lut, diverging_lut, label_filter_lut
+
+
+@pytest.mark.parametrize('lut_name', ['hot_red_blue', 'hot_all'])
+def test_diverging_lut_matches_split_luts(lut_name):
+    positive_lut, negative_lut = Lut().get_lut(lut_name)
+    neg_levels, pos_levels = [-8.0, -3.0], [3.0, 9.0]
+    data = np.random.RandomState(0).uniform(-10, 10, (50, 50)).astype(np.float32)
+
+    # How the heatmap was displayed before: separate negative and positive images
+    neg = np.where(data < 0, data, 0)
+    pos = np.where(data > 0, data, 0)
+    neg_rgba, _ = fn.makeARGB(neg, lut=negative_lut.astype(np.ubyte), levels=neg_levels)
+    pos_rgba, _ = fn.makeARGB(pos, lut=positive_lut.astype(np.ubyte), levels=pos_levels)
+    expected = np.where(pos_rgba[..., 3:] > 0, pos_rgba, neg_rgba)
+
+    lut, levels = diverging_lut(negative_lut, positive_lut, neg_levels, pos_levels)
+    rgba, _ = fn.makeARGB(data, lut=lut, levels=levels)
+
+    visible = (expected[..., 3] > 0) | (rgba[..., 3] > 0)
+    assert np.abs(rgba[visible].astype(int) - expected[visible]).max() <= 4
+    # Values between the thresholds are transparent
+    assert (rgba[(data > -3) & (data < 3), 3] == 0).all()
+
+
+@pytest.mark.parametrize('levels', [[0, 20], [3.5, 12]])
+def test_label_filter_lut_matches_masking(levels):
+    lut = Lut().anatomy_lut[:21]
+    labels = np.random.RandomState(0).randint(0, 21, (40, 40)).astype(np.uint8)
+    show = [2, 5, 17]
+
+    # How labels were filtered before: mask the slice
+    masked = labels.copy()
+    masked[~np.isin(masked, show)] = 0
+    expected, _ = fn.makeARGB(masked, lut=lut, levels=levels)
+
+    filtered_lut, filtered_levels = label_filter_lut(lut, levels, (0, 20), show)
+    rgba, _ = fn.makeARGB(labels, lut=filtered_lut, levels=filtered_levels)
+
+    visible = (expected[..., 3] > 0) | (rgba[..., 3] > 0)
+    assert np.array_equal(rgba[visible], expected[visible])
@@ -0,0 +1,85 @@
+import gzip
+import shutil
+import zipfile
+import numpy as np
+import SimpleITK as sitk
+import pytest
+from vpv.utils import native_readers
+
+
+def _test_image(dtype=np.int16):
+    arr = np.arange(4 * 5 * 6, dtype=dtype).reshape((4, 5, 6))
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing((14.0, 14.0, 28.0))
+    img.SetDirection((-1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 1.0))
+    return arr, img
+
+
+@pytest.mark.parametrize('ext', ['.nrrd', '.nii', '.mhd', '.mha'])
+@pytest.mark.parametrize('dtype', [np.uint8, np.int16, np.float32])
+def test_memmap_matches_sitk(tmp_path, ext, dtype):
+    arr, img = _test_image(dtype)
+    path = str(tmp_path / ('test' + ext))
+    sitk.WriteImage(img, path, useCompression=False)
+
+    mapped = native_readers.memmap_image(path)
+    assert isinstance(mapped.array, np.memmap)
+    assert mapped.array.shape == arr.shape
+    assert np.array_equal(mapped.array, arr)
+    assert np.allclose(mapped.direction, sitk.ReadImage(path).GetDirection())
+    assert np.allclose(mapped.spacing, img.GetSpacing())
+
+
+def test_compressed_falls_back(tmp_path):
+    _, img = _test_image()
+    path = str(tmp_path / 'test.nrrd')
+    sitk.WriteImage(img, path, useCompression=True)
+    assert native_readers.memmap_image(path) is None
+
+
+def test_unsupported_extension(tmp_path):
+    assert native_readers.memmap_image(str(tmp_path / 'test.tif')) is None
+
+
+@pytest.mark.parametrize('memmap', [False, True])
+@pytest.mark.parametrize('name', ['test.nrrd', 'test.nrrd.gz', 'test.nii.gz'])
+def test_decompress_matches_sitk(tmp_path, name, memmap):
+    arr, img = _test_image(np.float32)
+    path = str(tmp_path / name)
+    if name.endswith('.nrrd.gz'):
+        raw_path = str(tmp_path / 'raw.nrrd')
+        sitk.WriteImage(img, raw_path, useCompression=False)
+        with open(raw_path, 'rb') as src, gzip.open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    else:
+        sitk.WriteImage(img, path, useCompression=True)
+
+    decompressed = native_readers.decompress_image(path, memmap)
+    assert isinstance(decompressed.array, np.memmap) == memmap
+    assert np.array_equal(decompressed.array, arr)
+    assert np.allclose(decompressed.direction, img.GetDirection())
+
+
+def test_decompress_skips_raw_nrrd(tmp_path):
+    _, img = _test_image()
+    path = str(tmp_path / 'test.nrrd')
+    sitk.WriteImage(img, path, useCompression=False)
+    assert native_readers.decompress_image(path) is None
+
+
+@pytest.mark.parametrize('name', ['test.nrrd', 'test.nii', 'test.nii.gz', 'test.mhd'])
+def test_read_zip_member(tmp_path, name):
+    arr, img = _test_image(np.float32)
+    path = str(tmp_path / name)
+    sitk.WriteImage(img, path, useCompression=name.endswith('.gz'))
+    zip_path = str(tmp_path / 'analysis.zip')
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.write(path, 'results/' + name)
+
+    member = native_readers.ZipMember(zip_path, 'results/' + name)
+    image = native_readers.read_zip_member(member)
+    if name.endswith('.mhd'):  # Detached data file. Needs extracting
+        assert image is None
+    else:
+        assert np.array_equal(image.array, arr)
+        assert np.allclose(image.direction, img.GetDirection())
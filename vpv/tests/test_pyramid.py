@@ -0,0 +1,39 @@
+import numpy as np
+from vpv.utils.pyramid import PyramidMemory, VolumePyramid, downsample, level_shapes
+
+
+def test_pyramid_levels():
+    arr = np.random.RandomState(0).randint(0, 255, (37, 50, 21)).astype(np.uint8)
+    pyramid = VolumePyramid(arr, min_size=8)
+    pyramid.wait()
+    shapes = level_shapes(arr.shape, 8)
+    assert pyramid.num_levels() == len(shapes)
+    assert [level.shape for level in pyramid.levels] == shapes
+    assert pyramid.levels[0] is arr
+    assert np.array_equal(pyramid.levels[1], downsample(arr, arr.dtype))
+    assert np.array_equal(pyramid.levels[2], downsample(pyramid.levels[1], arr.dtype))
+
+
+def test_downsample_averages():
+    block = np.arange(8, dtype=np.float32).reshape((2, 2, 2))
+    assert downsample(block, block.dtype).ravel().tolist() == [3.5]
+
+
+def test_memory_budget():
+    arr = np.random.RandomState(0).randint(0, 255, (64, 64, 64)).astype(np.uint8)
+    level_bytes = 32 ** 3
+    memory = PyramidMemory(budget=level_bytes)
+    first = VolumePyramid(arr, min_size=32, memory=memory)
+    first.wait()
+    assert not isinstance(first.levels[1], np.memmap)
+    assert memory.used() == level_bytes
+
+    # No room left in the budget, so the level is memory mapped
+    second = VolumePyramid(arr, min_size=32, memory=memory)
+    second.wait()
+    assert isinstance(second.levels[1], np.memmap)
+    assert np.array_equal(second.levels[1], first.levels[1])
+
+    first.close()
+    assert memory.used() == 0
+    assert first.num_levels() == 1
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from vpv.utils import read_minc
+
+h5py = pytest.importorskip('h5py')
+
+
+def _write_minc2(path, arr, compression=None, image_range=None):
+    """
+    Write a minimal MINC2 file with a zyx image and the xyz dimension variables
+    """
+    with h5py.File(path, 'w') as f:
+        image = f.create_dataset(read_minc.MINC2_IMAGE, data=arr, compression=compression)
+        image.attrs['dimorder'] = b'zspace,yspace,xspace'
+        for name, step in zip(('xspace', 'yspace', 'zspace'), (0.014, 0.014, 0.028)):
+            dim = f.create_dataset('{}/{}'.format(read_minc.MINC2_DIMENSIONS, name), data=0)
+            dim.attrs['step'] = step
+        if image_range is not None:
+            image.attrs['valid_range'] = (0, 255)
+            for name, value in zip(('image-min', 'image-max'), image_range):
+                ds = f.create_dataset('/minc-2.0/image/0/{}'.format(name), data=np.full(arr.shape[0], value))
+                ds.attrs['dimorder'] = b'zspace'
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_read_minc2(tmp_path, compression):
+    arr = np.arange(4 * 5 * 6, dtype=np.int16).reshape((4, 5, 6))
+    path = str(tmp_path / 'test.mnc')
+    _write_minc2(path, arr, compression)
+
+    image = read_minc.read_minc2(path)
+    assert isinstance(image.array, np.memmap) == (compression is None)
+    assert np.array_equal(image.array, arr)
+    assert np.allclose(image.spacing, (0.014, 0.014, 0.028))
+    assert np.array_equal(read_minc.minc_to_numpy(path), arr)
+
+
+def test_mincstats_real_values(tmp_path):
+    arr = np.array([0, 255], dtype=np.uint8).reshape((2, 1, 1))
+    path = str(tmp_path / 'stats.mnc')
+    _write_minc2(path, arr, image_range=(-2.0, 3.0))
+    assert np.allclose(read_minc.mincstats_to_numpy(path).ravel(), [-2.0, 3.0])
@@ -0,0 +1,63 @@
+import time
+from PyQt5 import QtWidgets
+from vpv.display.render_scheduler import RenderScheduler, FrameThrottle
+
+app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+class FakeView(object):
+    def __init__(self, log):
+        self.current_slice_idx = 0
+        self.log = log
+
+    def set_slice(self, index, crosshair_xy=None):
+        self.current_slice_idx = index
+        self.log.append((self, index))
+
+    def set_crosshair(self, x, y):
+        self.log.append((self, 'crosshair'))
+
+
+def test_only_latest_request_applied_focused_first():
+    log = []
+    views = [FakeView(log) for _ in range(3)]
+    scheduler = RenderScheduler()
+    scheduler.focused = views[2]
+    for index in range(1, 20):
+        for view in views:
+            scheduler.request_slice(view, index, (1, 1))
+    assert log == []
+    scheduler.flush()
+    assert log == [(views[2], 19), (views[0], 19), (views[1], 19)]
+
+    # Same slice again only moves the cross hair
+    scheduler.request_slice(views[0], 19, (2, 2))
+    scheduler.flush()
+    assert log[-1] == (views[0], 'crosshair')
+
+
+def test_cancel_drops_request():
+    log = []
+    views = [FakeView(log) for _ in range(2)]
+    scheduler = RenderScheduler()
+    for view in views:
+        scheduler.request_slice(view, 5)
+    scheduler.cancel(views[0])
+    scheduler.flush()
+    assert log == [(views[1], 5)]
+
+
+def test_mouse_move_burst_gives_one_readout():
+    readouts = []
+    throttle = FrameThrottle(lambda *args: readouts.append(args))
+    for x in range(100):
+        throttle(x, 2 * x, 5, 'view')
+    assert readouts == []
+    deadline = time.time() + 5
+    while not readouts:  # The frame timer fires from the event loop
+        assert time.time() < deadline, 'throttled call was not made'
+        app.processEvents()
+        time.sleep(0.005)
+    time.sleep(0.05)
+    app.processEvents()
+    assert readouts == [(99, 198, 5, 'view')]
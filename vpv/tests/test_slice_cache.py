@@ -0,0 +1,54 @@
+import numpy as np
+from vpv.common import Orientation
+from vpv.model import slice_cache
+from vpv.model.slice_cache import SliceCache, SlicePrefetcher
+
+
+class FakeVolume(object):
+    def __init__(self):
+        self.prefetched = []
+
+    def prefetch_slices(self, orientation, indices, flips, superseded=None, lod=0, region=None):
+        self.prefetched.append(indices)
+
+
+def test_cached_slices_are_read_only_copies():
+    cache = SliceCache()
+    vol = FakeVolume()
+    arr = np.arange(12).reshape((3, 4))
+    key = (Orientation.axial, 0, False, False, False)
+    cached = cache.put(vol, key, arr.T)
+    assert cache.get(vol, key) is cached
+    assert not cached.flags.writeable and cached.flags.c_contiguous
+    assert np.array_equal(cached, arr.T)
+    assert not np.shares_memory(cached, arr)
+
+
+def test_lru_eviction():
+    slice_ = np.zeros((10, 10), dtype=np.uint8)
+    cache = SliceCache(budget=slice_.nbytes * 2)
+    vol = FakeVolume()
+    keys = [(Orientation.axial, i, False, False, False) for i in range(3)]
+    cache.put(vol, keys[0], slice_)
+    cache.put(vol, keys[1], slice_)
+    cache.get(vol, keys[0])
+    cache.put(vol, keys[2], slice_)
+    assert cache.get(vol, keys[1]) is None
+    assert cache.get(vol, keys[0]) is not None
+    assert cache.size() == slice_.nbytes * 2
+    cache.discard(vol)
+    assert cache.size() == 0
+
+
+def test_prefetch_follows_scroll_direction():
+    prefetcher = SlicePrefetcher(SliceCache())
+    vol = FakeVolume()
+    view = object()
+    flips = (False, False, False)
+    prefetcher.slice_changed(view, vol, Orientation.axial, 50, flips)
+    prefetcher.slice_changed(view, vol, Orientation.axial, 49, flips)
+    prefetcher._pool.shutdown(wait=True)
+    assert len(vol.prefetched) == 1
+    indices = vol.prefetched[0]
+    assert indices[:2] == [48, 47]
+    assert slice_cache.PREFETCH_MIN <= len(indices) <= slice_cache.PREFETCH_MAX
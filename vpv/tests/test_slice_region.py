@@ -0,0 +1,33 @@
+import itertools
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from vpv.common import Orientation
+from vpv.model.ImageVolume import ImageVolume
+
+
+@pytest.mark.parametrize('orientation', list(Orientation))
+def test_region_matches_full_slice(tmp_path, orientation):
+    path = str(tmp_path / 'vol.nrrd')
+    sitk.WriteImage(sitk.GetImageFromArray(np.random.RandomState(0).randint(0, 255, (20, 24, 28)).astype(np.uint8)),
+                    path)
+    vol = ImageVolume(path, None, 'volume')
+    width, height = vol.plane_shape(orientation)
+    region = (3, width // 2, 5, height - 2)
+    for flips in itertools.product([False, True], repeat=3):
+        full = vol.get_data(orientation, 10, *flips)
+        assert full.shape == (width, height)
+        cropped = vol.get_data(orientation, 10, *flips, region=region)
+        assert np.array_equal(cropped, full[region[0]: region[1], region[2]: region[3]])
+
+
+def test_interpolated_region(tmp_path):
+    path = str(tmp_path / 'vol.nrrd')
+    arr = np.tile(np.arange(28, dtype=np.float32), (20, 24, 1))  # A ramp in x
+    sitk.WriteImage(sitk.GetImageFromArray(arr), path)
+    vol = ImageVolume(path, None, 'volume')
+    region = (4, 12, 2, 10)
+    smooth = vol.get_interpolated(Orientation.axial, 10, True, False, False, region, (32, 32))
+    assert smooth.shape == (32, 32)
+    # The ramp is linear so the upsampled values lie along it, within the region
+    assert np.allclose(smooth[:, 0], np.linspace(4, 11, 32), atol=0.5)
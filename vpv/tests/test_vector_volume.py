@@ -0,0 +1,30 @@
+import time
+import numpy as np
+import SimpleITK as sitk
+from vpv.common import Orientation
+from vpv.model import VectorVolume as vector_volume
+from vpv.model.VectorVolume import VectorVolume
+from vpv.utils.volume_cache import VolumeCache
+
+
+def test_block_means(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_volume, 'volume_cache', VolumeCache(str(tmp_path / 'cache')))
+    path = str(tmp_path / 'def.nrrd')
+    arr = np.random.RandomState(0).normal(size=(12, 14, 16, 3))
+    sitk.WriteImage(sitk.GetImageFromArray(arr, isVector=True), path)
+    vol = VectorVolume(path, None, 'vector')
+    assert vol._arr_data.dtype == np.float16
+
+    c, axes = 3, (0, 2)
+    slice_ = vol.get_coronal(5).take(axes, axis=2).astype(np.float32)
+    expected = slice_[:9, :15].reshape(3, 3, 5, 3, 2).mean(axis=(1, 3))
+
+    means, magnitudes = vol.block_means(Orientation.coronal, 5, c, axes)
+    assert np.allclose(means, expected)
+    deadline = time.time() + 10
+    while (Orientation.coronal, c, axes) not in vol._block_fields:  # Built in the background
+        assert time.time() < deadline, 'block averaged field was not built'
+        time.sleep(0.01)
+    means, magnitudes = vol.block_means(Orientation.coronal, 5, c, axes)
+    assert np.allclose(means, expected, atol=1e-3)
+    assert np.allclose(magnitudes, np.hypot(expected[..., 0], expected[..., 1]), atol=1e-3)
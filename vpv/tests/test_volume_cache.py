@@ -0,0 +1,52 @@
+import os
+import numpy as np
+from vpv.utils.volume_cache import VolumeCache
+
+
+def _source(tmp_path, name='vol.nrrd.gz', content=b'compressed'):
+    path = str(tmp_path / name)
+    with open(path, 'wb') as fh:
+        fh.write(content)
+    return path
+
+
+def test_hit_returns_memmap(tmp_path):
+    cache = VolumeCache(str(tmp_path / 'cache'))
+    source = _source(tmp_path)
+    arr = np.arange(60, dtype=np.int16).reshape((3, 4, 5))
+    direction = (-1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 1.0)
+
+    assert cache.get(source) is None
+    cache.put(source, arr, direction)
+    cached, meta = cache.get(source)
+    assert isinstance(cached, np.memmap)
+    assert np.array_equal(cached, arr)
+    assert meta['direction'] == list(direction)
+    assert (meta['min'], meta['max']) == (0, 59)
+    assert cache.get(source, variant='float16') is None
+
+
+def test_invalidated_when_source_changes(tmp_path):
+    cache = VolumeCache(str(tmp_path / 'cache'))
+    source = _source(tmp_path)
+    cache.put(source, np.zeros((2, 2, 2)))
+    _source(tmp_path, content=b'recompressed')
+    assert cache.get(source) is None
+    assert cache.size() == 0
+
+
+def test_lru_eviction(tmp_path):
+    arr = np.zeros((10, 10, 10), dtype=np.uint8)
+    cache = VolumeCache(str(tmp_path / 'cache'), budget=2 * arr.nbytes + 256)
+    sources = [_source(tmp_path, name) for name in ('a.mnc', 'b.mnc', 'c.mnc')]
+
+    cache.put(sources[0], arr)
+    cache.put(sources[1], arr)
+    # Make 'a' the most recently used
+    os.utime(cache._entry_paths(sources[1], '')[1], (0, 0))
+    assert cache.get(sources[0]) is not None
+    cache.put(sources[2], arr)
+
+    assert cache.get(sources[0]) is not None
+    assert cache.get(sources[1]) is None
+    assert cache.get(sources[2]) is not None
@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import pytest
+from vpv.utils import volume_stats
+from vpv.utils.volume_stats import StatsStore, compute_stats
+
+
+@pytest.mark.parametrize('arr', [
+    np.random.RandomState(0).normal(size=(30, 20, 10)).astype(np.float16),
+    np.random.RandomState(0).randint(0, 200, size=(30, 20, 10)).astype(np.uint8),
+    np.random.RandomState(0).randint(-3000, 3000, size=(30, 20, 10)).astype(np.int16)
+])
+def test_compute_stats_matches_numpy(monkeypatch, arr):
+    monkeypatch.setattr(volume_stats, 'SLAB_BYTES', arr[0].nbytes * 4)  # Several slabs
+    stats = compute_stats(arr)
+    assert stats.min == arr.min() and stats.max == arr.max()
+    assert stats.neg_max == (arr[arr < 0].max() if (arr < 0).any() else None)
+    assert stats.pos_min == arr[arr > 0].min()
+    assert np.isclose(stats.mean, arr.mean(dtype=np.float64))
+    assert stats.histogram.sum() == arr.size
+    if arr.dtype.kind != 'f':  # Integer slab histograms are exact
+        expected = np.histogram(arr, bins=volume_stats.NUM_BINS, range=(arr.min(), arr.max()))[0]
+        assert np.array_equal(stats.histogram, expected)
+
+
+def test_sidecar_reused(tmp_path):
+    source = tmp_path / 'test.nrrd'
+    source.write_bytes(b'image')
+    arr = np.arange(-5, 55, dtype=np.float32).reshape((3, 4, 5))
+
+    stats = StatsStore(str(tmp_path / 'stats')).get(str(source), arr)
+    assert os.path.isfile(str(source) + volume_stats.SIDECAR_EXT)
+
+    # A new store (eg after restarting) reads the sidecar without any data
+    reopened = StatsStore(str(tmp_path / 'stats')).get(str(source), None)
+    assert reopened.to_dict() == stats.to_dict()
+
+    # Changing the source invalidates the stats
+    source.write_bytes(b'changed image')
+    assert StatsStore(str(tmp_path / 'stats')).get(str(source), None) is None
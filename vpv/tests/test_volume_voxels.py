@@ -0,0 +1,38 @@
+import itertools
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from vpv.common import Orientation
+from vpv.model.ImageVolume import ImageVolume
+from vpv.model.coordinate_mapper import Coordinate_mapper, flip_from_axial_order
+
+
+def _reorder(order, values):
+    return [j for _, j in sorted(zip(order, values), key=lambda pair: pair[0])]
+
+
+def test_get_voxel_matches_axial_pixel_lookup(tmp_path):
+    """
+    The hover readout used to read a voxel with get_data(Orientation.axial, z, xy=(shape_x - x, y)), x counting from 1
+    """
+    path = str(tmp_path / 'vol.nrrd')
+    sitk.WriteImage(sitk.GetImageFromArray(np.random.RandomState(0).randint(0, 255, (6, 7, 8)).astype(np.uint8)), path)
+    vol = ImageVolume(path, None, 'volume')
+    dims = vol.shape_xyz()
+    checked = 0
+    for flip_values in itertools.product([False, True], repeat=3):
+        for orientation in Orientation:
+            flip_info = {ori.name: dict(zip('xyz', flip_values)) for ori in Orientation}
+            mapper = Coordinate_mapper({}, flip_info)
+            view_dims = _reorder(flip_from_axial_order[orientation], dims)
+            for point in itertools.product(*(range(d + 1) for d in view_dims)):
+                x, y, z = mapper.view_to_volume(*point, orientation, dims)
+                try:
+                    expected = vol.get_data(Orientation.axial, z, xy=(dims[0] - x, y))
+                except IndexError:
+                    with pytest.raises(IndexError):
+                        vol.get_voxel(x - 1, y, z)
+                else:
+                    assert vol.get_voxel(x - 1, y, z) == expected
+                    checked += 1
+    assert checked >= 8 * 3 * 6 * 7 * 8  # Every voxel is read from each view and flip
@@ -18,6 +18,9 @@ dock widget
 """
 
 DEFAULT_SCALE_BAR_SIZE = 14.0
+BLOB_TABLE_DELAY_MS = 100  # Wait this long after the thresholds last changed before refreshing the blob table
+BLOB_TABLE_HEADERS = ['Count', 'Volume (mm³)', 'Mean', 'Sum', 'Peak |t|', 'Centroid x, y, z', 'Atlas label',
+                      'location x:x, y:y, z:z']
 
 
 class VolNameDialog(QDialog):
@@ -66,6 +69,8 @@ class ManageData(QWidget):
 
         self.model = model
         self.volume_ids = None
+        # Layers -> id of a volume chosen for that layer that is still loading in the background
+        self._pending_volumes = {}
         self.luts = Lut()
 
         self.ui.labelFdrThresholds.hide()
@@ -113,8 +118,18 @@ class ManageData(QWidget):
         self.blob_table = QTableWidget(self)
         self.ui.verticalLayoutConnectedComponents.addWidget(self.blob_table, 0)
 
-        self.blob_table.setColumnCount(3)
-        self.blob_table.setHorizontalHeaderLabels(['Count', 'Mean', 'location'])
+        self.blob_table.setColumnCount(len(BLOB_TABLE_HEADERS))
+        self.blob_table.setHorizontalHeaderLabels(BLOB_TABLE_HEADERS)
+        self.blob_table.setSelectionBehavior(QTableWidget.SelectRows)
+        # The heatmap whose connected components are shown in the blob table
+        self.blob_volume = None
+        # Refresh the blob table when the thresholds stop changing rather than on every slider movement
+        self.blob_timer = QtCore.QTimer(self)
+        self.blob_timer.setSingleShot(True)
+        self.blob_timer.setInterval(BLOB_TABLE_DELAY_MS)
+        self.blob_timer.timeout.connect(self.refresh_connected_components)
+        # The component trees behind the table are only built while it is visible, so catch it being shown
+        self.blob_table.installEventFilter(self)
 
         self.ui.doubleSpinBoxVoxelSize.setMaximum(1000.0)
         self.ui.doubleSpinBoxVoxelSize.setValue(DEFAULT_SCALE_BAR_SIZE)
@@ -352,6 +367,7 @@ class ManageData(QWidget):
             the t-statistic
         """
         self.modify_layer(Layers.heatmap, 'set_t_threshold', t)
+        self.blob_timer.start()
 
     def volume_changed(self, vol_name):
         """
@@ -372,28 +388,93 @@ class ManageData(QWidget):
         self.modify_layer(Layers.heatmap, 'set_volume', vol_name)
         self.update_connected_components(vol_name)
 
-    def update_connected_components(self, vol_name):
+    def update_connected_components(self, vol_name, build: bool = None):
+        """
+        Fill the blob table with the connected components of a heatmap at its current thresholds
+
+        Parameters
+        ----------
+        vol_name: str
+            the heatmap. 'None' to empty the table
+        build
+            whether to build the heatmap's component trees if they have not been built yet. Building takes a lot of
+            memory and time for large heatmaps, so by default they are only built when the blob table is visible
+        """
+        if build is None:
+            build = self.blob_table.isVisible()
+        # Rows must not be sorted while they are being added
+        self.blob_table.setSortingEnabled(False)
         self.blob_table.clear()
         self.blob_table.setRowCount(0) # clear
-        self.blob_table.setHorizontalHeaderLabels(['Count', 'Mean', 'location x:x, y:y, z:z'])
+        self.blob_table.setHorizontalHeaderLabels(BLOB_TABLE_HEADERS)
 
         # set the connected component list
         if vol_name != 'None':
-            conn = self.model.getdata(vol_name).connected_components
-
-            for i, (size_mean, bbox) in enumerate(conn.items()):
-                self.blob_table.insertRow(i)
-                bbox_string = ', '.join(str(x) for x in bbox)
-                self.blob_table.setItem(i, 0, QTableWidgetItem(str(size_mean[0])))
-                self.blob_table.setItem(i, 1, QTableWidgetItem(str(size_mean[1])))
-                self.blob_table.setItem(i, 2, QTableWidgetItem(bbox_string))
+            vol = self.model.getdata(vol_name)
+            self.set_blob_volume(vol)
+            voxel_volume = (self.ui.doubleSpinBoxVoxelSize.value() / 1000) ** 3  # um voxels to mm3
+            # If the components are not ready yet, the table is refreshed when they are
+            vol.find_largest_connected_components(voxel_volume, self.atlas_volume(), build)
+            conn = vol.connected_components
+
+            if conn is not None:
+                label_names = self.controller.atlas_label_names
+                self.blob_table.setRowCount(len(conn))
+                for i, row in enumerate(conn.itertuples()):
+                    bbox = [int(x) for x in (row.x0, row.x1, row.y0, row.y1, row.z0, row.z1)]
+                    centroid = ', '.join('{:.1f}'.format(c) for c in (row.centroid_x, row.centroid_y, row.centroid_z))
+                    label = label_names.get(int(row.label), str(row.label)) if row.label >= 1 else ''
+                    values = [int(row.size), round(float(row.volume), 6), round(float(row.mean), 4),
+                              round(float(row.sum), 2), round(float(row.peak), 4), centroid, label,
+                              ', '.join(str(x) for x in bbox)]
+                    for column, value in enumerate(values):
+                        item = QTableWidgetItem()
+                        # Numbers are set as data rather than text so they sort by value
+                        item.setData(QtCore.Qt.DisplayRole, value)
+                        self.blob_table.setItem(i, column, item)
+                    # The row's roi stays with it when the table is sorted
+                    self.blob_table.item(i, 0).setData(QtCore.Qt.UserRole, bbox)
+        else:
+            self.set_blob_volume(None)
 
         self.blob_table.resizeColumnsToContents()
+        self.blob_table.setSortingEnabled(True)
+
+    def atlas_volume(self):
+        """
+        The label map volume of the current view, used to name the regions the blobs are in. None if there isn't one
+        """
+        layer = self.controller.current_view.layers[Layers.vol2]
+        if layer.vol and layer.vol != 'None' and layer.label_map:
+            return layer.vol
+        return None
+
+    def set_blob_volume(self, vol):
+        """
+        Set the heatmap whose connected components are shown in the blob table. The component trees of the previous
+        heatmap are freed, or their building cancelled, so only the shown heatmap holds trees in memory
+        """
+        if vol is self.blob_volume:
+            return
+        if self.blob_volume is not None:
+            self.blob_volume.components_ready_signal.disconnect(self.refresh_connected_components)
+            self.blob_volume.free_connected_components()
+        self.blob_volume = vol
+        if vol is not None:
+            vol.components_ready_signal.connect(self.refresh_connected_components)
+
+    def refresh_connected_components(self):
+        if self.blob_volume is not None and self.blob_volume.active:
+            self.update_connected_components(self.blob_volume.name)
+
+    def eventFilter(self, obj, event):
+        if obj is self.blob_table and event.type() == QtCore.QEvent.Show:
+            # The trees may not have been built while the table was hidden
+            self.blob_timer.start()
+        return super(ManageData, self).eventFilter(obj, event)
 
     def on_connected_table_clicked(self, row, _):
-        roi_widget = self.blob_table.item(row, 2)
-        roi_str = roi_widget.text()
-        roi = [x.strip() for x in roi_str.split(', ')]
+        roi = self.blob_table.item(row, 0).data(QtCore.Qt.UserRole)
         self.roi_signal.emit(roi[0:2], roi[2:4], roi[4:6])
 
     def vector_changed(self, vol_name):
@@ -445,9 +526,19 @@ class ManageData(QWidget):
         self.populate_heatmap_controls()
         self.annotations.update()
 
+    @staticmethod
+    def add_loading_items(combobox, ids):
+        """
+        Add disabled placeholder entries for volumes that are still being loaded in the background
+        """
+        for id_ in ids:
+            combobox.addItem('{} (loading...)'.format(id_))
+            combobox.model().item(combobox.count() - 1).setEnabled(False)
+
     def populate_heatmap_controls(self):
         self.ui.comboBoxData.clear()
         self.ui.comboBoxData.addItems(self.model.data_id_list())
+        self.add_loading_items(self.ui.comboBoxData, self.model.loading_id_list(('heatmap',)))
         self.ui.comboBoxData.addItem("None")
         self.ui.comboBoxOrientation.setCurrentIndex(self.ui.comboBoxOrientation.findText(
             self.controller.current_orientation().name))
@@ -507,6 +598,7 @@ class ManageData(QWidget):
         """
         self.ui.comboBoxVolume.clear()
         self.ui.comboBoxVolume.addItems(self.model.volume_id_list())
+        self.add_loading_items(self.ui.comboBoxVolume, self.model.loading_id_list())
         self.ui.comboBoxVolume.addItem("None")
         # do the luts
         self.ui.comboBoxVolumeLut.clear()
@@ -515,6 +607,7 @@ class ManageData(QWidget):
 
         self.ui.comboBoxVolume2.clear()
         self.ui.comboBoxVolume2.addItems(self.model.volume_id_list())
+        self.add_loading_items(self.ui.comboBoxVolume2, self.model.loading_id_list())
         self.ui.comboBoxVolume2.addItem("None")
         # do the luts
         self.ui.comboBoxVolumeLut2.clear()
@@ -526,6 +619,7 @@ class ManageData(QWidget):
     def populate_vector_controls(self):
         self.ui.comboBoxVectors.clear()
         self.ui.comboBoxVectors.addItems(self.model.vector_id_list())
+        self.add_loading_items(self.ui.comboBoxVectors, self.model.loading_id_list(('vector',)))
         self.ui.comboBoxVectors.addItem("None")
         self.update_vector_controls()
 
@@ -630,6 +724,10 @@ class ManageData(QWidget):
         else:
             self.ui.comboBoxData.setCurrentIndex(self.ui.comboBoxData.findText('None'))
 
+    def on_pending_volume_loaded(self, layer_idx: Layers, _, vol_id: str):
+        if self._pending_volumes.get(layer_idx) == vol_id:
+            self.modify_layer(layer_idx, 'set_volume', vol_id)
+
     def modify_layer(self, layer_idx: Layers, method: str, *args):
         """
         Instead of of replicating all the functions in the layers here, we get the method to call on the layers by
@@ -645,11 +743,21 @@ class ManageData(QWidget):
             Any arguments to pass on
 
         """
-        if self.link_views:
-            for view in self.views.values():
-                getattr(view.layers[layer_idx], method)(*args)
-        else:
-            getattr(self.controller.current_view.layers[layer_idx], method)(*args)
+        if method == 'set_volume':
+            # A volume that is not loaded yet is set on the layer once it's ready. Until then the layer is unchanged
+            self._pending_volumes.pop(layer_idx, None)
+            handle = self.model.load_pending(args[0])
+            if handle is not None:
+                self._pending_volumes[layer_idx] = args[0]
+                handle.volume_loaded_signal.connect(partial(self.on_pending_volume_loaded, layer_idx))
+                return
+
+        views = self.views.values() if self.link_views else [self.controller.current_view]
+        for view in views:
+            if method == 'set_volume':
+                # A slice requested for the previous volume may not exist in the new one
+                self.controller.render_scheduler.cancel(view)
+            getattr(view.layers[layer_idx], method)(*args)
 
         self.update_slice_views()
         self.update_volume_controls()
@@ -692,10 +800,12 @@ class ManageData(QWidget):
     def data_negative_higher_changed(self, value):
         self.update_data_lut('neg_upper', value)
         self.ui.doubleSpinBoxNegThresh.setValue(value)
+        self.blob_timer.start()
 
     def data_positive_lower_changed(self, value):
         self.update_data_lut('pos_lower', value)
         self.ui.doubleSpinBoxPosThresh.setValue(value)
+        self.blob_timer.start()
 
     def data_positive_higher_changed(self, value):
         self.update_data_lut('pos_upper', value)
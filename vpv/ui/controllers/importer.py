@@ -379,7 +379,7 @@ class Import(QDialog):
         self.setFixedWidth(table_width + 43)
 
     def guess_type(self, data_path):
-        volume_types = ['.nrrd', '.tiff', '.tif', '.nii', '.mnc', '.npz', '.bmp', '.json', '.gz', '.zip']
+        volume_types = ['.nrrd', '.tiff', '.tif', '.nii', '.mnc', '.npz', '.bmp', '.json', '.gz', '.zip', '.vpvb']
         extension = os.path.splitext(data_path)[1].lower()
 
         data_basname = os.path.basename(data_path)
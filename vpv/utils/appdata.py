@@ -25,6 +25,10 @@ import logging
 
 VPV_APPDATA_VERSION = 2.2
 ANNOTATION_CRICLE_RADIUS_DEFAULT = 40
+VOLUME_CACHE_BUDGET_DEFAULT = 10 * 1024 ** 3  # bytes
+LAYOUT_CACHE_BUDGET_DEFAULT = 2 * 1024 ** 3  # bytes
+SLICE_CACHE_BUDGET_DEFAULT = 512 * 1024 ** 2  # bytes
+PYRAMID_MEMORY_BUDGET_DEFAULT = 1024 ** 3  # bytes
 
 
 class AppData(object):
@@ -116,6 +120,50 @@ class AppData(object):
     def annotation_circle_radius(self, radius):
         self.data['annotation_cricle_radius'] = radius
 
+    @property
+    def volume_cache_budget(self):
+        """
+        The maximum size in bytes of the on-disk cache of decoded volumes. 0 disables the cache
+        """
+        return self.data.get('volume_cache_budget', VOLUME_CACHE_BUDGET_DEFAULT)
+
+    @volume_cache_budget.setter
+    def volume_cache_budget(self, budget):
+        self.data['volume_cache_budget'] = int(budget)
+
+    @property
+    def layout_cache_budget(self):
+        """
+        The maximum size in bytes of the in-memory sagittal and coronal copies of volumes. 0 disables them
+        """
+        return self.data.get('layout_cache_budget', LAYOUT_CACHE_BUDGET_DEFAULT)
+
+    @layout_cache_budget.setter
+    def layout_cache_budget(self, budget):
+        self.data['layout_cache_budget'] = int(budget)
+
+    @property
+    def slice_cache_budget(self):
+        """
+        The maximum size in bytes of the 2D slices cached for display. 0 disables the cache and prefetching
+        """
+        return self.data.get('slice_cache_budget', SLICE_CACHE_BUDGET_DEFAULT)
+
+    @slice_cache_budget.setter
+    def slice_cache_budget(self, budget):
+        self.data['slice_cache_budget'] = int(budget)
+
+    @property
+    def pyramid_memory_budget(self):
+        """
+        The maximum size in bytes of the downsampled volume levels kept in memory. Others are memory mapped
+        """
+        return self.data.get('pyramid_memory_budget', PYRAMID_MEMORY_BUDGET_DEFAULT)
+
+    @pyramid_memory_budget.setter
+    def pyramid_memory_budget(self, budget):
+        self.data['pyramid_memory_budget'] = int(budget)
+
     @property
     def annotation_centre(self):
         return self.data.get('annotation_centre')
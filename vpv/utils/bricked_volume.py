@@ -0,0 +1,305 @@
+# Copyright 2016 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Neil Horner <n.horner@har.mrc.ac.uk>
+
+"""
+A bricked, multi-resolution on-disk volume format (.vpvb) for volumes that are larger than RAM.
+
+The volume is split into cubic bricks (64 voxels a side by default) and each brick is stored contiguously, so a 2D
+plane in any orientation only touches the bricks that cover it. Each level of the resolution pyramid is half the size
+of the previous one in every dimension.
+
+File layout (all readable with numpy alone)
+    8 bytes     magic b'VPVBRICK'
+    8 bytes     little-endian uint64 length of the json header
+    json header shape, dtype, brick_size, direction, spacing, min, max and for each level its shape and byte offset
+    level data  at 4096 byte aligned offsets. Each level is a C-ordered array of shape
+                (bricks_z, bricks_y, bricks_x, brick_size, brick_size, brick_size). Edge bricks are zero padded
+
+Convert an image with
+    python -m vpv.utils.bricked_volume input.nrrd output.vpvb
+"""
+
+import json
+import math
+import struct
+import logging
+import numpy as np
+
+from vpv.common import ImageReader
+from vpv.utils.native_readers import memmap_image, decompress_image
+from vpv.utils.pyramid import downsample, level_shapes
+
+BRICKED_EXT = '.vpvb'
+MAGIC = b'VPVBRICK'
+ALIGNMENT = 4096
+DEFAULT_BRICK_SIZE = 64
+
+
+class BrickedArray(object):
+    """
+    A read-only, array-like (z, y, x) view of one level of a bricked volume.
+    Supports integer and slice indexing. Only the bricks that cover the requested region are read, and for an
+    integer index only the matching rows within those bricks
+    """
+    def __init__(self, bricks: np.ndarray, shape: tuple):
+        """
+        Parameters
+        ----------
+        bricks
+            (bricks_z, bricks_y, bricks_x, brick_size, brick_size, brick_size) memmap
+        shape
+            the zyx shape of the volume at this level
+        """
+        self.bricks = bricks
+        self.brick_size = bricks.shape[-1]
+        self.shape = tuple(shape)
+        self.dtype = bricks.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        if len(key) > 3:
+            raise IndexError('too many indices for BrickedArray')
+        key = key + (slice(None), ) * (3 - len(key))
+
+        b = self.brick_size
+        brick_idx = []
+        inner_idx = []
+        crops = []  # For each sliced axis, the selection relative to the first brick read
+
+        for size, k in zip(self.shape, key):
+            if isinstance(k, (int, np.integer)):
+                k = int(k)
+                if k < 0:
+                    k += size
+                if not 0 <= k < size:
+                    raise IndexError('index {} is out of bounds for axis with size {}'.format(k, size))
+                brick_idx.append(k // b)
+                inner_idx.append(k % b)
+            elif isinstance(k, slice):
+                indices = range(*k.indices(size))
+                if len(indices) == 0:
+                    return np.empty([len(range(*k_.indices(s))) for s, k_ in zip(self.shape, key)
+                                     if isinstance(k_, slice)], dtype=self.dtype)
+                lo, hi = min(indices), max(indices) + 1
+                first_brick = lo // b
+                brick_idx.append(slice(first_brick, (hi - 1) // b + 1))
+                inner_idx.append(slice(None))
+                offset = first_brick * b
+                if indices.step == 1:
+                    crops.append(slice(indices.start - offset, indices.stop - offset))
+                else:
+                    crops.append(np.asarray(indices) - offset)
+            else:
+                raise TypeError('BrickedArray only supports integer and slice indexing')
+
+        region = self.bricks[tuple(brick_idx) + tuple(inner_idx)]
+
+        # Interleave the brick and within-brick axes of the sliced dimensions and merge them
+        n = len(crops)
+        order = [i for pair in zip(range(n), range(n, 2 * n)) for i in pair]
+        merged_shape = [region.shape[i] * region.shape[n + i] for i in range(n)]
+        region = region.transpose(order).reshape(merged_shape)
+
+        for axis, crop in enumerate(crops):
+            if isinstance(crop, slice):
+                region = region[(slice(None), ) * axis + (crop, )]
+            else:
+                region = np.take(region, crop, axis=axis)
+        return region
+
+
+class BrickedImage(object):
+    """
+    An opened .vpvb file
+
+    Attributes
+    ----------
+    levels: list
+        a BrickedArray for each level of the resolution pyramid. levels[0] is full resolution
+    direction: tuple
+        flattened direction cosines
+    spacing: tuple
+        voxel spacing xyz of the full resolution level
+    min, max: float
+        intensity range
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.header = read_header(path)
+        self.brick_size = self.header['brick_size']
+        self.direction = tuple(self.header['direction'])
+        self.spacing = tuple(self.header['spacing'])
+        self.min = self.header['min']
+        self.max = self.header['max']
+        dtype = np.dtype(self.header['dtype'])
+
+        self.levels = []
+        for level in self.header['levels']:
+            bricks = np.memmap(path, dtype=dtype, mode='r', offset=level['offset'],
+                               shape=_brick_grid_shape(level['shape'], self.brick_size))
+            self.levels.append(BrickedArray(bricks, level['shape']))
+
+
+def read_header(path: str) -> dict:
+    with open(path, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a bricked volume'.format(path))
+        header_len = struct.unpack('<Q', fh.read(8))[0]
+        return json.loads(fh.read(header_len).decode('utf-8'))
+
+
+def _brick_grid_shape(shape, brick_size: int) -> tuple:
+    grid = tuple(int(math.ceil(s / brick_size)) for s in shape)
+    return grid + (brick_size, ) * 3
+
+
+def _align(offset: int) -> int:
+    return int(math.ceil(offset / ALIGNMENT)) * ALIGNMENT
+
+
+def _write_slab(bricks: np.ndarray, brick_z: int, slab: np.ndarray):
+    """
+    Write a z slab of up to brick_size slices into one row of bricks
+    """
+    b = bricks.shape[-1]
+    grid_y, grid_x = bricks.shape[1:3]
+    padded = np.zeros((b, grid_y * b, grid_x * b), dtype=bricks.dtype)
+    padded[:slab.shape[0], :slab.shape[1], :slab.shape[2]] = slab
+    bricks[brick_z] = padded.reshape(b, grid_y, b, grid_x, b).transpose(1, 3, 0, 2, 4)
+
+
+def _read_source(in_path: str):
+    """
+    Get the source volume, memory mapped if possible so it does not have to fit in memory
+
+    Returns
+    -------
+    tuple: (array, direction, spacing)
+    """
+    source = memmap_image(in_path)
+    if source is None and isinstance(in_path, str):
+        source = decompress_image(in_path, memmap=True)
+    if source is not None:
+        return source.array, source.direction, source.spacing
+
+    # Zip members and images that SimpleITK reads. The spacing comes from whichever header ImageReader parsed
+    ir = ImageReader(in_path, memmap=True)
+    return ir.vol, ir.dir_cos, ir.spacing
+
+
+def convert_to_bricked(in_path: str, out_path: str, brick_size: int = DEFAULT_BRICK_SIZE):
+    """
+    Convert an image (NRRD, NIfTI or anything else SimpleITK reads) to a bricked, multi-resolution .vpvb file.
+    The source is processed one slab of bricks at a time
+
+    Parameters
+    ----------
+    in_path
+        the image to convert
+    out_path
+        the .vpvb file to write
+    brick_size
+        the length of the side of each cubic brick
+    """
+    arr, direction, spacing = _read_source(in_path)
+    if arr.ndim != 3:
+        raise ValueError('Only 3D single channel images can be converted. {} has shape {}'.format(in_path, arr.shape))
+    dtype = arr.dtype
+    shapes = level_shapes(arr.shape, brick_size)
+    level_bytes = [int(np.prod(_brick_grid_shape(s, brick_size))) * dtype.itemsize for s in shapes]
+
+    # The header includes the level offsets, which depend on the header length. Grow until it fits
+    data_start = ALIGNMENT
+    while True:
+        offsets = []
+        offset = data_start
+        for nbytes in level_bytes:
+            offsets.append(offset)
+            offset = _align(offset + nbytes)
+        header = {
+            'version': 1,
+            'shape': list(arr.shape),
+            'dtype': dtype.str,
+            'brick_size': brick_size,
+            'direction': list(direction),
+            'spacing': list(spacing),
+            'min': 0.0,
+            'max': 0.0,
+            'levels': [{'shape': list(s), 'offset': o, 'downsample': 2 ** i}
+                       for i, (s, o) in enumerate(zip(shapes, offsets))]
+        }
+        # Reserve space for the intensity range, which is filled in at the end
+        header_len = len(json.dumps(header).encode('utf-8')) + 64
+        if len(MAGIC) + 8 + header_len <= data_start:
+            break
+        data_start = _align(len(MAGIC) + 8 + header_len)
+
+    with open(out_path, 'wb') as fh:
+        fh.truncate(offset)
+
+    # Full resolution level
+    min_, max_ = None, None
+    levels = []
+    for shape, level_offset in zip(shapes, offsets):
+        bricks = np.memmap(out_path, dtype=dtype, mode='r+', offset=level_offset,
+                           shape=_brick_grid_shape(shape, brick_size))
+        levels.append(BrickedArray(bricks, shape))
+
+    for brick_z in range(levels[0].bricks.shape[0]):
+        slab = np.asarray(arr[brick_z * brick_size: (brick_z + 1) * brick_size])
+        _write_slab(levels[0].bricks, brick_z, slab)
+        slab_min, slab_max = slab.min(), slab.max()
+        min_ = slab_min if min_ is None else min(min_, slab_min)
+        max_ = slab_max if max_ is None else max(max_, slab_max)
+
+    # Each lower resolution level is made from the previous one
+    for previous, level in zip(levels[:-1], levels[1:]):
+        for brick_z in range(level.bricks.shape[0]):
+            slab = previous[brick_z * 2 * brick_size: (brick_z + 1) * 2 * brick_size]
+            _write_slab(level.bricks, brick_z, downsample(slab, dtype))
+        logging.info('Bricked level {} written'.format(level.shape))
+
+    for level in levels:
+        level.bricks.flush()
+
+    header['min'] = float(min_)
+    header['max'] = float(max_)
+    header_bytes = json.dumps(header).encode('utf-8')
+    with open(out_path, 'r+b') as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack('<Q', len(header_bytes)))
+        fh.write(header_bytes)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser("Convert an image to the VPV bricked multi-resolution format")
+    parser.add_argument(dest='input', help='Image to convert (nrrd, nifti etc)')
+    parser.add_argument(dest='output', help='Output path. Should end with {}'.format(BRICKED_EXT))
+    parser.add_argument('-b', '-brick_size', dest='brick_size', type=int, default=DEFAULT_BRICK_SIZE,
+                        help='Length of the side of each brick')
+    args = parser.parse_args()
+    convert_to_bricked(args.input, args.output, args.brick_size)
+
+
+if __name__ == '__main__':
+    main()
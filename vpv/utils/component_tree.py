@@ -0,0 +1,442 @@
+# Copyright 2016 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Neil Horner <n.horner@har.mrc.ac.uk>
+
+"""
+Component trees (max-trees) of heatmaps, for finding the connected components (blobs) at any t-statistic threshold.
+
+Each node of a max-tree is a connected component of the voxels with values of at least the node's level. The parent of
+a node is the component it joins at the next level down. The tree is built once, from the highest value down, and
+the components above any threshold are then the nodes above the threshold whose parents are not. Changing the
+threshold does not need the volume relabelling.
+"""
+
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+MIN_COMPONENT_SIZE = 4  # Smaller components are not reported
+CLUSTER_COLUMNS = ['size', 'volume', 'mean', 'sum', 'peak', 'centroid_x', 'centroid_y', 'centroid_z',
+                   'x0', 'x1', 'y0', 'y1', 'z0', 'z1', 'label']
+SMALL_GRAPH_EDGES = 2048  # Graphs with fewer edges are labelled with numpy rather than scipy, which has more overhead
+
+
+def _find(uf: np.ndarray, items: np.ndarray) -> np.ndarray:
+    """
+    Follow the union-find pointers of items to their representatives, compressing the paths as we go
+    """
+    r = uf[items]
+    while True:
+        next_ = uf[r]
+        if np.array_equal(next_, r):
+            break
+        r = next_
+    uf[items] = r
+    return r
+
+
+def _label_graph(u: np.ndarray, v: np.ndarray, num_nodes: int):
+    """
+    Find the connected components of an undirected graph given by its edges u[i] - v[i]
+
+    Returns
+    -------
+    tuple
+        (number of components, component of each node)
+    """
+    if len(u) >= SMALL_GRAPH_EDGES:
+        graph = coo_matrix((np.ones(len(u), dtype=np.int8), (u, v)), shape=(num_nodes, num_nodes))
+        return connected_components(graph, directed=False)
+    # Propagate the lowest node index along the edges until nothing changes
+    labels = np.arange(num_nodes)
+    while True:
+        previous = labels.copy()
+        lowest = np.minimum(labels[u], labels[v])
+        np.minimum.at(labels, u, lowest)
+        np.minimum.at(labels, v, lowest)
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            break
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels.max() + 1, labels
+
+
+class MaxTree(object):
+    """
+    The max-tree of the positive values of a volume. Use build_max_tree to make one
+
+    Attributes
+    ----------
+    level: np.ndarray
+        the value at which each node's component starts
+    parent: np.ndarray
+        index of each node's parent. -1 for roots
+    size: np.ndarray
+        number of voxels in each node's component
+    total: np.ndarray
+        sum of the values in each node's component
+    bbox_min, bbox_max: np.ndarray
+        (n, 3) the inclusive xyz bounding box of each node's component
+    shape: tuple
+        zyx shape of the volume
+    voxels: np.ndarray
+        flat indices of the voxels in the tree, highest value first
+    voxel_node: np.ndarray
+        the node each voxel was added to, which is at the voxel's value
+    """
+    def __init__(self, level, parent, size, total, bbox_min, bbox_max, shape, voxels, voxel_node):
+        self.level = level
+        self.parent = parent
+        self.size = size
+        self.total = total
+        self.bbox_min = bbox_min
+        self.bbox_max = bbox_max
+        self.shape = shape
+        self.voxels = voxels
+        self.voxel_node = voxel_node
+        self._voxel_values = level[voxel_node]
+        # Roots have no parent, so they are components at every threshold below their level
+        self._parent_level = np.where(parent >= 0, level[parent], -np.inf)
+
+    def __len__(self):
+        return len(self.level)
+
+    def components(self, threshold: float) -> np.ndarray:
+        """
+        Get the nodes that are the connected components of the voxels with values greater than threshold
+
+        Returns
+        -------
+        np.ndarray
+            node indices
+        """
+        return np.flatnonzero((self.level > threshold) & (self._parent_level <= threshold))
+
+    def component_voxels(self, threshold: float):
+        """
+        Get the voxels of the connected components of the voxels with values greater than threshold, without
+        labelling the volume
+
+        Returns
+        -------
+        tuple
+            (component nodes, flat indices of the voxels, index into the component nodes of each voxel's component,
+            value of each voxel)
+        """
+        nodes = self.components(threshold)
+        # Nodes and voxels are both in order of decreasing value, so those above the threshold come first
+        num_nodes = np.count_nonzero(self.level > threshold)
+        values = self._voxel_values
+        num_voxels = np.count_nonzero(values > threshold)
+        # Point each node at its component by jumping up the tree
+        up = self.parent[:num_nodes].copy()
+        up[nodes] = nodes
+        while True:
+            next_ = up[up]
+            if np.array_equal(next_, up):
+                break
+            up = next_
+        component_index = np.empty(num_nodes, dtype=self.parent.dtype)
+        component_index[nodes] = np.arange(len(nodes))
+        voxel_node = self.voxel_node[:num_voxels]
+        return nodes, self.voxels[:num_voxels], component_index[up[voxel_node]], values[:num_voxels]
+
+
+def build_max_tree(arr: np.ndarray, stop: threading.Event = None):
+    """
+    Build the max-tree of the positive values of a volume, with 6-connectivity. Zero and negative voxels are left
+    out of the tree
+
+    The voxels are added one distinct value at a time from the highest down. At each level, the new voxels and the
+    components they touch are joined with a sparse graph connected components search, so only one pass over the voxels
+    is needed
+
+    Parameters
+    ----------
+    arr
+        zyx volume
+    stop
+        building is abandoned when this is set
+
+    Returns
+    -------
+    MaxTree
+        None if stopped
+    """
+    # Voxel and node indices fit in 32 bits for all but the very largest volumes, which halves the memory of the tree
+    index_dtype = np.int32 if arr.size < np.iinfo(np.int32).max else np.int64
+    flat = np.flatnonzero(arr > 0).astype(index_dtype)
+    values = np.asarray(arr).ravel()[flat].astype(np.float32)
+    order = np.argsort(-values, kind='stable')
+    flat, values = flat[order], values[order]
+    n = len(flat)
+    # xyz of each voxel in the order they are added
+    coords = np.stack(np.unravel_index(flat, arr.shape)[::-1], axis=1).astype(np.int32)
+
+    # The face neighbours in the +x, +y and +z directions that are also in the tree
+    by_flat = np.argsort(flat, kind='stable').astype(index_dtype)
+    flat_sorted = flat[by_flat]
+    edges = []
+    for axis, step in enumerate((1, arr.shape[2], arr.shape[1] * arr.shape[2])):
+        ranks = np.flatnonzero(coords[:, axis] + 1 < arr.shape[2 - axis]).astype(index_dtype)
+        pos = np.searchsorted(flat_sorted, flat[ranks] + step)
+        pos[pos == n] = 0
+        found = flat_sorted[pos] == flat[ranks] + step
+        edges.append(np.stack((ranks[found], by_flat[pos[found]]), axis=1))
+    edges = np.concatenate(edges) if n else np.empty((0, 2), dtype=index_dtype)
+    # An edge joins its voxels once the lower of the two is added
+    activation = edges.max(axis=1)
+    edge_order = np.argsort(activation, kind='stable')
+    edges, activation = edges[edge_order], activation[edge_order]
+
+    # There is at most one node per voxel
+    level = np.empty(n, dtype=np.float32)
+    parent = np.full(n, -1, dtype=index_dtype)
+    size = np.zeros(n, dtype=index_dtype)
+    total = np.zeros(n, dtype=np.float64)
+    bbox_min = np.zeros((n, 3), dtype=np.int32)
+    bbox_max = np.zeros((n, 3), dtype=np.int32)
+    num_nodes = 0
+    # Each component so far is identified by a representative, the index of a node in its history. The union-find
+    # pointers only change when components merge, so they stay shallow
+    uf = np.arange(n, dtype=index_dtype)
+    current_node = np.arange(n, dtype=index_dtype)  # The latest node of each representative's component
+    voxel_rep = np.empty(n, dtype=index_dtype)  # The representative given to each voxel when it was added
+    voxel_node = np.empty(n, dtype=index_dtype)
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(values)) + 1))
+    ends = np.append(starts[1:], n)
+    edge_starts = np.searchsorted(activation, starts)
+    edge_ends = np.searchsorted(activation, ends)
+
+    for s, e, es, ee in zip(starts, ends, edge_starts, edge_ends):
+        if stop is not None and stop.is_set():
+            return None
+        k = e - s
+        level_edges = edges[es: ee]
+        if len(level_edges):
+            # Local graph nodes are the new voxels followed by the existing components they touch
+            old = level_edges < s
+            old_reps, old_local = np.unique(_find(uf, voxel_rep[level_edges[old]]), return_inverse=True)
+            local = level_edges - s
+            local[old] = k + old_local.ravel()
+            num_new, labels = _label_graph(local[:, 0], local[:, 1], k + len(old_reps))
+        else:
+            old_reps = np.empty(0, dtype=index_dtype)
+            num_new, labels = k, np.arange(k)
+
+        new_nodes = num_nodes + np.arange(num_new, dtype=index_dtype)
+        new_labels, old_labels = labels[:k], labels[k:]
+        level[new_nodes] = values[s]
+        size[new_nodes] = np.bincount(new_labels, minlength=num_new)
+        total[new_nodes] = np.bincount(new_labels, weights=values[s: e], minlength=num_new)
+        new_min = np.full((num_new, 3), np.iinfo(np.int32).max, dtype=np.int32)
+        new_max = np.zeros((num_new, 3), dtype=np.int32)
+        np.minimum.at(new_min, new_labels, coords[s: e])
+        np.maximum.at(new_max, new_labels, coords[s: e])
+        # Components born at this level are represented by their first node
+        component_reps = new_nodes.copy()
+        if len(old_reps):
+            children = current_node[old_reps]
+            size[new_nodes] += np.bincount(old_labels, weights=size[children], minlength=num_new).astype(index_dtype)
+            total[new_nodes] += np.bincount(old_labels, weights=total[children], minlength=num_new)
+            np.minimum.at(new_min, old_labels, bbox_min[children])
+            np.maximum.at(new_max, old_labels, bbox_max[children])
+            parent[children] = new_nodes[old_labels]
+            # Merged components keep the representative of the largest
+            by_size = np.lexsort((-size[children], old_labels))
+            largest = by_size[np.concatenate(([True], np.diff(old_labels[by_size]) != 0))]
+            component_reps[old_labels[largest]] = old_reps[largest]
+            uf[old_reps] = component_reps[old_labels]
+        bbox_min[new_nodes] = new_min
+        bbox_max[new_nodes] = new_max
+        current_node[component_reps] = new_nodes
+        voxel_rep[s: e] = component_reps[new_labels]
+        voxel_node[s: e] = new_nodes[new_labels]
+        num_nodes += num_new
+
+    # The node arrays were allocated for one node per voxel. Copy out the used part so the rest is freed
+    return MaxTree(level[:num_nodes].copy(), parent[:num_nodes].copy(), size[:num_nodes].copy(),
+                   total[:num_nodes].copy(), bbox_min[:num_nodes].copy(), bbox_max[:num_nodes].copy(), arr.shape,
+                   flat, voxel_node)
+
+
+class HeatmapComponentTrees(object):
+    """
+    Builds the max-trees of the positive and of the negated negative values of a heatmap on a background thread
+    """
+    def __init__(self, arr: np.ndarray, on_complete=None):
+        """
+        Parameters
+        ----------
+        arr
+            zyx heatmap
+        on_complete: callable
+            called with no arguments from the background thread once both trees are built
+        """
+        self.positive = None
+        self.negative = None
+        self.complete = False
+        self._arr = arr
+        self._on_complete = on_complete
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._build, daemon=True)
+        self._thread.start()
+        # The latest cluster_statistics_async request that has not been started, and the thread computing them
+        self._stats_lock = threading.Lock()
+        self._stats_request = None
+        self._stats_thread = None
+
+    def _build(self):
+        try:
+            positive = build_max_tree(self._arr, self._stop)
+            negative = build_max_tree(-np.asarray(self._arr), self._stop) if positive is not None else None
+        except MemoryError as e:
+            logging.info('Could not build the heatmap component trees\n{}'.format(e))
+            return
+        finally:
+            self._arr = None
+        if negative is None:  # Stopped
+            return
+        self.positive, self.negative = positive, negative
+        self.complete = True
+        if self._on_complete:
+            self._on_complete()
+
+    def cluster_statistics(self, negative_threshold: float, positive_threshold: float,
+                           min_size: int = MIN_COMPONENT_SIZE, voxel_volume: float = 1.0, atlas=None):
+        """
+        Get statistics of the connected components (clusters) of the voxels above positive_threshold and of those
+        below negative_threshold. Each statistic is computed for all the clusters at once with bincount over the
+        clusters' voxels
+
+        Parameters
+        ----------
+        min_size
+            smaller clusters are left out
+        voxel_volume
+            the physical volume of a voxel
+        atlas: callable
+            atlas(x, y, z) gets the atlas labels of arrays of voxels. If given, the most common label in each cluster
+            is reported
+
+        Returns
+        -------
+        pd.DataFrame
+            a row for each cluster, largest first, with the columns
+            size: number of voxels
+            volume: size * voxel_volume
+            mean, sum: of the t-statistics
+            peak: the largest absolute t-statistic
+            centroid_x, centroid_y, centroid_z: the mean voxel coordinates
+            x0, x1, y0, y1, z0, z1: inclusive bounding box
+            label: the most common atlas label. -1 if there's no atlas
+            None if the trees are not built yet
+        """
+        if not self.complete:
+            return None
+        tables = []
+        for tree, threshold, sign in ((self.positive, positive_threshold, 1), (self.negative, -negative_threshold, -1)):
+            nodes, voxels, clusters, values = tree.component_voxels(threshold)
+            keep = tree.size[nodes] >= min_size
+            nodes = nodes[keep]
+            in_kept = keep[clusters]
+            voxels, values = voxels[in_kept], values[in_kept]
+            clusters = (np.cumsum(keep) - 1)[clusters[in_kept]]
+            num = len(nodes)
+
+            size = np.bincount(clusters, minlength=num)
+            total = np.bincount(clusters, weights=values, minlength=num)
+            peak = np.zeros(num)
+            np.maximum.at(peak, clusters, values)
+            z, y, x = np.unravel_index(voxels, tree.shape)
+            table = pd.DataFrame({
+                'size': size,
+                'volume': size * voxel_volume,
+                'mean': sign * total / np.maximum(size, 1),
+                'sum': sign * total,
+                'peak': peak})
+            for axis, coords in zip('xyz', (x, y, z)):
+                table['centroid_' + axis] = np.bincount(clusters, weights=coords, minlength=num) / np.maximum(size, 1)
+            for i, axis in enumerate('xyz'):
+                table[axis + '0'] = tree.bbox_min[nodes, i]
+                table[axis + '1'] = tree.bbox_max[nodes, i]
+
+            table['label'] = -1
+            if atlas is not None and num:
+                labels = np.asarray(atlas(x, y, z)).astype(np.int64)
+                # Count each (cluster, label) pair by a single integer key, then take the most common label of each
+                # cluster
+                lowest = labels.min()
+                num_labels = labels.max() - lowest + 1
+                pairs, counts = np.unique(clusters * num_labels + (labels - lowest), return_counts=True)
+                pair_cluster, pair_label = np.divmod(pairs, num_labels)
+                by_count = np.lexsort((-counts, pair_cluster))
+                first = by_count[np.concatenate(([True], np.diff(pair_cluster[by_count]) != 0))]
+                table.loc[pair_cluster[first], 'label'] = pair_label[first] + lowest
+            tables.append(table)
+        table = pd.concat(tables, ignore_index=True)[CLUSTER_COLUMNS]
+        return table.sort_values('size', ascending=False, kind='stable').reset_index(drop=True)
+
+    def cluster_statistics_async(self, on_complete, *args, **kwargs):
+        """
+        Compute cluster_statistics on a background thread. If this is called again before the statistics are
+        finished, only the latest request is computed next
+
+        Parameters
+        ----------
+        on_complete: callable
+            called from the background thread with the table returned by cluster_statistics
+        args, kwargs
+            as cluster_statistics
+        """
+        with self._stats_lock:
+            self._stats_request = (on_complete, args, kwargs)
+            if self._stats_thread is not None:
+                return
+            self._stats_thread = threading.Thread(target=self._compute_statistics, daemon=True)
+            self._stats_thread.start()
+
+    def _compute_statistics(self):
+        while True:
+            with self._stats_lock:
+                request, self._stats_request = self._stats_request, None
+                if request is None or self._stop.is_set():
+                    self._stats_thread = None
+                    return
+            on_complete, args, kwargs = request
+            try:
+                table = self.cluster_statistics(*args, **kwargs)
+            except MemoryError as e:
+                logging.info('Could not compute the heatmap cluster statistics\n{}'.format(e))
+                continue
+            on_complete(table)
+
+    def wait(self, timeout: float = None):
+        """
+        Block until the trees, and any cluster statistics requested, are finished
+        """
+        self._thread.join(timeout)
+        with self._stats_lock:
+            stats_thread = self._stats_thread
+        if stats_thread is not None:
+            stats_thread.join(timeout)
+
+    def close(self):
+        self._stop.set()
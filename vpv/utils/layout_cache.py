@@ -0,0 +1,193 @@
+# Copyright 2016 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Neil Horner <n.horner@har.mrc.ac.uk>
+
+"""
+An in-memory cache of orientation-contiguous copies of volumes.
+
+Volumes are stored zyx in C order, so an axial plane is a contiguous block of memory but sagittal (arr[:, :, x]) and
+coronal (arr[:, y, :]) planes are strided gathers. For memory mapped volumes each of those is thousands of scattered
+page faults. The first time a sagittal or coronal plane is requested from a volume, a transposed copy in which those
+planes are contiguous is built on a background thread, reading the source one z slab at a time. Until it is ready,
+planes are taken from the original array.
+
+The total size of the copies is limited by a byte budget. The least recently used copies are dropped to make room.
+"""
+
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+from vpv.common import Orientation
+
+DEFAULT_BUDGET = 2 * 1024 ** 3  # 2GB
+SLAB_BYTES = 64 * 1024 ** 2  # The size of the source chunks read when building a copy
+
+# The axes of the zyx array for each layout. layout[i] == the plane at index i in that orientation
+LAYOUT_AXES = {
+    Orientation.sagittal: (2, 0, 1),  # xzy. layout[x] == arr[:, :, x]
+    Orientation.coronal: (1, 0, 2)    # yzx. layout[y] == arr[:, y, :]
+}
+
+
+def build_layout(arr: np.ndarray, orientation: Orientation, stop: threading.Event = None) -> np.ndarray:
+    """
+    Make a copy of a zyx array in which the planes of the given orientation are contiguous.
+
+    Parameters
+    ----------
+    arr
+        zyx array
+    orientation
+        sagittal or coronal
+    stop
+        if set while building, None is returned
+
+    Returns
+    -------
+    np.ndarray
+    """
+    axes = LAYOUT_AXES[orientation]
+    layout = np.empty([arr.shape[a] for a in axes], dtype=arr.dtype)
+    plane_bytes = max(1, arr[0].nbytes)
+    slab = max(1, SLAB_BYTES // plane_bytes)
+    for z in range(0, arr.shape[0], slab):
+        if stop is not None and stop.is_set():
+            return None
+        # z is the second axis of both layouts
+        layout[:, z: z + slab] = np.asarray(arr[z: z + slab]).transpose(axes)
+    return layout
+
+
+class LayoutCache(object):
+    """
+    Attributes
+    ----------
+    budget: int
+        Maximum size in bytes of all the copies. If 0, no copies are made
+    """
+    def __init__(self, budget: int = DEFAULT_BUDGET):
+        self.budget = budget
+        self._lock = threading.Lock()
+        # (id(owner), orientation) -> (weakref to owner, layout). Least recently used first
+        self._layouts = OrderedDict()
+        # (id(owner), orientation) -> (weakref to owner, nbytes, stop event, thread)
+        self._building = {}
+
+    def get(self, owner, arr: np.ndarray, orientation: Orientation):
+        """
+        Get the contiguous copy of arr for an orientation. If there isn't one, start building it
+
+        Parameters
+        ----------
+        owner
+            the object (normally a Volume) that arr belongs to. Copies are dropped when it is garbage collected
+        arr
+            zyx array
+        orientation
+
+        Returns
+        -------
+        np.ndarray or None if the copy is not available yet
+        """
+        if not self.budget or orientation not in LAYOUT_AXES:
+            return None
+
+        key = (id(owner), orientation)
+        with self._lock:
+            entry = self._layouts.get(key)
+            if entry is not None:
+                if entry[0]() is owner:
+                    self._layouts.move_to_end(key)
+                    return entry[1]
+                # A previous owner with the same id has gone
+                del self._layouts[key]
+
+            if key in self._building or arr.nbytes > self.budget:
+                return None
+
+            self._make_room(arr.nbytes)
+            stop = threading.Event()
+            thread = threading.Thread(target=self._build, args=(key, arr, orientation, stop), daemon=True)
+            self._building[key] = (weakref.ref(owner), arr.nbytes, stop, thread)
+        thread.start()
+        return None
+
+    def _build(self, key, arr, orientation, stop):
+        try:
+            layout = build_layout(arr, orientation, stop)
+        except (MemoryError, OSError, ValueError) as e:
+            logging.info('Could not make {} layout of volume\n{}'.format(orientation, e))
+            layout = None
+
+        with self._lock:
+            owner_ref = self._building.pop(key)[0]
+            if layout is not None and not stop.is_set() and owner_ref() is not None:
+                self._layouts[key] = (owner_ref, layout)
+
+    def _make_room(self, nbytes: int):
+        """
+        Drop copies of volumes that no longer exist, then the least recently used copies, until there is room for
+        nbytes more. Must be called with the lock held
+        """
+        for key, (owner_ref, _) in list(self._layouts.items()):
+            if owner_ref() is None:
+                del self._layouts[key]
+
+        used = sum(layout.nbytes for _, layout in self._layouts.values())
+        used += sum(entry[1] for entry in self._building.values())
+        while self._layouts and used + nbytes > self.budget:
+            _, (_, layout) = self._layouts.popitem(last=False)
+            used -= layout.nbytes
+
+    def discard(self, owner):
+        """
+        Drop all copies belonging to owner and stop any that are being built
+        """
+        with self._lock:
+            for orientation in LAYOUT_AXES:
+                key = (id(owner), orientation)
+                self._layouts.pop(key, None)
+                building = self._building.get(key)
+                if building is not None:
+                    building[2].set()
+
+    def wait(self, timeout: float = None):
+        """
+        Block until the copies currently being built are finished
+        """
+        with self._lock:
+            threads = [entry[3] for entry in self._building.values()]
+        for thread in threads:
+            thread.join(timeout)
+
+    def size(self) -> int:
+        """
+        The total size in bytes of the copies
+        """
+        with self._lock:
+            return sum(layout.nbytes for _, layout in self._layouts.values())
+
+    def clear(self):
+        with self._lock:
+            self._layouts.clear()
+            for entry in self._building.values():
+                entry[2].set()
+
+
+layout_cache = LayoutCache()
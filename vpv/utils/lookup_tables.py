@@ -27,6 +27,117 @@ from vpv.common import generic_anatomy_label_map_path
 
 # ANATOMY_LABELS_FILE = 'generic_anatomy.csv'
 
+# The number of entries in a combined negative/positive heatmap LUT. Sets how finely the thresholds are resolved
+DIVERGING_LUT_SIZE = 4096
+# The largest range of label values that can be filtered with a LUT
+MAX_LABEL_LUT_SIZE = 65536
+
+
+def diverging_lut(negative_lut, positive_lut, neg_levels, pos_levels, size=DIVERGING_LUT_SIZE):
+    """
+    Combine the negative and positive heatmap LUTs into a single LUT, so a heatmap slice can be displayed in one
+    ImageItem without splitting it into negative and positive copies.
+
+    Values up to neg_levels[1] are coloured as they would be by negative_lut with neg_levels, values from pos_levels[0]
+    as by positive_lut with pos_levels, and values in between are transparent.
+
+    Parameters
+    ----------
+    negative_lut, positive_lut: np.ndarray
+        (n, 4) RGBA LUTs
+    neg_levels, pos_levels: list
+        [lower, upper] levels of each LUT
+
+    Returns
+    -------
+    tuple: ((size, 4) uint8 LUT, [lower, upper] levels to display it with)
+    """
+    neg_levels = [float(x) for x in neg_levels]
+    pos_levels = [float(x) for x in pos_levels]
+    lower = min(neg_levels + pos_levels)
+    upper = max(neg_levels + pos_levels)
+    if upper <= lower:
+        upper = lower + 1.0
+
+    # Size the entries so both thresholds fall on entry boundaries, so values either side of them are never mixed up
+    width = (upper - lower) / size
+    gap = pos_levels[0] - neg_levels[1]
+    if gap > 0:
+        width = gap / max(1, round(gap / width))
+        lower = neg_levels[1] - np.ceil((neg_levels[1] - lower) / width) * width
+        size = int(np.ceil((upper - lower) / width))
+        upper = lower + size * width
+
+    # The value at the centre of each LUT entry
+    values = lower + (np.arange(size) + 0.5) * width
+
+    def lookup(lut, levels, v):
+        # As ImageItem maps values to LUT entries
+        lo, hi = levels
+        n = len(lut)
+        if hi <= lo:
+            idx = np.where(v < lo, 0, n - 1)
+        else:
+            idx = np.clip(((v - lo) / (hi - lo) * n).astype(int), 0, n - 1)
+        return np.asarray(lut)[idx]
+
+    combined = np.zeros((size, 4), dtype=np.ubyte)
+    neg = values <= neg_levels[1]
+    pos = values >= pos_levels[0]
+    combined[neg] = lookup(negative_lut, neg_levels, values[neg])
+    combined[pos] = lookup(positive_lut, pos_levels, values[pos])
+    return combined, [float(lower), float(upper)]
+
+
+def label_filter_lut(lut, levels, value_range, labels, max_entries=MAX_LABEL_LUT_SIZE):
+    """
+    Make a LUT that only shows some labels of a label map. There is one entry for each integer value in value_range,
+    coloured as the value would be by lut with levels, with the entries of all values not in labels made transparent.
+    Filtering labels is then a LUT change rather than masking every slice.
+
+    Parameters
+    ----------
+    lut: np.ndarray
+        (n, 3 or 4) LUT
+    levels: list
+        [lower, upper] levels that lut is displayed with
+    value_range: tuple
+        (min, max) of the label map
+    labels: iterable
+        the labels to show
+
+    Returns
+    -------
+    tuple: (lut, levels) to display the label map with. None if the value range is too large for one entry per value
+    """
+    vmin, vmax = int(np.floor(value_range[0])), int(np.ceil(value_range[1]))
+    vmax = max(vmax, vmin + 1)
+    num_values = vmax - vmin + 1
+    if num_values > max_entries:
+        return None
+
+    lut = np.asarray(lut)
+    if lut.shape[1] == 3:
+        lut = np.concatenate([lut, np.full((len(lut), 1), 255, dtype=lut.dtype)], axis=1)
+
+    # The LUT entry ImageItem would use for each value with the original lut and levels
+    values = np.arange(vmin, vmax + 1)
+    lo, hi = float(levels[0]), float(levels[1])
+    n = len(lut)
+    if hi <= lo:
+        idx = np.where(values < lo, 0, n - 1)
+    else:
+        idx = np.clip(np.floor((values - lo) * n / (hi - lo)).astype(int), 0, n - 1)
+    filtered = lut[idx].copy()
+
+    show = np.zeros(num_values, dtype=bool)
+    labels = np.asarray([label for label in labels if vmin <= label <= vmax], dtype=int)
+    show[labels - vmin] = True
+    filtered[~show, 3] = 0
+
+    # With one entry per value and these levels, ImageItem maps each value v to entry v - vmin
+    return filtered, [vmin, vmax]
+
 
 class Lut(object):
     def __init__(self):
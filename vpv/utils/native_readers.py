@@ -0,0 +1,597 @@
+# Copyright 2016 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Neil Horner <n.horner@har.mrc.ac.uk>
+
+"""
+Native readers for NRRD, NIfTI-1 and MetaImage files.
+
+SimpleITK decodes the whole volume into memory before we can get an array from it. For raw-encoded files we only need
+to parse the header to find the dtype, shape and the byte offset of the voxel data. The data can then be memory mapped
+straight from the file, so nothing is read from disk until a slice is requested.
+
+Compressed files (.nrrd.gz, .nii.gz and gzip/bzip2-encoded nrrds) are decompressed in chunks straight into a
+preallocated array or memmap, so no temporary copy of the uncompressed file is needed.
+
+All readers return arrays in the same zyx order as sitk.GetArrayFromImage, and the direction in the same row-major
+LPS form as sitk.Image.GetDirection()
+"""
+
+import os
+import gzip
+import struct
+import logging
+import tempfile
+import shutil
+import zipfile
+import numpy as np
+
+from vpv.lib import nrrd
+
+
+class MappedImage(object):
+    """
+    A memory mapped (or decompressed) volume and the header info we need from it
+
+    Attributes
+    ----------
+    array: np.memmap or np.ndarray
+        zyx ordered. read-only if mapped directly from the image file
+    direction: tuple
+        flattened 3x3 direction cosine matrix (LPS) as returned by sitk.Image.GetDirection()
+    spacing: tuple
+        voxel spacing xyz
+    """
+    def __init__(self, array, direction, spacing):
+        self.array = array
+        self.direction = direction
+        self.spacing = spacing
+
+
+class NativeReadError(Exception):
+    """
+    Raised when a file cannot be memory mapped. Callers should fall back to SimpleITK
+    """
+    pass
+
+
+DEFAULT_DIRECTION = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+DEFAULT_SPACING = (1.0, 1.0, 1.0)
+
+_NIFTI_DTYPES = {
+    2: 'u1',
+    4: 'i2',
+    8: 'i4',
+    16: 'f4',
+    64: 'f8',
+    256: 'i1',
+    512: 'u2',
+    768: 'u4',
+    1024: 'i8',
+    1280: 'u8'
+}
+
+_METAIMAGE_DTYPES = {
+    'MET_CHAR': 'i1',
+    'MET_UCHAR': 'u1',
+    'MET_SHORT': 'i2',
+    'MET_USHORT': 'u2',
+    'MET_INT': 'i4',
+    'MET_UINT': 'u4',
+    'MET_LONG_LONG': 'i8',
+    'MET_ULONG_LONG': 'u8',
+    'MET_FLOAT': 'f4',
+    'MET_DOUBLE': 'f8'
+}
+
+# NRRD axis kinds that indicate a per-voxel component axis rather than a spatial one
+_NRRD_COMPONENT_KINDS = ('vector', 'covariant-vector', 'normal', 'list', '2-vector', '3-vector', '4-vector',
+                         'rgb-color', 'rgba-color')
+
+
+def memmap_image(path: str) -> MappedImage:
+    """
+    Memory map an image if it's in a format we can read natively
+
+    Parameters
+    ----------
+    path
+        path to an image file
+
+    Returns
+    -------
+    MappedImage if the file is a raw-encoded .nrrd, .nii, .mhd or .mha. None otherwise, in which case the caller
+    should read the image via SimpleITK
+    """
+    if not isinstance(path, str):  # eg. ZipMember
+        return None
+    ext = os.path.splitext(path)[1].lower()
+    readers = {'.nrrd': nrrd_memmap,
+               '.nhdr': nrrd_memmap,
+               '.nii': nifti_memmap,
+               '.mhd': metaimage_memmap,
+               '.mha': metaimage_memmap}
+    reader = readers.get(ext)
+    if not reader:
+        return None
+    try:
+        return reader(path)
+    except (NativeReadError, nrrd.NrrdError, ValueError, KeyError, IndexError, struct.error) as e:
+        logging.info('Cannot memory map {}. Falling back to SimpleITK\n{}'.format(path, e))
+        return None
+
+
+def _memmap(data_path: str, dtype: np.dtype, shape: tuple, offset: int) -> np.memmap:
+    """
+    Check the data file is big enough then memory map it read-only
+    """
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    file_size = os.path.getsize(data_path)
+    if offset < 0:  # Data is at the end of the file
+        offset = file_size - nbytes
+    if offset < 0 or offset + nbytes > file_size:
+        raise NativeReadError('{} is too small for the header shape {}'.format(data_path, shape))
+    return np.memmap(data_path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def _normalised_direction(axes: np.ndarray, ras: bool = False) -> tuple:
+    """
+    Given a 3x3 matrix whose columns are the (unnormalised) axis vectors, return the flattened direction cosines.
+    If the vectors are in RAS space, convert to LPS as ITK does
+    """
+    axes = np.asarray(axes, dtype=np.float64)
+    norms = np.linalg.norm(axes, axis=0)
+    norms[norms == 0] = 1.0
+    direction = axes / norms
+    if ras:
+        direction[0:2, :] *= -1
+    return tuple(float(x) for x in direction.ravel())
+
+
+def nrrd_header_info(header: dict, data_axes: int = 3):
+    """
+    Get the zyx(c) shape, direction and spacing from a parsed NRRD header
+
+    Parameters
+    ----------
+    header
+        as returned by nrrd.read_header
+    data_axes
+        number of spatial axes
+
+    Returns
+    -------
+    tuple: shape, direction, spacing
+    """
+    sizes = list(header['sizes'])
+    kinds = header.get('kinds', [])
+
+    if header['dimension'] == data_axes + 1 and kinds and kinds[0] in _NRRD_COMPONENT_KINDS:
+        components = sizes.pop(0)
+        shape = tuple(reversed(sizes)) + (components,)
+        space_dirs = [x for x in header.get('space directions', []) if x != 'none']
+    elif header['dimension'] == data_axes:
+        shape = tuple(reversed(sizes))
+        space_dirs = header.get('space directions', [])
+    else:
+        raise NativeReadError('Unsupported NRRD dimension: {}'.format(header['dimension']))
+
+    if space_dirs and 'none' not in space_dirs and len(space_dirs) == data_axes:
+        axes = np.array([[float(x) for x in vec] for vec in space_dirs]).T
+        spacing = tuple(float(x) for x in np.linalg.norm(axes, axis=0))
+        space = header.get('space', '')
+        ras = space in ('right-anterior-superior', 'RAS')
+        direction = _normalised_direction(axes, ras)
+    else:
+        direction = DEFAULT_DIRECTION
+        spacings = header.get('spacings')
+        spacing = tuple(float(x) for x in spacings) if spacings else DEFAULT_SPACING
+
+    return shape, direction, spacing
+
+
+def nrrd_memmap(path: str) -> MappedImage:
+    """
+    Memory map a raw-encoded NRRD file. Attached and detached (.nhdr) headers are supported
+
+    Raises
+    ------
+    NativeReadError
+        If the data is compressed or the layout is not supported
+    """
+    with open(path, 'rb') as fh:
+        header = nrrd.read_header(fh)
+        header_end = fh.tell()
+
+    if header['encoding'] != 'raw':
+        raise NativeReadError('NRRD encoding is {}'.format(header['encoding']))
+
+    dtype = nrrd._determine_dtype(header)
+    shape, direction, spacing = nrrd_header_info(header)
+
+    lineskip = header.get('lineskip', header.get('line skip', 0))
+    byteskip = header.get('byteskip', header.get('byte skip', 0))
+    datafile = header.get('datafile', header.get('data file'))
+
+    if datafile:
+        if datafile.startswith('LIST') or '%' in datafile:
+            raise NativeReadError('Multi-file NRRD data is not supported')
+        if not os.path.isabs(datafile):
+            datafile = os.path.join(os.path.dirname(path), datafile)
+        data_path = datafile
+        offset = 0
+    else:
+        data_path = path
+        offset = header_end
+
+    if byteskip == -1:
+        return MappedImage(_memmap(data_path, dtype, shape, -1), direction, spacing)
+
+    if lineskip:
+        with open(data_path, 'rb') as fh:
+            fh.seek(offset)
+            for _ in range(lineskip):
+                fh.readline()
+            offset = fh.tell()
+
+    return MappedImage(_memmap(data_path, dtype, shape, offset + byteskip), direction, spacing)
+
+
+def _read_nifti_header(fh):
+    """
+    Parse the fields we need from a NIfTI-1 header
+
+    Returns
+    -------
+    dict
+    """
+    raw = fh.read(348)
+    if len(raw) < 348:
+        raise NativeReadError('File too small for a NIfTI-1 header')
+
+    endian = '<'
+    if struct.unpack('<i', raw[0:4])[0] != 348:
+        endian = '>'
+        if struct.unpack('>i', raw[0:4])[0] != 348:
+            raise NativeReadError('Not a NIfTI-1 file')
+
+    def unpack(fmt, offset):
+        return struct.unpack_from(endian + fmt, raw, offset)
+
+    hdr = {
+        'endian': endian,
+        'dim': unpack('8h', 40),
+        'datatype': unpack('h', 70)[0],
+        'pixdim': unpack('8f', 76),
+        'vox_offset': unpack('f', 108)[0],
+        'scl_slope': unpack('f', 112)[0],
+        'scl_inter': unpack('f', 116)[0],
+        'qform_code': unpack('h', 252)[0],
+        'sform_code': unpack('h', 254)[0],
+        'quatern': unpack('3f', 256),
+        'srow': (unpack('4f', 280), unpack('4f', 296), unpack('4f', 312)),
+        'magic': raw[344:348]
+    }
+    return hdr
+
+
+def _nifti_direction(hdr: dict) -> tuple:
+    """
+    Work out the LPS direction cosines from the qform, or the sform if there's no qform
+    """
+    if hdr['qform_code'] > 0:
+        b, c, d = [float(x) for x in hdr['quatern']]
+        a = np.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+        rot = np.array([
+            [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+            [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+            [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]
+        ])
+        qfac = -1.0 if hdr['pixdim'][0] < 0 else 1.0
+        rot[:, 2] *= qfac
+        return _normalised_direction(rot, ras=True)
+
+    if hdr['sform_code'] > 0:
+        axes = np.array([row[0:3] for row in hdr['srow']])
+        return _normalised_direction(axes, ras=True)
+
+    return DEFAULT_DIRECTION
+
+
+def nifti_header_info(hdr: dict):
+    """
+    Check that a NIfTI-1 header is for an image we can read natively and get the layout of its data. Shared by the
+    memory mapped and streamed readers
+
+    Parameters
+    ----------
+    hdr
+        from _read_nifti_header
+
+    Returns
+    -------
+    tuple: (dtype, zyx shape, direction, spacing, byte offset of the data)
+
+    Raises
+    ------
+    NativeReadError
+        If the image needs intensity rescaling, is not a single file NIfTI-1 or is not 3D
+    """
+    if hdr['magic'] != b'n+1\x00':
+        raise NativeReadError('Not a single file NIfTI-1 image')
+
+    slope, inter = hdr['scl_slope'], hdr['scl_inter']
+    if slope not in (0.0, 1.0) or (slope != 0.0 and inter != 0.0):
+        # ITK applies the scaling and returns floats. Let it do that
+        raise NativeReadError('NIfTI image has intensity scaling')
+
+    np_type = _NIFTI_DTYPES.get(hdr['datatype'])
+    if not np_type:
+        raise NativeReadError('Unsupported NIfTI datatype {}'.format(hdr['datatype']))
+    dtype = np.dtype(hdr['endian'] + np_type)
+
+    ndim = hdr['dim'][0]
+    dims = [d for d in hdr['dim'][1: ndim + 1]]
+    # Drop any trailing singleton dimensions eg. time
+    while len(dims) > 3 and dims[-1] == 1:
+        dims.pop()
+    if len(dims) != 3:
+        raise NativeReadError('Only 3D NIfTI images are supported')
+
+    shape = tuple(reversed(dims))
+    spacing = tuple(abs(float(x)) for x in hdr['pixdim'][1:4])
+    return dtype, shape, _nifti_direction(hdr), spacing, int(hdr['vox_offset'])
+
+
+def nifti_memmap(path: str) -> MappedImage:
+    """
+    Memory map a single-file (.nii) NIfTI-1 image
+
+    Raises
+    ------
+    NativeReadError
+        If the image needs intensity rescaling, is not a single file NIfTI-1 or is not 3D
+    """
+    with open(path, 'rb') as fh:
+        hdr = _read_nifti_header(fh)
+    dtype, shape, direction, spacing, offset = nifti_header_info(hdr)
+    return MappedImage(_memmap(path, dtype, shape, offset), direction, spacing)
+
+
+def read_metaimage_header(path: str):
+    """
+    Parse a MetaImage (.mhd/.mha) header
+
+    Returns
+    -------
+    tuple: (dict of header key -> str values, byte offset of the end of the header)
+    """
+    header = {}
+    with open(path, 'rb') as fh:
+        while True:
+            line = fh.readline()
+            if not line:
+                break
+            key, sep, value = line.decode('ascii', 'ignore').partition('=')
+            if not sep:
+                continue
+            header[key.strip()] = value.strip()
+            # ElementDataFile is always the last entry
+            if key.strip() == 'ElementDataFile':
+                break
+        header_end = fh.tell()
+    return header, header_end
+
+
+def metaimage_memmap(path: str) -> MappedImage:
+    """
+    Memory map an uncompressed MetaImage file (.mhd + .raw, or a .mha with local data)
+
+    Raises
+    ------
+    NativeReadError
+        If the data is compressed or split over multiple files
+    """
+    header, header_end = read_metaimage_header(path)
+
+    if header.get('CompressedData', 'False').lower() == 'true':
+        raise NativeReadError('MetaImage data is compressed')
+
+    dims = [int(x) for x in header['DimSize'].split()]
+    if len(dims) != 3:
+        raise NativeReadError('Only 3D MetaImages can be memory mapped')
+
+    np_type = _METAIMAGE_DTYPES.get(header['ElementType'])
+    if not np_type:
+        raise NativeReadError('Unsupported MetaImage type {}'.format(header['ElementType']))
+
+    msb = header.get('BinaryDataByteOrderMSB', header.get('ElementByteOrderMSB', 'False'))
+    dtype = np.dtype(('>' if msb.lower() == 'true' else '<') + np_type)
+
+    shape = tuple(reversed(dims))
+    channels = int(header.get('ElementNumberOfChannels', 1))
+    if channels > 1:
+        shape += (channels,)
+
+    data_file = header['ElementDataFile']
+    if data_file == 'LOCAL':
+        data_path = path
+        offset = header_end
+    elif data_file.startswith('LIST') or '%' in data_file:
+        raise NativeReadError('Multi-file MetaImage data is not supported')
+    else:
+        data_path = data_file if os.path.isabs(data_file) else os.path.join(os.path.dirname(path), data_file)
+        offset = 0
+
+    header_size = int(header.get('HeaderSize', 0))
+    if header_size == -1:
+        offset = -1
+    else:
+        offset += header_size
+
+    matrix = header.get('TransformMatrix', header.get('Rotation', header.get('Orientation')))
+    if matrix:
+        # Each row of the MetaImage matrix is an axis direction. ITK stores these as columns
+        direction = _normalised_direction(np.array([float(x) for x in matrix.split()]).reshape((3, 3)).T)
+    else:
+        direction = DEFAULT_DIRECTION
+
+    spacing = header.get('ElementSpacing', header.get('ElementSize'))
+    spacing = tuple(float(x) for x in spacing.split()) if spacing else DEFAULT_SPACING
+
+    return MappedImage(_memmap(data_path, dtype, shape, offset), direction, spacing)
+
+
+def empty_array(shape: tuple, dtype: np.dtype, memmap: bool = False) -> np.ndarray:
+    """
+    Preallocate an array to decode an image into. If memmap, back it with an anonymous temporary file
+    """
+    if memmap:
+        return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+    return np.empty(shape, dtype=dtype)
+
+
+def decompress_image(path: str, memmap: bool = False) -> MappedImage:
+    """
+    Decompress an image in chunks directly into a preallocated array
+
+    Parameters
+    ----------
+    path
+        .nrrd.gz, .nii.gz or a .nrrd/.nhdr with gzip or bzip2 encoding
+    memmap
+        decompress into a memmap backed by a temporary file rather than into memory
+
+    Returns
+    -------
+    MappedImage. None if the file is not one of the supported compressed formats, in which case the caller should
+    read the image via SimpleITK
+    """
+    lower = path.lower()
+    try:
+        if lower.endswith('.nrrd.gz'):
+            with gzip.open(path, 'rb') as fh:
+                return _stream_nrrd(fh, path, memmap)
+        elif lower.endswith('.nii.gz'):
+            with gzip.open(path, 'rb') as fh:
+                return _stream_nifti(fh, memmap)
+        elif lower.endswith(('.nrrd', '.nhdr')):
+            with open(path, 'rb') as fh:
+                return _stream_nrrd(fh, path, memmap, compressed_only=True)
+    except (NativeReadError, nrrd.NrrdError, ValueError, KeyError, IndexError, struct.error, EOFError, OSError) as e:
+        logging.info('Cannot decompress {}. Falling back to SimpleITK\n{}'.format(path, e))
+    return None
+
+
+def _stream_nrrd(fh, path: str, memmap: bool, compressed_only: bool = False) -> MappedImage:
+    """
+    Read nrrd data from the open (possibly gzip) file handle fh into a new array
+
+    Parameters
+    ----------
+    compressed_only
+        Return None for raw-encoded data, as that can be memory mapped instead
+    """
+    header = nrrd.read_header(fh)
+    if compressed_only and header['encoding'] == 'raw':
+        return None
+
+    dtype = nrrd._determine_dtype(header)
+    shape, direction, spacing = nrrd_header_info(header)
+    arr = empty_array(shape, dtype, memmap)
+    nrrd.read_data(header, fh, path, out=arr)
+    return MappedImage(arr, direction, spacing)
+
+
+def _stream_nifti(fh, memmap: bool) -> MappedImage:
+    """
+    Read a NIfTI-1 image from the open (gzip) file handle fh into a new array
+    """
+    dtype, shape, direction, spacing, offset = nifti_header_info(_read_nifti_header(fh))
+    arr = empty_array(shape, dtype, memmap)
+    fh.seek(offset)
+    if nrrd._read_stream_into(fh, arr) != arr.nbytes:
+        raise NativeReadError('NIfTI data is truncated')
+    return MappedImage(arr, direction, spacing)
+
+
+class ZipMember(object):
+    """
+    An image stored in a zip archive, such as the IMPC analysis results zip. Can be used in place of a path when
+    loading volumes so the image is read from the archive without extracting it
+
+    Attributes
+    ----------
+    zip_path: str
+        path to the zip file
+    name: str
+        name of the member in the zip
+    """
+    def __init__(self, zip_path: str, name: str):
+        self.zip_path = zip_path
+        self.name = name
+
+    def __str__(self):
+        return os.path.join(self.zip_path, self.name)
+
+    def extract_to_temp(self) -> tempfile.NamedTemporaryFile:
+        """
+        Fallback for images that can't be streamed. Extract just this member to a temporary file with the same
+        extension. The returned NamedTemporaryFile must be kept alive until the image has been read
+        """
+        basename = os.path.basename(self.name)
+        suffix = basename[basename.find('.'):] if '.' in basename else ''
+        with zipfile.ZipFile(self.zip_path) as zf:
+            if self.name not in zf.namelist():
+                raise FileNotFoundError('{} is not in {}'.format(self.name, self.zip_path))
+            tmp = tempfile.NamedTemporaryFile(suffix=suffix)
+            with zf.open(self.name) as member:
+                shutil.copyfileobj(member, tmp)
+        tmp.flush()
+        return tmp
+
+
+def read_zip_member(member: ZipMember, memmap: bool = False) -> MappedImage:
+    """
+    Decode a .nrrd, .nrrd.gz, .nii or .nii.gz image straight from its stream in a zip file
+
+    Parameters
+    ----------
+    member
+        the image in the zip
+    memmap
+        decode into a memmap backed by a temporary file rather than into memory
+
+    Returns
+    -------
+    MappedImage. None if the image can't be read this way, in which case the caller should extract the member
+    """
+    lower = member.name.lower()
+    try:
+        with zipfile.ZipFile(member.zip_path) as zf, zf.open(member.name) as fh:
+            if lower.endswith('.nrrd'):
+                return _stream_nrrd(fh, str(member), memmap)
+            elif lower.endswith('.nrrd.gz'):
+                with gzip.GzipFile(fileobj=fh) as gz:
+                    return _stream_nrrd(gz, str(member), memmap)
+            elif lower.endswith('.nii'):
+                return _stream_nifti(fh, memmap)
+            elif lower.endswith('.nii.gz'):
+                with gzip.GzipFile(fileobj=fh) as gz:
+                    return _stream_nifti(gz, memmap)
+    except (NativeReadError, nrrd.NrrdError, ValueError, KeyError, IndexError, struct.error, EOFError, OSError,
+            zipfile.BadZipFile) as e:
+        logging.info('Cannot stream {} from the zip file\n{}'.format(member, e))
+    return None
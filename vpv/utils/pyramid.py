@@ -0,0 +1,177 @@
+# Copyright 2016 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Neil Horner <n.horner@har.mrc.ac.uk>
+
+"""
+Multi-resolution (level of detail) pyramids of volumes.
+
+When a view is zoomed out so that several voxels fall on each screen pixel, slices can be taken from a downsampled copy
+of the volume instead. Level n of the pyramid is 2**n times smaller than the volume in each dimension.
+
+The levels of all the volumes' pyramids that are kept in memory share one byte budget. Levels that don't fit are
+memory mapped from a temporary file.
+"""
+
+import math
+import logging
+import tempfile
+import threading
+import weakref
+import numpy as np
+
+MIN_LEVEL_SIZE = 128  # Stop adding levels once the largest dimension is this small
+IN_MEMORY_MAX_BYTES = 512 * 1024 ** 2  # Levels bigger than this are memory mapped from a temporary file
+DEFAULT_BUDGET = 1024 ** 3  # 1GB
+SLAB_SLICES = 64  # The number of output slices made at a time
+
+
+def downsample(block: np.ndarray, dtype) -> np.ndarray:
+    """
+    Halve a block in each dimension by averaging 2x2x2 voxels. Odd dimensions are padded by repeating the edge
+    """
+    pad = [(0, s % 2) for s in block.shape]
+    if any(p[1] for p in pad):
+        block = np.pad(block, pad, mode='edge')
+    z, y, x = (s // 2 for s in block.shape)
+    mean = block.reshape(z, 2, y, 2, x, 2).mean(axis=(1, 3, 5))
+    if np.issubdtype(dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(dtype)
+
+
+def level_shapes(shape, min_size: int = MIN_LEVEL_SIZE) -> list:
+    """
+    The shapes of each level, halving until the largest dimension is no bigger than min_size
+    """
+    shapes = [tuple(shape)]
+    while max(shapes[-1]) > min_size:
+        shapes.append(tuple(int(math.ceil(s / 2)) for s in shapes[-1]))
+    return shapes
+
+
+class PyramidMemory(object):
+    """
+    Accounts for the bytes of the pyramid levels held in memory by all the volumes
+
+    Attributes
+    ----------
+    budget: int
+        Maximum size in bytes of the in-memory levels. If 0, all levels are memory mapped
+    """
+    def __init__(self, budget: int = DEFAULT_BUDGET):
+        self.budget = budget
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes: int) -> bool:
+        """
+        Reserve room for a level to be kept in memory
+
+        Returns
+        -------
+        bool
+            False if it would go over the budget
+        """
+        with self._lock:
+            if self._used + nbytes > self.budget:
+                return False
+            self._used += nbytes
+            return True
+
+    def release(self, nbytes: int):
+        with self._lock:
+            self._used = max(0, self._used - nbytes)
+
+    def used(self) -> int:
+        """
+        The total size in bytes of the in-memory levels
+        """
+        with self._lock:
+            return self._used
+
+
+pyramid_memory = PyramidMemory()
+
+
+def _release(memory: PyramidMemory, reserved: list):
+    memory.release(reserved[0])
+    reserved[0] = 0
+
+
+class VolumePyramid(object):
+    """
+    Builds the levels of a volume's pyramid on a background thread. Level 0 is the volume itself
+    """
+    def __init__(self, arr: np.ndarray, min_size: int = MIN_LEVEL_SIZE, memory: PyramidMemory = None):
+        """
+        Parameters
+        ----------
+        arr
+            zyx volume
+        min_size
+            levels are added until the largest dimension is no bigger than this
+        memory
+            the budget for the levels kept in memory. pyramid_memory if None
+        """
+        self.levels = [arr]
+        self.shapes = level_shapes(arr.shape, min_size)
+        self._memory = memory if memory is not None else pyramid_memory
+        # The bytes reserved from the budget. In a list so they are still released if the pyramid is garbage collected
+        # without being closed
+        self._reserved = [0]
+        weakref.finalize(self, _release, self._memory, self._reserved)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._build, daemon=True)
+        self._thread.start()
+
+    def _build(self):
+        for shape in self.shapes[1:]:
+            previous = self.levels[-1]
+            dtype = previous.dtype
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            if nbytes <= IN_MEMORY_MAX_BYTES and self._memory.reserve(nbytes):
+                self._reserved[0] += nbytes
+                level = np.empty(shape, dtype=dtype)
+            else:
+                level = np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+            try:
+                for z in range(0, shape[0], SLAB_SLICES):
+                    if self._stop.is_set():
+                        return
+                    level[z: z + SLAB_SLICES] = downsample(np.asarray(previous[2 * z: 2 * (z + SLAB_SLICES)]), dtype)
+            except (MemoryError, OSError) as e:
+                logging.info('Could not build level {} of the volume pyramid\n{}'.format(shape, e))
+                return
+            # Only made available once complete
+            self.levels.append(level)
+
+    def num_levels(self) -> int:
+        """
+        The number of levels built so far, including level 0
+        """
+        return len(self.levels)
+
+    def wait(self, timeout: float = None):
+        self._thread.join(timeout)
+
+    def close(self):
+        """
+        Stop building, and free the levels so their memory is returned to the budget
+        """
+        self._stop.set()
+        self._thread.join()
+        del self.levels[1:]
+        _release(self._memory, self._reserved)
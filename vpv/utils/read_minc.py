@@ -16,14 +16,33 @@
 # @author James Brown <james.brown@har.mrc.ac.uk>
 
 import subprocess as sp
+import logging
 import numpy as np
 import re
 from tempfile import NamedTemporaryFile
+from vpv.utils.native_readers import MappedImage, DEFAULT_DIRECTION, _normalised_direction
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+    logging.info('h5py not installed. MINC files will be read using the minc tools')
 
 minc_dtypes = {'unsigned': {'byte': np.uint8, 'short': np.uint16, 'float': np.float32},
                'signed': {'byte': np.int8, 'short': np.int16, 'float': np.float32}}
 
+MINC2_IMAGE = '/minc-2.0/image/0/image'
+MINC2_DIMENSIONS = '/minc-2.0/dimensions'
+MINC2_SPATIAL_DIMS = ('xspace', 'yspace', 'zspace')
+
+
 def minc_to_numpy(minc_file):
+    """
+    Read the voxel values from a MINC file.
+    MINC2 (HDF5) files are read directly and memory mapped where possible. MINC1 files need the minc tools
+    """
+    if _is_minc2(minc_file):
+        return read_minc2(minc_file).array
 
     info = minc_info(minc_file)
     if not info:
@@ -34,6 +53,11 @@ def minc_to_numpy(minc_file):
 
 
 def mincstats_to_numpy(minc_file):
+    """
+    Read a MINC stats file as float32 real values
+    """
+    if _is_minc2(minc_file):
+        return read_minc2(minc_file, real_values=True).array
 
     info = minc_info(minc_file)
     if not info:
@@ -45,6 +69,93 @@ def mincstats_to_numpy(minc_file):
     return vol
 
 
+def _is_minc2(minc_file) -> bool:
+    return h5py is not None and h5py.is_hdf5(minc_file)
+
+
+def _attr_str(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, np.ndarray):  # Some writers store strings as char arrays
+        return b''.join(value.astype('S1').ravel()).decode('utf-8')
+    return str(value)
+
+
+def read_minc2(minc_file, real_values: bool = False) -> MappedImage:
+    """
+    Read a MINC2 file without the minc tools.
+    If the image dataset is stored contiguously and uncompressed it is memory mapped, otherwise it's read straight
+    from the HDF5 file into an array
+
+    Parameters
+    ----------
+    minc_file: str
+        path to a MINC2 file
+    real_values
+        If True, apply the image-min/image-max intensity scaling of integer images and return float32
+
+    Returns
+    -------
+    MappedImage with the zyx array, direction cosines and voxel spacing (mm) from the dimension variables
+    """
+    with h5py.File(minc_file, 'r') as f:
+        ds = f[MINC2_IMAGE]
+        dim_order = [d.strip() for d in _attr_str(ds.attrs.get('dimorder', 'zspace,yspace,xspace')).split(',')]
+
+        offset = ds.id.get_offset()
+        if offset is not None and ds.chunks is None and ds.compression is None:
+            array = np.memmap(minc_file, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
+        else:
+            array = ds[()]
+
+        # Get the spacing and direction cosines of the spatial dimensions in xyz order
+        spacing = []
+        axes = np.eye(3)
+        for i, dim_name in enumerate(MINC2_SPATIAL_DIMS):
+            dim = f[MINC2_DIMENSIONS].get(dim_name)
+            step = float(dim.attrs.get('step', 1.0)) if dim is not None else 1.0
+            spacing.append(abs(step))
+            if dim is not None and 'direction_cosines' in dim.attrs:
+                axes[:, i] = dim.attrs['direction_cosines']
+
+        if real_values:
+            array = _minc2_real_values(f, ds, array, dim_order)
+
+    # Reorder the axes to z, y, x. This is a view, so a memmap is not read
+    spatial_order = [dim_order.index(d) for d in reversed(MINC2_SPATIAL_DIMS) if d in dim_order]
+    if len(spatial_order) == array.ndim and spatial_order != list(range(array.ndim)):
+        array = np.transpose(array, spatial_order)
+
+    direction = _normalised_direction(axes, ras=True) if not np.array_equal(axes, np.eye(3)) else DEFAULT_DIRECTION
+    return MappedImage(array, direction, tuple(spacing))
+
+
+def _minc2_real_values(f, ds, array, dim_order):
+    """
+    Convert voxel values to real values using the per-slice image-min and image-max datasets
+        real = (voxel - valid_min) / (valid_max - valid_min) * (image_max - image_min) + image_min
+    """
+    if np.issubdtype(array.dtype, np.floating) or 'image-min' not in ds.parent or 'image-max' not in ds.parent:
+        return np.asarray(array, dtype=np.float32)
+
+    info = np.iinfo(array.dtype)
+    valid_min, valid_max = ds.attrs.get('valid_range', (info.min, info.max))
+    image_min = ds.parent['image-min']
+    image_max = ds.parent['image-max']
+
+    # image-min/max vary over the leading (slice) dimensions. Broadcast them against the image
+    scale_dims = [d.strip() for d in _attr_str(image_min.attrs.get('dimorder', '')).split(',') if d.strip()]
+    shape = [array.shape[dim_order.index(d)] if d in scale_dims else 1 for d in dim_order]
+    image_min = np.asarray(image_min[()], dtype=np.float32).reshape(shape)
+    image_max = np.asarray(image_max[()], dtype=np.float32).reshape(shape)
+
+    real = array.astype(np.float32)
+    real -= valid_min
+    real *= (image_max - image_min) / float(valid_max - valid_min)
+    real += image_min
+    return real
+
+
 class SliceGenerator(object):
 
     def __init__(self, recon):
@@ -0,0 +1,236 @@
+# Copyright 2016 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Neil Horner <n.horner@har.mrc.ac.uk>
+
+"""
+An on-disk cache of decoded volumes.
+
+Decoding a gzipped nrrd or reading an image via SimpleITK can take a long time for large volumes. The decoded array is
+saved as an .npy file in the vpv_viewer app data directory along with a small json file containing the shape, dtype,
+direction and intensity range. On the next load of the same file the .npy is memory mapped instead.
+
+Entries are keyed on the real path of the source file plus a variant string (eg 'float16' for heatmaps, which are
+cast before caching). An entry is invalidated if the source file's modification time or size changes. When the total
+size of the cache goes over the byte budget, the least recently used entries are removed.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+
+from vpv.common import log_dir
+from vpv.utils.native_readers import ZipMember
+
+CACHE_DIR = os.path.join(log_dir, 'volume_cache')
+DEFAULT_BUDGET = 10 * 1024 ** 3  # 10GB
+
+
+class VolumeCache(object):
+    """
+    Attributes
+    ----------
+    cache_dir: str
+        Where the .npy and .json files are kept
+    budget: int
+        Maximum size in bytes of all cached arrays. If 0, caching is disabled
+    """
+    def __init__(self, cache_dir: str, budget: int = DEFAULT_BUDGET):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _source(source_path, variant: str):
+        """
+        Images in zip files are keyed on the zip path, with the member name added to the variant
+        """
+        if isinstance(source_path, ZipMember):
+            return source_path.zip_path, '{}|{}'.format(source_path.name, variant)
+        return source_path, variant
+
+    def _entry_paths(self, source_path: str, variant: str):
+        key = hashlib.sha1('{}|{}'.format(os.path.realpath(source_path), variant).encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.npy', base + '.json'
+
+    @staticmethod
+    def _source_stat(source_path: str):
+        st = os.stat(source_path)
+        return st.st_mtime_ns, st.st_size
+
+    def get(self, source_path, variant: str = ''):
+        """
+        Get a cached volume
+
+        Parameters
+        ----------
+        source_path: str or ZipMember
+            The path of the original image file
+        variant
+            distinguishes different decodings of the same file
+
+        Returns
+        -------
+        tuple: (np.memmap, dict of metadata). None if there is no valid entry
+        """
+        if not self.budget:
+            return None
+
+        source_path, variant = self._source(source_path, variant)
+        npy_path, meta_path = self._entry_paths(source_path, variant)
+        if not os.path.isfile(meta_path) or not os.path.isfile(npy_path):
+            return None
+        try:
+            with open(meta_path, 'r') as fh:
+                meta = json.load(fh)
+            mtime, size = self._source_stat(source_path)
+        except (OSError, ValueError):
+            return None
+
+        if meta.get('mtime') != mtime or meta.get('size') != size:
+            # The source file has changed
+            self._remove(npy_path, meta_path)
+            return None
+
+        try:
+            arr = np.load(npy_path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logging.info('Removing unreadable cache entry {}\n{}'.format(npy_path, e))
+            self._remove(npy_path, meta_path)
+            return None
+
+        # Touch the metadata file. Its modification time is used for the LRU eviction
+        os.utime(meta_path, None)
+        return arr, meta
+
+    def put(self, source_path, arr: np.ndarray, direction=None, min_=None, max_=None, variant: str = ''):
+        """
+        Add a decoded volume to the cache
+
+        Parameters
+        ----------
+        source_path: str or ZipMember
+            The path of the original image file
+        arr
+            the decoded volume
+        direction
+            the direction cosines of the image
+        min_, max_
+            The intensity range. Calculated if not given
+        variant
+            distinguishes different decodings of the same file
+        """
+        if not self.budget or arr.nbytes > self.budget:
+            return
+
+        source_path, variant = self._source(source_path, variant)
+        npy_path, meta_path = self._entry_paths(source_path, variant)
+        try:
+            mtime, size = self._source_stat(source_path)
+        except OSError:
+            return
+
+        meta = {
+            'source': os.path.realpath(source_path),
+            'mtime': mtime,
+            'size': size,
+            'shape': list(arr.shape),
+            'dtype': arr.dtype.str,
+            'direction': list(direction) if direction is not None else None,
+            'min': float(arr.min()) if min_ is None else float(min_),
+            'max': float(arr.max()) if max_ is None else float(max_)
+        }
+
+        with self._lock:
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                # Write to temporary files and then move into place, so a partially written entry is never read
+                tmp_npy = npy_path + '.tmp'
+                with open(tmp_npy, 'wb') as fh:
+                    np.save(fh, arr)
+                with open(meta_path + '.tmp', 'w') as fh:
+                    json.dump(meta, fh)
+                os.replace(tmp_npy, npy_path)
+                os.replace(meta_path + '.tmp', meta_path)
+            except OSError as e:
+                logging.warning('Could not write volume cache entry for {}\n{}'.format(source_path, e))
+                self._remove(npy_path + '.tmp', meta_path + '.tmp')
+                return
+            self._evict()
+
+    def put_async(self, *args, **kwargs):
+        """
+        Run put() on a background thread so a cache miss does not delay displaying the volume.
+        The array must not be modified afterwards
+        """
+        thread = threading.Thread(target=self.put, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
+
+    def _entries(self):
+        """
+        Returns
+        -------
+        list of (last access time, size in bytes, npy path, json path), least recently used first
+        """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            meta_path = os.path.join(self.cache_dir, name)
+            npy_path = meta_path[:-len('.json')] + '.npy'
+            try:
+                entries.append((os.path.getmtime(meta_path), os.path.getsize(npy_path), npy_path, meta_path))
+            except OSError:
+                self._remove(npy_path, meta_path)
+        return sorted(entries)
+
+    def size(self) -> int:
+        """
+        The total size in bytes of the cached arrays
+        """
+        return sum(entry[1] for entry in self._entries())
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(entry[1] for entry in entries)
+        for _, nbytes, npy_path, meta_path in entries:
+            if total <= self.budget:
+                break
+            self._remove(npy_path, meta_path)
+            total -= nbytes
+
+    def clear(self):
+        with self._lock:
+            for _, _, npy_path, meta_path in self._entries():
+                self._remove(npy_path, meta_path)
+
+    @staticmethod
+    def _remove(*paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+volume_cache = VolumeCache(CACHE_DIR)
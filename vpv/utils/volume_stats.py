@@ -0,0 +1,279 @@
+# Copyright 2016 Medical Research Council Harwell.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# @author Neil Horner <n.horner@har.mrc.ac.uk>
+
+"""
+Single pass volume statistics.
+
+The min, max, largest negative value, smallest positive value, mean and histogram of a volume are computed together in
+one pass over the data. The volume is split into z slabs which are reduced in a thread pool, so a memory mapped volume
+is only read from disk once.
+
+Results are kept in memory and in a small json sidecar file next to the image (<image>.vpvstats), or in the vpv_viewer
+app data directory if the image's directory is not writable, so reopening a volume needs no scan at all. As with the
+volume cache, the stats are invalidated if the image's modification time or size changes.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from vpv.common import log_dir
+from vpv.utils.native_readers import ZipMember
+
+STATS_VERSION = 1
+SIDECAR_EXT = '.vpvstats'
+STATS_DIR = os.path.join(log_dir, 'stats')
+NUM_BINS = 256
+FINE_BINS = 4096  # Bins of each slab's histogram, which are merged into the NUM_BINS histogram
+EXACT_RANGE = 65536  # Integer slabs with a range up to this have each value counted, so the histogram is exact
+SLAB_BYTES = 32 * 1024 ** 2
+NUM_WORKERS = min(8, os.cpu_count() or 1)
+
+
+class VolumeStats(object):
+    """
+    Attributes
+    ----------
+    min, max: float
+    neg_max: float
+        the largest negative value. None if there are no negative values
+    pos_min: float
+        the smallest positive value. None if there are no positive values
+    mean: float
+    histogram: np.ndarray
+        counts of NUM_BINS equal width bins from min to max
+    bin_edges: np.ndarray
+    """
+    def __init__(self, min_, max_, neg_max, pos_min, mean, histogram, bin_edges):
+        self.min = min_
+        self.max = max_
+        self.neg_max = neg_max
+        self.pos_min = pos_min
+        self.mean = mean
+        self.histogram = np.asarray(histogram)
+        self.bin_edges = np.asarray(bin_edges)
+
+    def to_dict(self) -> dict:
+        return {
+            'min': self.min,
+            'max': self.max,
+            'neg_max': self.neg_max,
+            'pos_min': self.pos_min,
+            'mean': self.mean,
+            'histogram': self.histogram.tolist(),
+            'bin_edges': self.bin_edges.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(d['min'], d['max'], d['neg_max'], d['pos_min'], d['mean'], d['histogram'], d['bin_edges'])
+
+
+def _optional_float(x):
+    return None if x is None else float(x)
+
+
+def _slab_stats(slab: np.ndarray):
+    """
+    Reduce one slab of the volume
+
+    Returns
+    -------
+    tuple: (min, max, largest negative, smallest positive, sum, count, histogram bin centres, histogram counts).
+    None if the slab has no finite values
+    """
+    slab = np.asarray(slab)
+    if slab.dtype.kind == 'f':
+        finite = np.isfinite(slab)
+        if not finite.all():
+            slab = slab[finite]
+    if slab.size == 0:
+        return None
+
+    lo, hi = slab.min(), slab.max()
+    neg_max = pos_min = None
+    if lo < 0:
+        neg_max = slab[slab < 0].max()
+    if hi > 0:
+        pos_min = slab[slab > 0].min() if lo <= 0 else lo
+    total = slab.sum(dtype=np.float64)
+
+    if slab.dtype.kind in 'iub' and int(hi) - int(lo) < EXACT_RANGE:
+        # Exact counts of each integer value
+        counts = np.bincount((slab.astype(np.int64) - int(lo)).ravel())
+        centres = int(lo) + np.arange(len(counts))
+    else:
+        if slab.dtype == np.float16:
+            slab = slab.astype(np.float32)  # np.histogram computes the bin edges in the data type
+        counts, edges = np.histogram(slab, bins=FINE_BINS, range=(float(lo), float(hi) if hi > lo else float(lo) + 1))
+        centres = (edges[:-1] + edges[1:]) / 2
+    return lo, hi, neg_max, pos_min, total, slab.size, centres, counts
+
+
+def compute_stats(arr, bins: int = NUM_BINS) -> VolumeStats:
+    """
+    Compute the statistics of a volume in a single pass over the data
+
+    Parameters
+    ----------
+    arr: np.ndarray
+        any array-like that can be sliced along its first axis
+    bins
+        the number of histogram bins
+
+    Returns
+    -------
+    VolumeStats
+    """
+    plane_bytes = max(1, int(np.prod(arr.shape[1:])) * np.dtype(arr.dtype).itemsize)
+    slab = max(1, SLAB_BYTES // plane_bytes)
+    starts = range(0, arr.shape[0], slab)
+
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as pool:
+        results = [r for r in pool.map(lambda z: _slab_stats(arr[z: z + slab]), starts) if r is not None]
+
+    if not results:
+        return VolumeStats(0.0, 0.0, None, None, 0.0, np.zeros(bins, dtype=np.int64), np.linspace(0, 1, bins + 1))
+
+    lo = min(r[0] for r in results)
+    hi = max(r[1] for r in results)
+    negs = [r[2] for r in results if r[2] is not None]
+    poss = [r[3] for r in results if r[3] is not None]
+    count = sum(r[5] for r in results)
+    mean = sum(r[4] for r in results) / count
+
+    edges = np.linspace(float(lo), float(hi) if hi > lo else float(lo) + 1, bins + 1)
+    histogram = np.zeros(bins, dtype=np.int64)
+    for r in results:
+        histogram += np.histogram(r[6], bins=edges, weights=r[7])[0].astype(np.int64)
+
+    return VolumeStats(float(lo), float(hi), _optional_float(max(negs) if negs else None),
+                       _optional_float(min(poss) if poss else None), float(mean), histogram, edges)
+
+
+class StatsStore(object):
+    """
+    Keeps the statistics of volumes in memory and in sidecar files
+    """
+    def __init__(self, stats_dir: str = STATS_DIR):
+        self.stats_dir = stats_dir
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _source(source):
+        """
+        Get the file the stats are of, and the extra key for images inside a zip file
+        """
+        if isinstance(source, ZipMember):
+            return source.zip_path, source.name
+        return source, ''
+
+    def _sidecar_paths(self, source, variant: str) -> list:
+        """
+        The sidecar next to the image, then the one in the app data directory
+        """
+        path, member = self._source(source)
+        suffix = '.{}'.format(variant) if variant else ''
+        paths = [] if member else [path + suffix + SIDECAR_EXT]
+        key = hashlib.sha1('{}|{}|{}'.format(os.path.realpath(path), member, variant).encode('utf-8')).hexdigest()
+        paths.append(os.path.join(self.stats_dir, key + SIDECAR_EXT))
+        return paths
+
+    def get(self, source, arr, variant: str = '') -> VolumeStats:
+        """
+        Get the statistics of a volume, computing them if they are not in memory or in a valid sidecar file
+
+        Parameters
+        ----------
+        source: str or ZipMember
+            the image file the volume was loaded from. If None the stats are computed and not stored
+        arr
+            the volume data. If None, only stored stats are returned
+        variant
+            distinguishes different decodings of the same file, as for the volume cache
+
+        Returns
+        -------
+        VolumeStats or None if arr is None and there are no stored stats
+        """
+        if not isinstance(source, (str, ZipMember)):
+            return compute_stats(arr) if arr is not None else None
+
+        path, member = self._source(source)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return compute_stats(arr) if arr is not None else None
+        key = (os.path.realpath(path), member, variant, st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            stats = self._memory.get(key)
+        if stats is not None:
+            return stats
+
+        sidecars = self._sidecar_paths(source, variant)
+        stats = self._read_sidecar(sidecars, st)
+        if stats is None:
+            if arr is None:
+                return None
+            stats = compute_stats(arr)
+            self._write_sidecar(sidecars, stats, st)
+
+        with self._lock:
+            self._memory[key] = stats
+        return stats
+
+    @staticmethod
+    def _read_sidecar(sidecars, st):
+        for sidecar in sidecars:
+            if not os.path.isfile(sidecar):
+                continue
+            try:
+                with open(sidecar, 'r') as fh:
+                    d = json.load(fh)
+                if d.get('version') == STATS_VERSION and d.get('mtime') == st.st_mtime_ns and \
+                        d.get('size') == st.st_size:
+                    return VolumeStats.from_dict(d['stats'])
+            except (OSError, ValueError, KeyError) as e:
+                logging.info('Ignoring unreadable stats file {}\n{}'.format(sidecar, e))
+        return None
+
+    def _write_sidecar(self, sidecars, stats: VolumeStats, st):
+        d = {'version': STATS_VERSION, 'mtime': st.st_mtime_ns, 'size': st.st_size, 'stats': stats.to_dict()}
+        for sidecar in sidecars:
+            try:
+                if not os.path.isdir(os.path.dirname(sidecar)):
+                    os.makedirs(os.path.dirname(sidecar))
+                tmp = sidecar + '.tmp'
+                with open(tmp, 'w') as fh:
+                    json.dump(d, fh)
+                os.replace(tmp, sidecar)
+                return
+            except OSError as e:
+                logging.info('Could not write stats file {}\n{}'.format(sidecar, e))
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+
+stats_store = StatsStore()
@@ -26,6 +26,7 @@ PYTHON_DIR = 'python-3.6.3.amd64'
 
 import os
 import sys
+import threading
 from pathlib import Path
 import logging
 from os.path import join, isdir
@@ -34,7 +35,7 @@ p = sys.path
 
 from PyQt5 import QtCore
 from PyQt5.QtGui import QKeyEvent
-from PyQt5.QtWidgets import QApplication, QMessageBox, QDesktopWidget
+from PyQt5.QtWidgets import QApplication, QMessageBox, QDesktopWidget, QProgressDialog
 from PyQt5.QtWidgets import QFileDialog
 from functools import partial
 from vpv import common
@@ -67,8 +68,13 @@ import pandas as pd
 from vpv.ui.controllers.dock_widget_manager import ManagerDockWidget
 from vpv.model.model import DataModel
 from vpv.utils.appdata import AppData
+from vpv.utils.volume_cache import volume_cache
+from vpv.utils.layout_cache import layout_cache
+from vpv.utils.pyramid import pyramid_memory
+from vpv.utils.native_readers import ZipMember
 from vpv.common import Orientation, Layers, log_path, error_dialog
 from vpv.display.slice_view_widget import SliceWidget
+from vpv.display.render_scheduler import RenderScheduler, FrameThrottle
 from vpv.ui.controllers.data_manager import ManageData
 from vpv.ui.controllers.options_tab import OptionsTab
 from vpv.annotations.annotations_widget import AnnotationsWidget
@@ -91,8 +97,8 @@ except Exception:  # I thnk it might not be an ImportError? look into it
 
 from vpv.ui.controllers.gradient_editor import GradientEditor
 import zipfile
+import io
 from vpv.lib import addict
-import tempfile
 import csv
 import logging.config
 from vpv.common import log_path
@@ -118,15 +124,25 @@ class Vpv(QtCore.QObject):
         self.view_scale_basrs = False
         self.view_id_counter = 0
         self.appdata = AppData()
+        volume_cache.budget = self.appdata.volume_cache_budget
+        layout_cache.budget = self.appdata.layout_cache_budget
+        pyramid_memory.budget = self.appdata.pyramid_memory_budget
 
         print(self.appdata.data)
         self.mainwindow = main_window.Mainwindow(self, self.appdata)
         # self.mainwindow.showFullScreen()
         self.model = DataModel()
-        self.model.updating_started_signal.connect(self.updating_started)
-        self.model.updating_finished_signal.connect(self.updating_finished)
+        self.model.slice_cache.budget = self.appdata.slice_cache_budget
+        # A progress dialog for each load in progress, most recently started last
+        self._progress_dialogs = []
         self.model.updating_msg_signal.connect(self.display_update_msg)
+        self.model.load_error_signal.connect(partial(QMessageBox.warning, self.mainwindow, 'Loading error'))
+        self.model.data_changed_signal.connect(self.on_model_data_changed)
         self.views = {}
+        # Synchronised slicing changes the other views' slices at most once per frame
+        self.render_scheduler = RenderScheduler()
+        # The voxel values under the mouse are read at most once per frame, for the latest mouse position
+        self._hover_throttle = FrameThrottle(self._hover_readout)
 
         # Initialise the QC tab
         self.qc = QC(self, self.mainwindow, self.appdata)
@@ -157,7 +173,6 @@ class Vpv(QtCore.QObject):
         self.heatmap_pixel_signal.connect(self.mainwindow.set_data_pix_intensity)
 
         self.options_tab = OptionsTab(self.mainwindow, self.appdata)
-        self.options_tab.flip_signal.connect(self.update_slice_views)
 
         self.filter_widget = LabelFilter(self.mainwindow)
         self.filter_widget.filter_label_signal.connect(self.filter_label)
@@ -186,6 +201,9 @@ class Vpv(QtCore.QObject):
         ]
 
         self.mapper = Coordinate_mapper(self.views, self.appdata.get_flips())
+        # The mapper's transforms must be remade before the views are updated with the new flips
+        self.options_tab.flip_signal.connect(self.mapper.flips_changed)
+        self.options_tab.flip_signal.connect(self.update_slice_views)
 
         for v in inital_views:
             self.setup_views(*v)
@@ -206,6 +224,7 @@ class Vpv(QtCore.QObject):
         self.check_vpv_version()
 
         self.atlas_meta = None
+        self.atlas_label_names = {}  # label number -> name, from atlas_meta
 
         self.data_manager.load_metadata_signal.connect(self.load_atlas_meta)
 
@@ -233,6 +252,7 @@ class Vpv(QtCore.QObject):
             self.appdata.last_atlas_metadata_file = str(file_[0])
             meta = pd.read_csv(file_[0], index_col=0)
             self.atlas_meta = meta
+            self.atlas_label_names = {int(label): str(name) for label, name in meta['label_name'].items()}
 
             # Todo, we need only one instace of LUT, not one in each SliceWidget
             # self.data_manager.luts.set_custom_atlas_colors(self.atlas_meta)
@@ -292,7 +312,10 @@ class Vpv(QtCore.QObject):
         z
             The current slice index of the slice view
         """
+        # Mouse moves come much faster than the screen is redrawn. Only read out the latest position each frame
+        self._hover_throttle(x, y, z, src_view)
 
+    def _hover_readout(self, x: int, y: int, z: int, src_view: SliceWidget):
         vol = src_view.main_volume
         vol2 = src_view.secondary_volume
         hm = src_view.heatmap_volume
@@ -306,16 +329,14 @@ class Vpv(QtCore.QObject):
         # map to the volume space
         vol_points = self.mapper.view_to_volume(x, y, z, src_view.orientation, src_view.main_volume.shape_xyz())
 
-        x1 = src_view.main_volume.shape_xyz()[0] - vol_points[0]
+        # The x of view_to_volume counts from 1
+        vx, vy, vz = vol_points[0] - 1, vol_points[1], vol_points[2]
 
         self.mainwindow.set_mouse_position_indicator(*vol_points)
 
-        # Get any flips that have been applied to the data
-        flipx, flipy, flipz = src_view.get_flips()
         # Get the values of the voxels underneath the mouse pointer
         try:
-            vol_hover_voxel_value = vol.get_data(Orientation.axial, vol_points[2],
-                                                 xy=[x1, vol_points[1]])
+            vol_hover_voxel_value = vol.get_voxel(vx, vy, vz)
 
         except IndexError:
             pass
@@ -323,11 +344,11 @@ class Vpv(QtCore.QObject):
             if x > 0 and x > 0:
                 self.volume_pixel_signal.emit(round(float(vol_hover_voxel_value), 2))
                 if vol2:
-                    vol2_hover_voxel_value = vol2.get_data(Orientation.axial, vol_points[2], xy=[x1, vol_points[1]])
+                    vol2_hover_voxel_value = vol2.get_voxel(vx, vy, vz)
                     self.volume2_pixel_signal.emit((round(float(vol2_hover_voxel_value), 4)))
 
                 if hm:
-                    hm_hover_voxel_value = hm.get_data(Orientation.axial, vol_points[2], xy=[x1, vol_points[1]])
+                    hm_hover_voxel_value = hm.get_voxel(vx, vy, vz)
                     self.heatmap_pixel_signal.emit((round(float(hm_hover_voxel_value), 4)))
 
         # # If shift is pressed emit signal to get other views to get to the same or interscting slice
@@ -338,14 +359,13 @@ class Vpv(QtCore.QObject):
             # With mouse move signal, also send current vol.
             # If veiews are not synchronised, syncyed slicing only occurs within the same volumes
             self.mouse_shift(x, y, z, src_view)
+            # This is already the once per frame update, so apply the slice changes now rather than a frame later
+            self.render_scheduler.flush()
 
     def set_current_label(self, value):
         self.last_selected_label = value
 
-        if self.atlas_meta is not None and value >=1:
-            label_name = self.atlas_meta.at[int(value), 'label_name']
-        else:
-            label_name = ''
+        label_name = self.atlas_label_names.get(int(value), '') if value >= 1 else ''
         self.atlas_label_over_signal.emit(label_name)
 
     def update_qc(self, *args, **kwargs):
@@ -381,10 +401,11 @@ class Vpv(QtCore.QObject):
         if not self.annotations_manager.annotating:
             return
         dims = self.current_annotation_volume().shape_xyz()
-        for dest_view in self.views.values():
-            # First map the annotation marker between views
-            dest_x, dest_y, dest_index = self.mapper.view_to_view(x, y, slice_idx, src_view.orientation,
-                                                                  dest_view.orientation, dims)
+        views = list(self.views.values())
+        # First map the annotation marker between views
+        dest_points = self.mapper.view_to_views(x, y, slice_idx, src_view.orientation,
+                                                [view.orientation for view in views], dims).tolist()
+        for dest_view, (dest_x, dest_y, dest_index) in zip(views, dest_points):
 
             dest_view.set_slice(dest_index)
             # Set the annotation marker. Red for pre-annoation, green indicates annotation save
@@ -417,15 +438,13 @@ class Vpv(QtCore.QObject):
             return
 
         dims = self.current_annotation_volume().shape_xyz()
+        self.render_scheduler.focused = src_view
 
-        for dest_view in self.views.values():
-
-            dest_x, dest_y, dest_z = self.mapper.view_to_view(x, y, z, src_view.orientation, dest_view.orientation, dims)
-
-            try:
-                dest_view.set_slice(dest_z, crosshair_xy=(dest_x, dest_y))
-            except IndexError:
-                pass
+        views = list(self.views.values())
+        dest_points = self.mapper.view_to_views(x, y, z, src_view.orientation, [view.orientation for view in views],
+                                                dims).tolist()
+        for dest_view, (dest_x, dest_y, dest_z) in zip(views, dest_points):
+            self.render_scheduler.request_slice(dest_view, dest_z, (dest_x, dest_y))
 
     def current_annotation_volume(self):
         """
@@ -489,14 +508,39 @@ class Vpv(QtCore.QObject):
         self.data_manager.link_views = True
         self.annotations_manager.tab_changed(indx)
 
-    def updating_started(self):
-        self.updating_dlg = QMessageBox()
+    def updating_started(self, cancel) -> QProgressDialog:
+        """
+        Open a progress dialog for a load. Each load has its own, so loads running at the same time don't close or
+        cancel each other's. Only shown if loading takes longer than the minimum duration
 
-    def updating_finished(self):
-        self.updating_dlg.close()
+        Parameters
+        ----------
+        cancel: callable
+            called when the cancel button is pressed. Cancels the load
+
+        Returns
+        -------
+        QProgressDialog
+            pass to updating_finished when the load is finished
+        """
+        dlg = QProgressDialog('Loading...', 'Cancel', 0, 0, self.mainwindow)
+        dlg.canceled.connect(cancel)
+        dlg.setValue(0)
+        self._progress_dialogs.append(dlg)
+        return dlg
+
+    def updating_finished(self, dlg: QProgressDialog):
+        if dlg not in self._progress_dialogs:  # Already closed
+            return
+        self._progress_dialogs.remove(dlg)
+        # Closing a QProgressDialog emits canceled
+        dlg.canceled.disconnect()
+        dlg.close()
 
     def display_update_msg(self, msg: str):
-        self.updating_dlg.setText(msg)
+        # The messages are from the load that was started most recently
+        if self._progress_dialogs:
+            self._progress_dialogs[-1].setLabelText(msg)
 
     def set_view_controls_visibility(self, visible):
         for view in self.views.values():
@@ -561,8 +605,7 @@ class Vpv(QtCore.QObject):
         self.data_manager.switch_selected_view(view_id)
 
     def recalc_connected_components(self):
-        self.current_view.layers[Layers.heatmap].vol.find_largest_connected_components()
-        self.data_manager.update_connected_components(self.current_view.layers[Layers.heatmap].vol.name)
+        self.data_manager.update_connected_components(self.current_view.layers[Layers.heatmap].vol.name, build=True)
 
     def add_view(self, id_, orientation, color, mapper):
         """
@@ -743,19 +786,25 @@ class Vpv(QtCore.QObject):
     def virtual_stack_callback(self, file_paths, last_dir):
         if len(file_paths) > 0:
             self.appdata.set_last_dir_browsed(last_dir)
-            try:
-                self.model.add_volume(file_paths, 'virtual_stack', memory_map=True)
-            except ValueError:
-                QMessageBox.warning(self.mainwindow, 'Loading error',
-                    "Virtual stack could not be loaded\nAre all images the same dimension?", QMessageBox.Ok)
-            else:
-                self.appdata.set_last_dir_browsed(last_dir)
-                if self.dock_widget.isVisible():
-                    self.dock_widget.update()
-                if not self.any_data_loaded:
-                    #  Load up one of the volumes just loaded into the bottom layer
-                    self.add_initial_volume()
-                    self.any_data_loaded = True
+            # Load in the background with a progress dialog that can cancel the load
+            handle = self.model.load_volumes_async([file_paths], 'virtual_stack', memory_map=True)
+            dlg = self.updating_started(handle.cancel)
+            handle.volume_loaded_signal.connect(self.on_virtual_stack_loaded)
+            handle.volume_failed_signal.connect(self.on_virtual_stack_failed)
+            handle.finished_signal.connect(partial(self.updating_finished, dlg))
+
+    def on_virtual_stack_loaded(self, _, vol_id):
+        if self.dock_widget.isVisible():
+            self.dock_widget.update()
+        if not self.any_data_loaded:
+            #  Load up one of the volumes just loaded into the bottom layer
+            self.add_initial_volume()
+            self.any_data_loaded = True
+
+    def on_virtual_stack_failed(self, _, msg):
+        QMessageBox.warning(self.mainwindow, 'Loading error',
+                            "Virtual stack could not be loaded\nAre all images the same dimension?\n{}".format(msg),
+                            QMessageBox.Ok)
 
     def add_initial_volume(self):
         """
@@ -790,8 +839,10 @@ class Vpv(QtCore.QObject):
         """
         if len(impc_analysis) > 0:
             self.load_impc_analysis(impc_analysis[0])
+        load_handle = None
         if len(volumes) > 0:
-            self.load_volumes(volumes, 'vol', memory_map)
+            # Load in the background. Annotations for these volumes are loaded as each one arrives
+            load_handle = self.load_volumes_async(volumes, 'vol', memory_map)
         if len(heatmaps) > 0:
             self.load_volumes(heatmaps, 'heatmap', memory_map, fdr_thresholds=False)
         if len(vector_files) > 0:
@@ -806,14 +857,16 @@ class Vpv(QtCore.QObject):
             self.load_annotations(annotations) # From importer
 
         self.appdata.set_last_dir_browsed(last_dir)
-        self._auto_load_annotations(volumes)
 
         if self.dock_widget.isVisible():
             self.data_manager.update()
             self.annotations_manager.update()
 
         if distribute:
-            self.distribute_volumes_across_views()
+            if load_handle:
+                load_handle.finished_signal.connect(self.distribute_volumes_across_views)
+            else:
+                self.distribute_volumes_across_views()
 
     def distribute_volumes_across_views(self):
         """
@@ -923,20 +976,25 @@ class Vpv(QtCore.QObject):
         non_loaded = []
         loaded_ids = []
 
-        for i, vol_path in enumerate(file_list):
-            try:
-
-                loaded_id = self.model.add_volume(vol_path, data_type, memory_map, fdr_thresholds)
+        # The volumes are decoded in parallel and each one is added to the model as soon as it is ready
+        cancel_event = threading.Event()
+        dlg = self.updating_started(cancel_event.set)
+        try:
+            for vol_path, result in self.model.add_volumes(file_list, data_type, memory_map, fdr_thresholds,
+                                                           cancel_event):
+                if isinstance(result, Exception):
+                    print(result)
+                    non_loaded.append(vol_path)
+                    continue
                 self.appdata.add_used_volume(vol_path)
                 if not self.any_data_loaded:
                     #  Load up one of the volumes just loaded into the bottom layer
                     self.add_initial_volume()
                     self.any_data_loaded = True
-            except (IOError, RuntimeError) as e:  # RT error Raised by SimpleITK
-                print(e)
-                non_loaded.append(vol_path)
-            else:
-                loaded_ids.append(loaded_id)
+                loaded_ids.append(result)
+        finally:
+            self.updating_finished(dlg)
+
         if len(non_loaded) > 0:
             common.error_dialog(self.mainwindow, 'Volumes not loaded', '\n'.join(non_loaded))
         # self.any_data_loaded
@@ -944,6 +1002,44 @@ class Vpv(QtCore.QObject):
         self._auto_load_annotations(file_list)
         return loaded_ids
 
+    def load_volumes_async(self, file_list, data_type, memory_map=False, fdr_thresholds=False):
+        """
+        Load volumes in the background so already loaded volumes can still be viewed.
+        Placeholder entries are shown in the data manager until each volume is ready.
+
+        Parameters
+        ----------
+        As load_volumes
+
+        Returns
+        -------
+        model.LoadHandle
+        """
+        handle = self.model.load_volumes_async(file_list, data_type, memory_map, fdr_thresholds)
+        handle.volume_loaded_signal.connect(self.on_async_volume_loaded)
+        handle.finished_signal.connect(partial(self.on_async_load_finished, handle))
+        return handle
+
+    def on_async_volume_loaded(self, vol_path: str, vol_id: str):
+        self.appdata.add_used_volume(vol_path)
+        if not self.any_data_loaded:
+            #  Load up the first volume to arrive into the bottom layer
+            self.add_initial_volume()
+            self.any_data_loaded = True
+        self._auto_load_annotations([vol_path])
+
+    def on_async_load_finished(self, handle):
+        if handle.failed:
+            common.error_dialog(self.mainwindow, 'Volumes not loaded', '\n'.join(str(p) for p, _ in handle.failed))
+        self.check_non_ras()
+
+    def on_model_data_changed(self):
+        """
+        Volumes have been added, or background loads started, so refresh the data manager comboboxes
+        """
+        if self.dock_widget.isVisible():
+            self.data_manager.update()
+
     def img_ids(self):
         return self.model.volume_id_list(sort=False)
 
@@ -987,31 +1083,43 @@ class Vpv(QtCore.QObject):
                 files_remaining.append(name)
 
         if all(file_names.values()):
-            td = tempfile.TemporaryDirectory()
-            zf.extractall(td.name)
-            popavg = join(td.name, file_names.popavg_file)
-            self.load_volumes([popavg], 'vol')
+            # The images are streamed straight out of the zip rather than extracting the archive
 
             # get the trhesholds from the csv files
-            qval_int_csv = join(td.name, file_names.qvals_intensity_file)
-            intensity_fdr_thresh = self.extract_fdr_thresholds(qval_int_csv)
-
-            inten_tstat = join(td.name, file_names.intensity_tstats_file)
-
-            self.load_volumes([inten_tstat], 'heatmap', memory_map=False,
-                              fdr_thresholds=intensity_fdr_thresh)
-
-            qval_jac_csv = join(td.name, file_names.qvals_jacobians_file)
-            jacobian_fdr_thresh = self.extract_fdr_thresholds(qval_jac_csv)
-
-            jac_tstat = join(td.name, file_names.jacobians_tstats_file)
-
-            self.load_volumes([jac_tstat], 'heatmap', memory_map=False,
-                              fdr_thresholds=jacobian_fdr_thresh)
+            intensity_fdr_thresh = self.extract_fdr_thresholds(file_names.qvals_intensity_file, zf)
+            jacobian_fdr_thresh = self.extract_fdr_thresholds(file_names.qvals_jacobians_file, zf)
+
+            # Decode the popavg and the t-statistic heatmaps in parallel
+            specs = [(ZipMember(impc_zip_file, file_names.popavg_file), 'vol', False, False),
+                     (ZipMember(impc_zip_file, file_names.intensity_tstats_file), 'heatmap', False,
+                      intensity_fdr_thresh),
+                     (ZipMember(impc_zip_file, file_names.jacobians_tstats_file), 'heatmap', False,
+                      jacobian_fdr_thresh)]
+            non_loaded = []
+            loaded = []
+            cancel_event = threading.Event()
+            dlg = self.updating_started(cancel_event.set)
+            try:
+                for spec, result in self.model.add_volume_batch(specs, cancel_event):
+                    if isinstance(result, Exception):
+                        print(result)
+                        non_loaded.append(spec[0].name)
+                        continue
+                    # Not added to the recent files, which can only reopen image files, not images in a zip
+                    loaded.append(str(spec[0]))
+            finally:
+                self.updating_finished(dlg)
+            if not self.any_data_loaded and len(non_loaded) < len(specs):
+                self.add_initial_volume()
+                self.any_data_loaded = True
+            if non_loaded:
+                common.error_dialog(self.mainwindow, 'Volumes not loaded', '\n'.join(non_loaded))
+            self._auto_load_annotations(loaded)
 
-            # Load any other volumes in the zip. Probably will be mutants
-            mutants = [join(td.name, x) for x in files_remaining if x.endswith('nrrd')]
-            self.load_volumes(mutants, 'vol', memory_map=False)
+            # Any other volumes in the zip are probably mutants. Only load them when they are viewed
+            for name in files_remaining:
+                if name.endswith('nrrd'):
+                    self.model.add_volume_lazy(ZipMember(impc_zip_file, name), 'vol')
 
             if not intensity_fdr_thresh:
                 common.info_dialog(self.mainwindow, "No hits",
@@ -1029,7 +1137,7 @@ class Vpv(QtCore.QObject):
             print(failed)
 
     @staticmethod
-    def extract_fdr_thresholds(stats_info_csv):
+    def extract_fdr_thresholds(stats_info_csv, zip_file=None):
         """
         Given a csv path containing the stats summary from the TCP pipeline (or LAMA)
         read the fdr threshold q value and corresponding t-statsitc into a dict
@@ -1038,6 +1146,8 @@ class Vpv(QtCore.QObject):
         ----------
         stats_info_csv: str
             path to csv
+        zip_file: zipfile.ZipFile
+            If given, stats_info_csv is the name of a file in this zip
         Returns
         -------
         dict of q to t mappings
@@ -1048,7 +1158,12 @@ class Vpv(QtCore.QObject):
         from collections import OrderedDict
         q_t = OrderedDict()
 
-        with open(stats_info_csv, 'r') as csvfile:
+        if zip_file:
+            csvfile = io.TextIOWrapper(zip_file.open(stats_info_csv), newline='')
+        else:
+            csvfile = open(stats_info_csv, 'r')
+
+        with csvfile:
             reader = csv.reader(csvfile, delimiter=',')
             reader.__next__()  # remove header
 